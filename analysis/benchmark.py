@@ -0,0 +1,339 @@
+import argparse
+import datetime
+import gc
+import importlib
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from cohortextractor import StudyDefinition, patients
+
+from event_data import EventData
+from extraction_profile import ExtractionProfile
+from local_backend import LocalBackend, bmi_codes, height_codes, weight_codes
+
+
+# Benchmarks for the local backend
+# Synthetic event data is generated for a number of patients, drawing codes
+# from the study's own codelists (so queries match at realistic rates), and
+# the whole study is extracted against it. A module with no `study`, such as
+# jcvi_variables.py, has its variables extracted for every patient. Each size
+# runs in a fresh process, and the peak RSS is reset once the data is built, so
+# it measures extraction rather than the data generator. Results are timed end
+# to end and per family of queries, and appended to a json lines history so
+# runs can be compared between commits. Run from the repository root, as the
+# study definition is:
+#   python analysis/benchmark.py --sizes 10000 100000 1000000
+#   python analysis/benchmark.py --study jcvi_variables --sizes 10000
+
+# query types timed together, by the table they read
+families = dict(
+    clinical_events=("with_these_clinical_events", "most_recent_bmi"),
+    medications=("with_these_medications",),
+    vaccinations=("with_tpp_vaccination_record",),
+    hospital_admissions=("admitted_to_hospital",),
+    sgss_tests=("with_test_result_in_sgss",),
+    address_and_practice=("address_as_of", "registered_practice_as_of"),
+)
+
+first_date = np.datetime64("2015-01-01", "D")
+last_date = np.datetime64("2022-12-31", "D")
+
+# codes that no codelist contains, so not every event matches something
+unmatched_codes = ["Y0000", "Y0001", "Y0002", "999999999"]
+
+
+def codes_in(covariate_definitions, query_types, arg):
+    codes = set()
+    for query_type, query_args in covariate_definitions.values():
+        codelist = query_args.get(arg) if query_type in query_types else None
+        if codelist is None:
+            continue
+        if codelist.has_categories:
+            codelist = [code for code, _ in codelist]
+        codes.update(codelist)
+    return sorted(codes)
+
+
+def values_of(covariate_definitions, query_type, arg):
+    values = set()
+    for definition_type, query_args in covariate_definitions.values():
+        value = query_args.get(arg) if definition_type == query_type else None
+        if value:
+            values.update([value] if isinstance(value, str) else value)
+    return sorted(values)
+
+
+def synthetic_frames(covariate_definitions, n_patients, events_per_patient=10, seed=0):
+    # columns of every table as numpy arrays, n_patients patients with
+    # patient_ids 1..n_patients and about events_per_patient clinical events each
+    rng = np.random.default_rng(seed)
+
+    def patients(k):
+        return rng.integers(1, n_patients + 1, k)
+
+    def dates(k, start=first_date, end=last_date):
+        return start + rng.integers(0, (end - start).astype(int) + 1, k)
+
+    def choose(values, k):
+        # blank values where the study gives nothing to draw from
+        values = values or [""]
+        return np.asarray(values)[rng.integers(0, len(values), k)]
+
+    event_codes = codes_in(covariate_definitions, ("with_these_clinical_events",), "codelist")
+    event_codes += bmi_codes + weight_codes + height_codes + unmatched_codes
+    medication_codes = codes_in(covariate_definitions, ("with_these_medications",), "codelist") + unmatched_codes
+    diagnoses = codes_in(covariate_definitions, ("admitted_to_hospital",), "with_these_diagnoses") + ["R69"]
+    ids = np.arange(1, n_patients + 1)
+    frames = {}
+    frames["patients"] = dict(
+        patient_id=ids,
+        sex=choose(["F", "M"], n_patients),
+        date_of_birth=dates(n_patients, np.datetime64("1920-01-01", "D"), np.datetime64("2010-12-31", "D")),
+    )
+    # everyone has a registration, and some have moved practice
+    n_registrations = n_patients + n_patients // 5
+    registered = np.r_[ids, patients(n_registrations - n_patients)]
+    start_dates = dates(n_registrations, np.datetime64("2000-01-01", "D"), np.datetime64("2020-06-01", "D"))
+    end_dates = start_dates + rng.integers(30, 3000, n_registrations)
+    end_dates[rng.random(n_registrations) < 0.8] = np.datetime64("NaT")
+    n_practices = max(n_patients // 5000, 10)
+    frames["registrations"] = dict(
+        patient_id=registered,
+        practice_id=rng.integers(1, n_practices + 1, n_registrations),
+        start_date=start_dates,
+        end_date=end_dates,
+    )
+    frames["practices"] = dict(
+        practice_id=np.arange(1, n_practices + 1),
+        nuts1_region_name=choose(["North East", "North West", "London", "East", "South West"], n_practices),
+        stp_code=np.char.add("E5400", (np.arange(n_practices) % 40).astype(str)),
+    )
+    frames["addresses"] = dict(
+        patient_id=registered,
+        start_date=start_dates,
+        end_date=end_dates,
+        index_of_multiple_deprivation=rng.integers(0, 32845, n_registrations) // 100 * 100,
+        rural_urban_classification=rng.integers(1, 9, n_registrations),
+    )
+    n_events = n_patients * events_per_patient
+    frames["clinical_events"] = dict(
+        patient_id=patients(n_events),
+        code=choose(event_codes, n_events),
+        date=dates(n_events),
+        numeric_value=np.round(rng.gamma(4, 8, n_events) * (rng.random(n_events) < 0.8), 1),
+    )
+    n_medications = n_events // 3
+    frames["medications"] = dict(
+        patient_id=patients(n_medications),
+        code=choose(medication_codes, n_medications),
+        date=dates(n_medications),
+    )
+    n_vaccinations = n_patients * 2
+    target_diseases = values_of(covariate_definitions, "with_tpp_vaccination_record", "target_disease_matches")
+    product_names = values_of(covariate_definitions, "with_tpp_vaccination_record", "product_name_matches")
+    frames["vaccinations"] = dict(
+        patient_id=patients(n_vaccinations),
+        target_disease=choose(target_diseases, n_vaccinations),
+        product_name=choose(product_names, n_vaccinations),
+        date=dates(n_vaccinations, np.datetime64("2019-09-01", "D")),
+    )
+    frames["sgss_tests"] = dict(
+        patient_id=patients(n_patients),
+        specimen_date=dates(n_patients, np.datetime64("2020-02-01", "D")),
+        result=choose(["positive", "negative", "negative", "negative"], n_patients),
+    )
+    n_admissions = n_patients // 2
+    admission_methods = values_of(covariate_definitions, "admitted_to_hospital", "with_admission_method")
+    admission_methods += ["11", "12"]
+    frames["hospital_admissions"] = dict(
+        patient_id=patients(n_admissions),
+        admission_date=dates(n_admissions, np.datetime64("2019-01-01", "D")),
+        admission_method=choose(admission_methods, n_admissions),
+        patient_classification=choose(["1", "1", "2", "3"], n_admissions),
+        diagnoses=np.char.add(np.char.add(choose(diagnoses, n_admissions), " "), choose(diagnoses, n_admissions)),
+    )
+    deaths = rng.choice(ids, n_patients // 50, replace=False)
+    frames["ons_deaths"] = dict(patient_id=deaths, date=dates(len(deaths), np.datetime64("2019-01-01", "D")))
+    n_consultations = n_patients * 5
+    frames["gp_consultations"] = dict(
+        patient_id=patients(n_consultations),
+        date=dates(n_consultations, np.datetime64("2018-01-01", "D"), np.datetime64("2021-12-31", "D")),
+    )
+    frames["sus_ethnicity"] = dict(
+        patient_id=patients(n_patients),
+        code=choose(["A", "B", "C", "D", "H", "J", "M", "N", "R", "S", "Z", ""], n_patients),
+    )
+    return frames
+
+
+def load_study(study_module):
+    module = importlib.import_module(study_module)
+    if hasattr(module, "study"):
+        return module.study
+    # a module of variables for a study, named after the module
+    name = study_module.rsplit(".", 1)[-1]
+    variables = getattr(module, name, None)
+    if not isinstance(variables, dict):
+        raise ValueError(f"{study_module} defines neither `study` nor a `{name}` dict of variables")
+    return StudyDefinition(population=patients.all(), **variables)
+
+
+def status_bytes(field):
+    # a memory figure from /proc/self/status, or None where there isn't one
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    # linux lets a process reset its own high-water mark; returns False where
+    # it can't, and the peak then includes everything before extraction
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_bytes():
+    peak = status_bytes("VmHWM")
+    if peak is not None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def family_seconds(profile):
+    seconds = dict.fromkeys(list(families) + ["other"], 0.0)
+    family_of = {query_type: family for family, query_types in families.items() for query_type in query_types}
+    for record in profile.variables.values():
+        seconds[family_of.get(record["query_type"], "other")] += record["seconds"]
+    return seconds
+
+
+def run_benchmark(study_module, n_patients, events_per_patient, seed, options):
+    study = load_study(study_module)
+    start = time.perf_counter()
+    frames = synthetic_frames(study.covariate_definitions, n_patients, events_per_patient, seed)
+    generated = time.perf_counter()
+    event_data = EventData({name: pd.DataFrame(columns) for name, columns in frames.items()})
+    del frames
+    gc.collect()
+    loaded = time.perf_counter()
+    # memory in use with the event data loaded, and the peak from here on
+    baseline_rss = status_bytes("VmRSS")
+    peak_reset = reset_peak_rss()
+    profile = ExtractionProfile(trace_memory=False)
+    frame = LocalBackend(event_data, study.covariate_definitions, profile=profile, **options).to_dataframe()
+    profile.finish()
+    extract_seconds = time.perf_counter() - loaded
+    return dict(
+        n_patients=n_patients,
+        events_per_patient=events_per_patient,
+        event_rows=sum(len(table.get("row", ())) for table in event_data.tables.values()),
+        output_rows=len(frame),
+        generate_seconds=generated - start,
+        load_seconds=loaded - generated,
+        extract_seconds=extract_seconds,
+        patients_per_second=n_patients / extract_seconds,
+        family_seconds=family_seconds(profile),
+        baseline_rss_bytes=baseline_rss,
+        peak_rss_bytes=peak_rss_bytes(),
+        peak_rss_reset=peak_reset,
+    )
+
+
+def current_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_run(history, record):
+    # the latest earlier run of the same benchmark
+    same = ("study", "n_patients", "events_per_patient", "seed", "options")
+    for earlier in reversed(history):
+        if all(earlier.get(key) == record[key] for key in same):
+            return earlier
+    return None
+
+
+def describe(record, previous):
+    line = (
+        f"{record['n_patients']:>10} patients  {record['extract_seconds']:8.2f}s  "
+        f"{record['patients_per_second']:10.0f} patients/s  {record['peak_rss_bytes'] / 2 ** 20:8.0f} MiB peak"
+    )
+    if record.get("baseline_rss_bytes") is not None:
+        line += f" ({record['baseline_rss_bytes'] / 2 ** 20:.0f} MiB with the data loaded)"
+    if previous is not None:
+        change = record["extract_seconds"] / previous["extract_seconds"] - 1
+        line += f"  {change:+.1%} vs {previous.get('commit') or 'previous run'}"
+    families = "  ".join(f"{family} {seconds:.2f}s" for family, seconds in record["family_seconds"].items())
+    return f"{line}\n{'':12}{families}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the local backend on synthetic event data")
+    parser.add_argument("--study", default="study_definition", help="study definition module")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="numbers of patients"
+    )
+    parser.add_argument("--events-per-patient", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--history", default="output/benchmarks/history.jsonl", help="json lines file to append results to"
+    )
+    parser.add_argument("--no-fuse", action="store_true")
+    parser.add_argument("--staged", action="store_true")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    options = dict(fuse=not args.no_fuse, staged=args.staged, workers=args.workers)
+    history = read_history(args.history)
+    directory = os.path.dirname(args.history)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    commit = current_commit()
+    for n_patients in args.sizes:
+        # a fresh process for each size, so peak RSS isn't carried over
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            result = pool.submit(run_benchmark, args.study, n_patients, args.events_per_patient, args.seed, options)
+            record = dict(
+                commit=commit,
+                timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+                study=args.study,
+                seed=args.seed,
+                options=options,
+                **result.result(),
+            )
+        print(describe(record, previous_run(history, record)))
+        history.append(record)
+        with open(args.history, "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+if __name__ == "__main__":
+    main()
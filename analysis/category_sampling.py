@@ -0,0 +1,62 @@
+import math
+
+import numpy as np
+
+
+# Sampling categories by their ratios, for dummy data
+# Each ratio map (such as imd's 320 equally likely values) is compiled once
+# into an alias table, by Vose's method: every one of its k slots keeps a
+# probability and an alias, so a draw is a uniform slot, a uniform number and
+# one comparison, and millions of draws are a few whole-array operations
+# however many categories there are. Compiled tables are cached by ratio map;
+# the cache can be handed to worker processes with restore_tables so that
+# they don't compile them again.
+
+
+class AliasTable:
+    def __init__(self, values, probabilities):
+        self.values = np.empty(len(values), dtype=object)
+        self.values[:] = list(values)
+        k = len(self.values)
+        scaled = np.asarray(probabilities, dtype=np.float64) * k / np.sum(probabilities)
+        self.probabilities = np.ones(k)
+        self.aliases = np.arange(k)
+        small = [i for i in range(k) if scaled[i] < 1]
+        large = [i for i in range(k) if scaled[i] >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+        # whatever is left over is 1 but for rounding, and keeps its own slot
+
+    def __len__(self):
+        return len(self.values)
+
+    def sample_indexes(self, rng, n):
+        slots = rng.integers(0, len(self), n)
+        keep = rng.random(n) < self.probabilities[slots]
+        return np.where(keep, slots, self.aliases[slots])
+
+    def sample(self, rng, n):
+        return self.values[self.sample_indexes(rng, n)]
+
+
+# ratio map, as a tuple of its items, -> AliasTable
+tables = {}
+
+
+def table_for(ratios):
+    key = tuple(ratios.items())
+    if key not in tables:
+        total = sum(ratios.values())
+        if not math.isclose(total, 1):
+            raise ValueError(f"Category ratios must add up to 1, not {total}")
+        tables[key] = AliasTable(ratios.keys(), list(ratios.values()))
+    return tables[key]
+
+
+def restore_tables(compiled):
+    # in worker processes, tables compiled by the parent
+    tables.update(compiled)
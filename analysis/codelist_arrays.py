@@ -0,0 +1,136 @@
+import threading
+
+import numpy as np
+
+
+# Integer representation of codelists
+# SNOMED and dm+d codes are plain integers, so they are stored as their int64
+# value. Anything else (CTV3, ICD-10, or a numeric-looking code with a leading
+# zero) is interned in a table shared by all codelists and stored as a negative
+# id, so the two ranges can never collide. A codelist then becomes a sorted
+# int64 array and membership over millions of event rows is a single
+# searchsorted call instead of a python loop over strings. Each codelist's
+# array (and, for categorised codelists, its category lookup) is built once per
+# process and shared by every query that uses the same codes.
+
+# a code that is not in the interning table never matches any codelist
+unknown_code = np.iinfo(np.int64).min
+
+
+def is_integer_code(code):
+    return code.isdigit() and len(code) <= 18 and (code == "0" or not code.startswith("0"))
+
+
+class CodeInterner:
+    def __init__(self):
+        self.ids = {}
+        self.codes = []
+        # codelists may be encoded by several threads at once
+        self.lock = threading.Lock()
+
+    def intern(self, code):
+        if code not in self.ids:
+            with self.lock:
+                if code not in self.ids:
+                    self.codes.append(code)
+                    self.ids[code] = -len(self.codes)
+        return self.ids[code]
+
+    def encode_one(self, code, add=True):
+        if is_integer_code(code):
+            return int(code)
+        if add:
+            return self.intern(code)
+        return self.ids.get(code, unknown_code)
+
+    def encode(self, codes, add=False):
+        # encode each distinct code once and broadcast back to every row; event
+        # data has millions of rows but only thousands of distinct codes
+        codes = np.asarray(codes, dtype=str)
+        if not codes.size:
+            return np.empty(0, dtype=np.int64)
+        distinct, inverse = np.unique(codes, return_inverse=True)
+        ids = np.fromiter(
+            (self.encode_one(code, add=add) for code in distinct),
+            dtype=np.int64,
+            count=len(distinct),
+        )
+        return ids[inverse.reshape(codes.shape)]
+
+    def decode(self, ids):
+        return [str(i) if i >= 0 else self.codes[-i - 1] for i in np.asarray(ids).tolist()]
+
+
+interner = CodeInterner()
+
+
+def restore_interner(codes):
+    # give a worker process the same code ids as the process that encoded
+    # its event data
+    interner.codes = list(codes)
+    interner.ids = {code: -(i + 1) for i, code in enumerate(interner.codes)}
+    # anything encoded before now may have used other ids
+    codelist_arrays.clear()
+    category_lookups.clear()
+
+
+# codelist contents -> sorted code ids, and -> CategoryLookup
+codelist_arrays = {}
+category_lookups = {}
+
+
+def codelist_array(codes):
+    key = tuple(codes)
+    if key not in codelist_arrays:
+        if getattr(codes, "has_categories", False):
+            codes = [code for code, _ in codes]
+        array = np.unique(interner.encode(list(codes), add=True))
+        # shared by every query that uses this codelist
+        array.flags.writeable = False
+        codelist_arrays[key] = array
+    return codelist_arrays[key]
+
+
+def isin_codelist(code_ids, codelist_ids):
+    # vectorised membership test of encoded event codes against a codelist array
+    code_ids = np.asarray(code_ids, dtype=np.int64)
+    if not len(codelist_ids):
+        return np.zeros(code_ids.shape, dtype=bool)
+    positions = np.searchsorted(codelist_ids, code_ids)
+    positions[positions == len(codelist_ids)] = 0
+    return codelist_ids[positions] == code_ids
+
+
+class CategoryLookup:
+    # sorted code ids with a parallel array of category numbers, so a whole
+    # column of encoded event codes can be mapped to categories at once
+    def __init__(self, codes):
+        assert codes.has_categories
+        self.categories = sorted({category for _, category in codes})
+        category_numbers = {category: i for i, category in enumerate(self.categories)}
+        code_ids = interner.encode([code for code, _ in codes], add=True)
+        order = np.argsort(code_ids)
+        self.code_ids = code_ids[order]
+        self.category_numbers = np.array(
+            [category_numbers[category] for _, category in codes], dtype=np.int32
+        )[order]
+
+    def category_numbers_for(self, code_ids):
+        # -1 for codes not in the codelist
+        code_ids = np.asarray(code_ids, dtype=np.int64)
+        positions = np.searchsorted(self.code_ids, code_ids)
+        positions[positions == len(self.code_ids)] = 0
+        found = self.code_ids[positions] == code_ids
+        return np.where(found, self.category_numbers[positions], -1)
+
+    def categories_for(self, code_ids):
+        # category labels, with "" for codes not in the codelist
+        labels = np.array(self.categories + [""], dtype=object)
+        return labels[self.category_numbers_for(code_ids)]
+
+
+def category_lookup(codes):
+    key = tuple(codes)
+    if key not in category_lookups:
+        category_lookups[key] = CategoryLookup(codes)
+    return category_lookups[key]
@@ -0,0 +1,164 @@
+import csv
+import functools
+import hashlib
+import io
+import json
+import os
+import struct
+
+from cohortextractor import codelist
+
+
+# Compiled codelist cache
+# Each codelist is stored once as a sorted array of fixed width codes (and
+# categories), under a key made from the sha recorded for its csv in
+# codelists/codelists.json, the csv's size, and the system/column/
+# category_column used to read it. The key doesn't depend on where or when the
+# csv was checked out, so every checkout of the same codelists shares cache
+# entries, and working it out is a stat call: a warm cache never opens the csv.
+# A csv that isn't in the manifest is keyed on its contents instead. (A listed
+# csv edited by hand keeps its key unless its size changes; codelist_loader.py
+# checks every csv against its sha.) Cache files are read whole and decoded
+# into the codelist, which is much cheaper than parsing csv; each process
+# holds its own copy of the codes.
+# Set CODELIST_CACHE_DIR to move the cache, or to an empty string to disable it.
+
+cache_dir = os.environ.get("CODELIST_CACHE_DIR", ".codelist_cache")
+
+manifest_file = "codelists/codelists.json"
+
+magic = b"CODELST1"
+# magic, number of codes, code width, category width
+header = struct.Struct("<8sIII")
+
+
+def read_manifest(path=manifest_file):
+    with open(path) as f:
+        return json.load(f)["files"]
+
+
+@functools.lru_cache(maxsize=None)
+def manifest_shas():
+    # csv filename -> sha, or nothing if there is no manifest
+    try:
+        return {filename: entry["sha"] for filename, entry in read_manifest().items()}
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def cache_key(filename, system, column="code", category_column=None):
+    sha = manifest_shas().get(os.path.basename(filename))
+    if sha is None:
+        with open(filename, "rb") as f:
+            sha = hashlib.sha1(f.read()).hexdigest()
+    size = os.stat(filename).st_size
+    key = "\0".join([sha, str(size), system, column, category_column or ""])
+    return hashlib.sha1(key.encode("utf8")).hexdigest()
+
+
+def cache_path(filename, system, column="code", category_column=None):
+    return os.path.join(cache_dir, cache_key(filename, system, column, category_column) + ".bin")
+
+
+def codelist_from_csv_bytes(content, system, column="code", category_column=None):
+    # same rules as cohortextractor's codelist_from_csv, but reading from bytes
+    # already in memory so callers can hash and parse a file in one read
+    codes = []
+    for row in csv.DictReader(io.StringIO(content.decode("utf8"))):
+        code = row[column].strip()
+        if not code:
+            continue
+        if category_column:
+            codes.append((code, row[category_column].strip()))
+        else:
+            codes.append(code)
+    return codelist(codes, system)
+
+
+def pack_codelist(codes):
+    if codes.has_categories:
+        rows = sorted(codes)
+    else:
+        rows = sorted((code, "") for code in codes)
+    encoded = [(code.encode("utf8"), category.encode("utf8")) for code, category in rows]
+    code_width = max(len(code) for code, _ in encoded)
+    category_width = max(len(category) for _, category in encoded)
+    return b"".join(
+        [header.pack(magic, len(encoded), code_width, category_width)]
+        + [code.ljust(code_width, b"\0") for code, _ in encoded]
+        + [category.ljust(category_width, b"\0") for _, category in encoded]
+    )
+
+
+def unpack_codelist(buffer, system):
+    file_magic, n, code_width, category_width = header.unpack_from(buffer)
+    if file_magic != magic:
+        raise ValueError("not a compiled codelist")
+    codes_start = header.size
+    categories_start = codes_start + n * code_width
+    codes = fixed_width_strings(buffer, codes_start, n, code_width)
+    if category_width:
+        categories = fixed_width_strings(buffer, categories_start, n, category_width)
+        return codelist(list(zip(codes, categories)), system, check_categories=False)
+    return codelist(codes, system)
+
+
+def fixed_width_strings(buffer, start, n, width):
+    data = buffer[start:start + n * width]
+    return [
+        data[i:i + width].rstrip(b"\0").decode("utf8")
+        for i in range(0, n * width, width)
+    ]
+
+
+def write_compiled(path, data):
+    # write to a temporary file first so that concurrent readers never see a
+    # partially written cache entry
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def read_compiled(path, system):
+    with open(path, "rb") as f:
+        return unpack_codelist(f.read(), system)
+
+
+def cached_codelist_from_bytes(content, filename, system, column="code", category_column=None):
+    # content is the csv at filename, already read by the caller
+    if not cache_dir:
+        return codelist_from_csv_bytes(content, system, column=column, category_column=category_column)
+
+    path = cache_path(filename, system, column, category_column)
+    if os.path.exists(path):
+        return read_compiled(path, system)
+    return compile_codelist(path, content, system, column, category_column)
+
+
+def compile_codelist(path, content, system, column, category_column):
+    data = pack_codelist(
+        codelist_from_csv_bytes(content, system, column=column, category_column=category_column)
+    )
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_compiled(path, data)
+    except OSError:
+        # nowhere to write the cache (such as a read-only workspace): the
+        # codelist is parsed from its csv again next time
+        pass
+    # return the codelist as it is read back from the cache, so a cold and a
+    # warm cache give identical (sorted) codelists
+    return unpack_codelist(data, system)
+
+
+def cached_codelist_from_csv(filename, system, column="code", category_column=None):
+    if cache_dir:
+        path = cache_path(filename, system, column, category_column)
+        if os.path.exists(path):
+            return read_compiled(path, system)
+    with open(filename, "rb") as f:
+        content = f.read()
+    if not cache_dir:
+        return codelist_from_csv_bytes(content, system, column=column, category_column=category_column)
+    return compile_codelist(path, content, system, column, category_column)
@@ -0,0 +1,62 @@
+import hashlib
+import os
+from concurrent.futures import (FIRST_EXCEPTION, ThreadPoolExecutor, wait)
+
+from codelist_cache import (cached_codelist_from_bytes, manifest_file, read_manifest)
+
+
+# Bulk codelist loader
+# Reads and parses every codelist at once on a thread pool, checking each csv
+# against the sha recorded for it in codelists/codelists.json in the same pass.
+# Useful when the codelist cache is cold, eg straight after `opensafely
+# codelists update`. Run as a script to verify all codelists and warm the cache:
+#   python analysis/codelist_loader.py
+
+
+def manifest_sha(content):
+    # same hash as the opensafely cli, which normalises line endings first
+    return hashlib.sha1(b"\n".join(content.splitlines())).hexdigest()
+
+
+def load_verified(name, spec, manifest):
+    filename = os.path.basename(spec["filename"])
+    if filename not in manifest:
+        raise ValueError(f"codelist '{name}' ({spec['filename']}) is not listed in {manifest_file}")
+    with open(spec["filename"], "rb") as f:
+        content = f.read()
+    if manifest_sha(content) != manifest[filename]["sha"]:
+        raise ValueError(
+            f"codelist '{name}' ({spec['filename']}) does not match the sha in "
+            f"{manifest_file}; has it been modified since it was downloaded?"
+        )
+    return cached_codelist_from_bytes(
+        content,
+        spec["filename"],
+        spec["system"],
+        column=spec.get("column", "code"),
+        category_column=spec.get("category_column"),
+    )
+
+
+def load_codelists(specs, manifest_path=manifest_file, max_workers=None):
+    manifest = read_manifest(manifest_path)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(load_verified, name, spec, manifest): name
+            for name, spec in specs.items()
+        }
+        # fail fast: stop at the first bad codelist rather than parsing the rest
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                for pending in not_done:
+                    pending.cancel()
+                raise future.exception()
+        return {futures[future]: future.result() for future in futures}
+
+
+if __name__ == "__main__":
+    import codelists
+
+    loaded = codelists.load_all()
+    print(f"{len(loaded)} codelists loaded and verified against {manifest_file}")
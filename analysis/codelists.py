@@ -1,331 +1,400 @@
-from cohortextractor import (codelist_from_csv, combine_codelists)
+from cohortextractor import (combine_codelists, filter_codes_by_category)
+
+from codelist_cache import cached_codelist_from_csv
+
+
+# Codelists are not read when this module is imported. Each one is parsed from
+# its csv the first time it is accessed as `codelists.<name>` (see __getattr__
+# below), so a study only pays for the codelists it actually uses. Parsed
+# codelists are kept in the compiled cache in codelist_cache.py, so the csv
+# itself is only parsed again when it changes.
+
+codelist_specs = dict(
+
+    # Asthma Diagnosis code
+    ast=dict(
+        filename="codelists/primis-covid19-vacc-uptake-ast.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Asthma Admission codes
+    astadm=dict(
+        filename="codelists/primis-covid19-vacc-uptake-astadm.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Asthma systemic steroid prescription codes
+    astrx=dict(
+        filename="codelists/primis-covid19-vacc-uptake-astrx.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Chronic Respiratory Disease
+    resp_cov=dict(
+        filename="codelists/primis-covid19-vacc-uptake-resp_cov.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Chronic heart disease codes
+    chd_cov=dict(
+        filename="codelists/primis-covid19-vacc-uptake-chd_cov.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Chronic kidney disease diagnostic codes
+    ckd_cov=dict(
+        filename="codelists/primis-covid19-vacc-uptake-ckd_cov.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Chronic kidney disease codes - all stages
+    ckd15=dict(
+        filename="codelists/primis-covid19-vacc-uptake-ckd15.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Chronic kidney disease codes-stages 3 - 5
+    ckd35=dict(
+        filename="codelists/primis-covid19-vacc-uptake-ckd35.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Chronic Liver disease codes
+    cld=dict(
+        filename="codelists/primis-covid19-vacc-uptake-cld.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Diabetes diagnosis codes
+    diab=dict(
+        filename="codelists/primis-covid19-vacc-uptake-diab.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Immunosuppression diagnosis codes
+    immdx_cov=dict(
+        filename="codelists/primis-covid19-vacc-uptake-immdx_cov.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Immunosuppression medication codes
+    immrx=dict(
+        filename="codelists/primis-covid19-vacc-uptake-immrx.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Chronic Neurological Disease including Significant Learning Disorder
+    cns_cov=dict(
+        filename="codelists/primis-covid19-vacc-uptake-cns_cov.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Asplenia or Dysfunction of the Spleen codes
+    spln_cov=dict(
+        filename="codelists/primis-covid19-vacc-uptake-spln_cov.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # BMI
+    bmi=dict(
+        filename="codelists/primis-covid19-vacc-uptake-bmi.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # All BMI coded terms
+    bmi_stage=dict(
+        filename="codelists/primis-covid19-vacc-uptake-bmi_stage.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Severe Obesity code recorded
+    sev_obesity=dict(
+        filename="codelists/primis-covid19-vacc-uptake-sev_obesity.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Diabetes resolved codes
+    dmres=dict(
+        filename="codelists/primis-covid19-vacc-uptake-dmres.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Severe Mental Illness codes
+    sev_mental=dict(
+        filename="codelists/primis-covid19-vacc-uptake-sev_mental.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Remission codes relating to Severe Mental Illness
+    smhres=dict(
+        filename="codelists/primis-covid19-vacc-uptake-smhres.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # High Risk from COVID-19 code
+    shield=dict(
+        filename="codelists/primis-covid19-vacc-uptake-shield.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Lower Risk from COVID-19 codes
+    nonshield=dict(
+        filename="codelists/primis-covid19-vacc-uptake-nonshield.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # to represent household contact of shielding individual
+    hhld_imdef=dict(
+        filename="codelists/primis-covid19-vacc-uptake-hhld_imdef.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Wider Learning Disability
+    learndis=dict(
+        filename="codelists/primis-covid19-vacc-uptake-learndis.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Carer codes
+    carer=dict(
+        filename="codelists/primis-covid19-vacc-uptake-carer.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # No longer a carer codes
+    notcarer=dict(
+        filename="codelists/primis-covid19-vacc-uptake-notcarer.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Employed by Care Home codes
+    carehome=dict(
+        filename="codelists/primis-covid19-vacc-uptake-carehome.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Employed by nursing home codes
+    nursehome=dict(
+        filename="codelists/primis-covid19-vacc-uptake-nursehome.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Employed by domiciliary care provider codes
+    domcare=dict(
+        filename="codelists/primis-covid19-vacc-uptake-domcare.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Patients in long-stay nursing and residential care
+    longres=dict(
+        filename="codelists/primis-covid19-vacc-uptake-longres.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Ethnicity codes
+    eth2001=dict(
+        filename="codelists/primis-covid19-vacc-uptake-eth2001.csv",
+        system="snomed",
+        column="code",
+        category_column="grouping_6_id",
+    ),
+
+    # Pregnancy codes recorded in the 8.5 months before the audit run date
+    preg=dict(
+        filename="codelists/primis-covid19-vacc-uptake-preg.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Pregnancy or Delivery codes recorded in the 8.5 months before audit run date
+    pregdel=dict(
+        filename="codelists/primis-covid19-vacc-uptake-pregdel.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # COVID vaccination contraindication codes
+    covcontra=dict(
+        filename="codelists/primis-covid19-vacc-uptake-covcontra.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # First COVID vaccination declined
+    cov1decl=dict(
+        filename="codelists/primis-covid19-vacc-uptake-cov1decl.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    # Second COVID vaccination declined
+    cov2decl=dict(
+        filename="codelists/primis-covid19-vacc-uptake-cov2decl.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    ## History of covid
+    covid_codes=dict(
+        filename="codelists/opensafely-covid-identification.csv",
+        system="icd10",
+        column="icd10_code",
+    ),
+
+    ## Smoking
+    clear_smoking_codes=dict(
+        filename="codelists/opensafely-smoking-clear.csv",
+        system="ctv3",
+        column="CTV3Code",
+        category_column="Category",
+    ),
+
+    unclear_smoking_codes=dict(
+        filename="codelists/opensafely-smoking-unclear.csv",
+        system="ctv3",
+        column="CTV3Code",
+        category_column="Category",
+    ),
+
+    ## SSRI
+    ssri_codes=dict(
+        filename="codelists/opensafely-selective-serotonin-reuptake-inhibitors-dmd.csv",
+        system="snomed",
+        column="dmd_id",
+    ),
+
+    ## DMARD
+    dmards_codes=dict(
+        filename="codelists/opensafely-dmards.csv",
+        system="snomed",
+        column="snomed_id",
+    ),
+
+    ## hypertension
+    hypertension_codes=dict(
+        filename="codelists/opensafely-hypertension.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+
+    # drugs for end of life care
+    eol_codes=dict(
+        filename="codelists/nhsd-primary-care-domain-refsets-palcare_cod.csv",
+        system="snomed",
+        column="code",
+    ),
+
+    midazolam_codes=dict(
+        filename="codelists/opensafely-midazolam-end-of-life.csv",
+        system="snomed",
+        column="dmd_id",
+    ),
+
+    # tests for probable COVID
+    covid_primary_care_positive_test=dict(
+        filename="codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+
+    covid_primary_care_code=dict(
+        filename="codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+
+    covid_primary_care_sequalae=dict(
+        filename="codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+
+)
+
+# codelists built by combining other codelists in this module
+combined_codelists = dict(
+
+    # tests for probable COVID
+    covid_primary_care_probable_combined=(
+        "covid_primary_care_positive_test",
+        "covid_primary_care_code",
+        "covid_primary_care_sequalae",
+    ),
+
+)
+
+
+def load_codelist(name):
+    if name in codelist_specs:
+        return cached_codelist_from_csv(**codelist_specs[name])
+    if name in combined_codelists:
+        return combine_codelists(*(getattr_codelist(part) for part in combined_codelists[name]))
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def getattr_codelist(name):
+    # store the loaded codelist as a module global, so later lookups are plain
+    # attribute access and never reach __getattr__ again
+    if name not in globals():
+        globals()[name] = load_codelist(name)
+    return globals()[name]
+
+
+def __getattr__(name):
+    return getattr_codelist(name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(codelist_specs) | set(combined_codelists))
 
 
-# Asthma Diagnosis code
-ast = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-ast.csv",
-    system="snomed",
-    column="code",
-)
-
-# Asthma Admission codes
-astadm = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-astadm.csv",
-    system="snomed",
-    column="code",
-)
-
-# Asthma systemic steroid prescription codes
-astrx = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-astrx.csv",
-    system="snomed",
-    column="code",
-)
-
-# Chronic Respiratory Disease
-resp_cov = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-resp_cov.csv",
-    system="snomed",
-    column="code",
-)
-
-# Chronic heart disease codes
-chd_cov = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-chd_cov.csv",
-    system="snomed",
-    column="code",
-)
-
-# Chronic kidney disease diagnostic codes
-ckd_cov = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-ckd_cov.csv",
-    system="snomed",
-    column="code",
-)
-
-# Chronic kidney disease codes - all stages
-ckd15 = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-ckd15.csv",
-    system="snomed",
-    column="code",
-)
-
-# Chronic kidney disease codes-stages 3 - 5
-ckd35 = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-ckd35.csv",
-    system="snomed",
-    column="code",
-)
-
-# Chronic Liver disease codes
-cld = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-cld.csv",
-    system="snomed",
-    column="code",
-)
-
-# Diabetes diagnosis codes
-diab = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-diab.csv",
-    system="snomed",
-    column="code",
-)
-
-# Immunosuppression diagnosis codes
-immdx_cov = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-immdx_cov.csv",
-    system="snomed",
-    column="code",
-)
-
-# Immunosuppression medication codes
-immrx = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-immrx.csv",
-    system="snomed",
-    column="code",
-)
-
-# Chronic Neurological Disease including Significant Learning Disorder
-cns_cov = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-cns_cov.csv",
-    system="snomed",
-    column="code",
-)
-
-# Asplenia or Dysfunction of the Spleen codes
-spln_cov = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-spln_cov.csv",
-    system="snomed",
-    column="code",
-)
-
-# BMI
-bmi = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-bmi.csv",
-    system="snomed",
-    column="code",
-)
-
-# All BMI coded terms
-bmi_stage = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-bmi_stage.csv",
-    system="snomed",
-    column="code",
-)
-
-# Severe Obesity code recorded
-sev_obesity = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-sev_obesity.csv",
-    system="snomed",
-    column="code",
-)
-
-# Diabetes resolved codes
-dmres = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-dmres.csv",
-    system="snomed",
-    column="code",
-)
-
-# Severe Mental Illness codes
-sev_mental = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-sev_mental.csv",
-    system="snomed",
-    column="code",
-)
-
-# Remission codes relating to Severe Mental Illness
-smhres = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-smhres.csv",
-    system="snomed",
-    column="code",
-)
-
-# High Risk from COVID-19 code
-shield = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-shield.csv",
-    system="snomed",
-    column="code",
-)
-
-# Lower Risk from COVID-19 codes
-nonshield = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-nonshield.csv",
-    system="snomed",
-    column="code",
-)
-
-# to represent household contact of shielding individual
-hhld_imdef = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-hhld_imdef.csv",
-    system="snomed",
-    column="code",
-)
-
-# Wider Learning Disability
-learndis = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-learndis.csv",
-    system="snomed",
-    column="code",
-)
-
-# Carer codes
-carer = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-carer.csv",
-    system="snomed",
-    column="code",
-)
-
-# No longer a carer codes
-notcarer = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-notcarer.csv",
-    system="snomed",
-    column="code",
-)
-
-# Employed by Care Home codes
-carehome = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-carehome.csv",
-    system="snomed",
-    column="code",
-)
-
-# Employed by nursing home codes
-nursehome = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-nursehome.csv",
-    system="snomed",
-    column="code",
-)
-
-# Employed by domiciliary care provider codes
-domcare = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-domcare.csv",
-    system="snomed",
-    column="code",
-)
-
-# Patients in long-stay nursing and residential care
-longres = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-longres.csv",
-    system="snomed",
-    column="code",
-)
-
-# Ethnicity codes
-eth2001 = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-eth2001.csv",
-    system="snomed",
-    column="code",
-    category_column="grouping_6_id",
-)
-
-# Pregnancy codes recorded in the 8.5 months before the audit run date
-preg = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-preg.csv",
-    system="snomed",
-    column="code",
-)
+def load_all(max_workers=None):
+    # read, verify and parse every codelist up front on a thread pool (see
+    # codelist_loader.py), rather than lazily one at a time
+    from codelist_loader import load_codelists
 
-# Pregnancy or Delivery codes recorded in the 8.5 months before audit run date
-pregdel = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-pregdel.csv",
-    system="snomed",
-    column="code",
-)
-
-# COVID vaccination contraindication codes
-covcontra = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-covcontra.csv",
-    system="snomed",
-    column="code",
-)
+    globals().update(load_codelists(codelist_specs, max_workers=max_workers))
+    return {name: getattr_codelist(name) for name in [*codelist_specs, *combined_codelists]}
 
-# First COVID vaccination declined
-cov1decl = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-cov1decl.csv",
-    system="snomed",
-    column="code",
-)
 
-# Second COVID vaccination declined
-cov2decl = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-cov2decl.csv",
-    system="snomed",
-    column="code",
-)
+category_subsets = {}
 
-## History of covid
-covid_codes = codelist_from_csv(
-  "codelists/opensafely-covid-identification.csv",
-  system = "icd10",
-  column = "icd10_code",
-)
-
-## Smoking
-clear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-clear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
-unclear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-unclear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
-
-## SSRI
-ssri_codes = codelist_from_csv(
-    "codelists/opensafely-selective-serotonin-reuptake-inhibitors-dmd.csv",
-    system="snomed",
-    column="dmd_id",
-)
 
-## DMARD
-dmards_codes = codelist_from_csv(
-    "codelists/opensafely-dmards.csv", 
-    system="snomed", 
-    column="snomed_id",
-)
-
-## hypertension
-hypertension_codes = codelist_from_csv(
-    "codelists/opensafely-hypertension.csv", 
-    system="ctv3",
-    column="CTV3ID",
-)
-
-# drugs for end of life care
-eol_codes = codelist_from_csv(
-    "codelists/nhsd-primary-care-domain-refsets-palcare_cod.csv",
-    system="snomed",
-    column="code",
-)
-midazolam_codes = codelist_from_csv(
-    "codelists/opensafely-midazolam-end-of-life.csv",
-    system="snomed",
-    column="dmd_id",   
-)
-
-# tests for probable COVID
-covid_primary_care_positive_test = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-covid_primary_care_code = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-covid_primary_care_sequalae = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-covid_primary_care_probable_combined=combine_codelists(
-    covid_primary_care_positive_test,
-    covid_primary_care_code,
-    covid_primary_care_sequalae,
-)
\ No newline at end of file
+def filter_by_category(name, include):
+    # memoised filter_codes_by_category on a named categorised codelist (eg
+    # clear_smoking_codes), so each category subset is only built once and is
+    # shared by every variable that uses it
+    key = (name, frozenset(include))
+    if key not in category_subsets:
+        category_subsets[key] = filter_codes_by_category(getattr_codelist(name), include=sorted(key[1]))
+    return category_subsets[key]
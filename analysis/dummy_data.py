@@ -0,0 +1,366 @@
+import argparse
+import collections
+import contextlib
+import copy
+import functools
+import hashlib
+import importlib
+import itertools
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import cohortextractor
+from category_sampling import restore_tables, table_for, tables
+from event_data import EventData
+from local_backend import LocalBackend, column_query_types, nat
+from output_files import StreamingWriter, check_output_path, cohort_file, is_columnar
+
+
+# Dummy data from a study definition's return_expectations
+# Every variable read from the event tables is sampled, a whole column at a
+# time, from its return_expectations merged over the study's
+# default_expectations, as cohortextractor's dummy data generator does:
+# `incidence` (or rate "universal") gives who has a value, dates are drawn
+# uniformly or increasing exponentially towards the end of their range, ints
+# from normal, poisson or UK population age distributions, floats from normal
+# distributions, and categories by their ratios (from the alias tables in
+# category_sampling.py). Unlike cohortextractor, dates are kept within each
+# variable's own `between` window, which may be relative to other variables (as
+# most are to elig_date), and variables computed from other columns
+# (categorised_as, value_from, aggregate_of, fixed_value) are evaluated exactly
+# as the local backend evaluates them, so elig_date follows its rules and only
+# patients in the population are written. Few sampled patients meet a
+# population made of several independent flags (under 1% for this study's),
+# so filtering can be turned off to write every patient generated, as
+# cohortextractor's dummy data does: the population isn't sampled at all and
+# the output is generated about 30 times faster.
+# Patients are generated in fixed size chunks, each written on a background
+# thread while the next is generated, until the output has the requested
+# number of rows. Every variable draws from its own counter-based (Philox)
+# random stream for each block of 50,000 patients, keyed by the seed and the
+# variable's name. Chunks are whole blocks, so they can be generated by any
+# number of processes, and in chunks of any size, and the output is the
+# same; adding or removing a variable leaves the others' values alone:
+#   python analysis/dummy_data.py --output output/input.csv --rows 10000000 --workers 4
+#   python analysis/dummy_data.py --output output/input.csv --rows 10000000 --no-population-filter
+
+# patients per random stream; chunks are made of whole blocks
+stream_block = 50_000
+
+# chunks with nobody in the population before giving up
+max_empty_chunks = 100
+
+empty_values = dict(bool=False, int=0, float=0.0, str="", date=nat)
+
+# expectations for query types whose values can't be sampled from the
+# defaults, for variables that don't give their own
+fallback_expectations = dict(
+    most_recent_bmi={"float": {"distribution": "normal", "mean": 28, "stddev": 6}},
+)
+
+
+def merge(defaults, overrides):
+    # nested dictionaries merged recursively, as cohortextractor merges
+    # return_expectations over default_expectations
+    merged = copy.deepcopy(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict):
+            merged[key] = merge(merged.get(key, {}), value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def expectation_date(value):
+    if value == "today":
+        return np.datetime64("today", "D")
+    return np.datetime64(value, "D")
+
+
+@functools.lru_cache(maxsize=None)
+def population_age_ratios():
+    # ratio of each age from 0 to 109, from the 2018 UK population estimates
+    # in five year bands that cohortextractor ships
+    path = os.path.join(os.path.dirname(cohortextractor.__file__), "uk_population_bands_2018.csv")
+    bands = pd.read_csv(path, thousands=",")
+    ends = bands["band"].str.split("-").str[-1].str.rstrip("+").astype(int).to_numpy()
+    counts = bands["range"].to_numpy(dtype=np.float64)
+    ages = np.arange(110)
+    probabilities = counts[np.minimum(np.searchsorted(ends, ages), len(counts) - 1)] / counts.sum() / 5
+    # whatever doesn't add up goes to the commonest age
+    probabilities[np.argmax(probabilities)] += 1 - probabilities.sum()
+    return dict(zip(ages.tolist(), probabilities.tolist()))
+
+
+def stream_key(seed, name):
+    # the Philox key for a variable's random streams
+    digest = hashlib.sha256(f"{seed}:{name}".encode("utf8")).digest()
+    return np.frombuffer(digest[:16], dtype=np.uint64)
+
+
+def date_range(lo, hi, expected):
+    # the window [lo, hi] (either end None if open) cut to the expected range
+    # of dates; where they don't meet, the window itself, with any open end
+    # as far from the other as the expected range is long
+    earliest = expectation_date(expected.get("earliest", "1900-01-01"))
+    latest = expectation_date(expected.get("latest", "today"))
+    if lo is None and hi is None:
+        return earliest, latest
+    span = latest - earliest
+    lo = hi - span if lo is None else lo
+    hi = lo + span if hi is None else hi
+    cut_lo = np.maximum(lo, earliest)
+    cut_hi = np.minimum(hi, latest)
+    meet = cut_lo <= cut_hi
+    return np.where(meet, cut_lo, lo), np.where(meet, cut_hi, hi)
+
+
+def sample_dates(rng, lo, hi, rate, n):
+    # a date in [lo, hi] for each of n patients, NaT where the range is empty
+    lo = np.broadcast_to(lo, n)
+    hi = np.broadcast_to(hi, n)
+    span = (hi - lo).astype(np.int64)
+    valid = ~np.isnat(lo) & ~np.isnat(hi) & (span >= 0)
+    span = np.where(valid, span, 0)
+    u = rng.random(len(span))
+    if rate == "exponential_increase":
+        # truncated exponential counted back from hi, a tenth of the range
+        # per unit of scale
+        offsets = -0.1 * np.log1p(-u * (1 - math.exp(-10)))
+        dates = hi - np.minimum(np.floor(offsets * (span + 1)), span).astype("timedelta64[D]")
+    else:
+        dates = lo + np.floor(u * (span + 1)).astype("timedelta64[D]")
+    return np.where(valid, dates, nat)
+
+
+def sample_ints(rng, distribution, n):
+    kind = distribution.get("distribution")
+    if kind == "normal":
+        return np.rint(rng.normal(distribution["mean"], distribution["stddev"], n)).astype(np.int64)
+    if kind == "poisson":
+        return rng.poisson(distribution["mean"], n)
+    if kind == "population_ages":
+        return table_for(population_age_ratios()).sample(rng, n).astype(np.int64)
+    raise ValueError(f"Unknown int distribution: {kind}")
+
+
+class DummyBackend(LocalBackend):
+    # patients with sampled rather than extracted values, for every query
+    # type but those computed from other columns
+    def __init__(
+        self, chunk, chunk_size, covariate_definitions, default_expectations, seed=0, filter_population=True, **options
+    ):
+        # patients chunk * chunk_size + 1 onwards
+        if not filter_population:
+            covariate_definitions = {
+                name: definition for name, definition in covariate_definitions.items() if name != "population"
+            }
+        self.seed = seed
+        self.default_expectations = default_expectations or {}
+        # variables whose dates are taken by value_from
+        self.date_sources = {
+            query_args["source"]
+            for query_type, query_args in covariate_definitions.values()
+            if query_type == "value_from" and query_args["returning"] == "date"
+        }
+        patient_ids = np.arange(chunk * chunk_size + 1, (chunk + 1) * chunk_size + 1)
+        super().__init__(EventData.from_patient_ids(patient_ids), covariate_definitions, fuse=False, **options)
+
+    def random(self, name, block):
+        # each variable has its own stream for each block of patients, so its
+        # values don't depend on which other variables there are, the order
+        # they're generated in, how the blocks are grouped into chunks, or
+        # which process generates them
+        return np.random.Generator(np.random.Philox(counter=[0, 0, 0, block], key=stream_key(self.seed, name)))
+
+    def blocks(self):
+        # (block number, rows) for each block with patients here, in order
+        blocks = (self.data.patient_ids - 1) // stream_block
+        starts = np.flatnonzero(np.diff(blocks, prepend=-1))
+        ends = np.append(starts[1:], len(blocks))
+        return [(blocks[start], np.arange(start, end)) for start, end in zip(starts, ends)]
+
+    def evaluate_variable(self, name):
+        query_type, query_args = self.covariate_definitions[name]
+        if query_type in column_query_types or query_type == "all":
+            return super().evaluate_variable(name)
+        return {name: self.sample(name, query_args)}
+
+    def sample(self, name, query_args):
+        # (values, date of each value), so that value_from can take the date
+        query_type = self.covariate_definitions[name][0]
+        expectations = merge(self.default_expectations, fallback_expectations.get(query_type, {}))
+        expectations = merge(expectations, query_args.get("return_expectations") or {})
+        column_type = query_args["column_type"]
+        rate = expectations.get("rate", "exponential_increase")
+        incidence = 1.0 if rate == "universal" else expectations.get("incidence")
+        if incidence is None:
+            raise ValueError(f"No incidence in the expectations for {name}")
+        between = query_args.get("between")
+        with_dates = "date" in expectations and (between or column_type == "date" or name in self.date_sources)
+        window = self.window(between) if with_dates else None
+        sampled = [
+            self.sample_block(self.random(name, block), rows, name, query_args, expectations, incidence, window)
+            for block, rows in self.blocks() or [(0, np.arange(0))]
+        ]
+        return tuple(np.concatenate(columns) for columns in zip(*sampled))
+
+    def sample_block(self, rng, rows, name, query_args, expectations, incidence, window):
+        column_type = query_args["column_type"]
+        rate = expectations.get("rate", "exponential_increase")
+        n = len(rows)
+        present = rng.random(n) < incidence
+        dates = np.full(n, nat)
+        if window is not None:
+            # dates only for the patients with a value
+            with_value = np.flatnonzero(present)
+            lo, hi = window
+            lo = None if lo is None else lo[rows[with_value]]
+            hi = None if hi is None else hi[rows[with_value]]
+            dates[with_value] = sample_dates(rng, *date_range(lo, hi, expectations["date"]), rate, len(with_value))
+            # nothing happened where the window is empty, as it is when it's
+            # relative to a missing date
+            present &= ~np.isnat(dates)
+        if column_type == "date":
+            values = dates
+        elif column_type == "bool":
+            values = present
+        elif "category" in expectations:
+            values = table_for(expectations["category"]["ratios"]).sample(rng, n)
+        elif column_type == "int" and "int" in expectations:
+            values = sample_ints(rng, expectations["int"], n)
+        elif column_type == "float" and "float" in expectations:
+            distribution = expectations["float"]
+            if distribution.get("distribution") != "normal":
+                raise ValueError(f"Unknown float distribution: {distribution.get('distribution')}")
+            values = rng.normal(distribution["mean"], distribution["stddev"], n)
+        elif column_type == "str" and getattr(query_args.get("codelist"), "has_categories", False):
+            # categories from the codelist, equally likely
+            categories = sorted({category for _, category in query_args["codelist"]})
+            values = table_for({category: 1 / len(categories) for category in categories}).sample(rng, n)
+        else:
+            raise ValueError(f"No {column_type} expectations for {name}")
+        if column_type != "date" and column_type != "bool":
+            values = np.where(present, values, empty_values[column_type])
+        return values, dates
+
+
+def compile_tables(covariate_definitions, default_expectations):
+    # every alias table the study's expectations need, compiled up front so
+    # that worker processes are given them rather than compiling their own
+    for query_type, query_args in covariate_definitions.values():
+        if query_type in column_query_types:
+            continue
+        expectations = merge(default_expectations or {}, query_args.get("return_expectations") or {})
+        if "category" in expectations:
+            table_for(expectations["category"]["ratios"])
+        if expectations.get("int", {}).get("distribution") == "population_ages":
+            table_for(population_age_ratios())
+
+
+def generate_chunk(chunk, covariate_definitions, default_expectations, chunk_size, seed, typed, filter_population):
+    backend = DummyBackend(
+        chunk, chunk_size, covariate_definitions, default_expectations, seed, filter_population, staged=True
+    )
+    return backend.to_dataframe(typed=typed)
+
+
+def chunk_frames(chunk_args, workers):
+    # the population in each chunk, in order, generated by `workers`
+    # processes with at most one chunk each waiting to be taken
+    if workers == 1:
+        for chunk in itertools.count():
+            yield generate_chunk(chunk, *chunk_args)
+        return
+    with ProcessPoolExecutor(workers, initializer=restore_tables, initargs=(tables,)) as pool:
+        running = collections.deque()
+        try:
+            for chunk in itertools.count():
+                running.append(pool.submit(generate_chunk, chunk, *chunk_args))
+                if len(running) > workers:
+                    yield running.popleft().result()
+        finally:
+            for future in running:
+                future.cancel()
+
+
+def generate(study, path, rows, chunk_size=250_000, seed=0, partition_by=None, workers=1, filter_population=True):
+    # patients are generated in chunks of chunk_size until there are `rows`
+    # in the population (or just `rows` patients, without filter_population);
+    # the output depends only on the seed, not on chunk_size or the number of
+    # workers. Returns (rows written, patients generated).
+    if rows <= 0:
+        return 0, 0
+    if chunk_size % stream_block:
+        raise ValueError(f"The chunk size must be a multiple of {stream_block}")
+    compile_tables(study.covariate_definitions, study.default_expectations)
+    chunk_args = (
+        study.covariate_definitions, study.default_expectations, chunk_size, seed, is_columnar(path), filter_population
+    )
+    written = 0
+    chunks = 0
+    with StreamingWriter(path, partition_by) as writer, contextlib.closing(chunk_frames(chunk_args, workers)) as frames:
+        for frame in frames:
+            chunks += 1
+            frame = frame.iloc[: rows - written]
+            # chunks with nobody in the population are skipped, as skip_empty does
+            if len(frame):
+                writer.write(frame)
+                written += len(frame)
+            elif not written and chunks == max_empty_chunks:
+                # chunks are generated until enough patients are in the
+                # population, which would never end if nobody can be
+                raise ValueError(f"None of the first {chunks * chunk_size} patients were in the population")
+            if written == rows:
+                break
+    return written, chunks * chunk_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate dummy data for a study from its return_expectations")
+    parser.add_argument("--study", default="study_definition", help="study definition module")
+    parser.add_argument("--output", default=cohort_file, help="csv, csv.gz, feather or parquet file to write")
+    parser.add_argument("--rows", type=int, default=100_000, help="number of patients in the population to write")
+    parser.add_argument("--chunk-size", type=int, default=250_000, help="patients to generate at a time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="number of processes to generate chunks in")
+    parser.add_argument("--partition-by", help="write one output file per value of this variable")
+    parser.add_argument(
+        "--no-population-filter",
+        dest="filter_population",
+        action="store_false",
+        help="write every patient generated, as cohortextractor does, rather than only those in the population",
+    )
+    args = parser.parse_args()
+    check_output_path(args.output)
+    study = importlib.import_module(args.study).study
+    start = time.perf_counter()
+    written, generated = generate(
+        study,
+        args.output,
+        args.rows,
+        args.chunk_size,
+        args.seed,
+        args.partition_by,
+        args.workers,
+        args.filter_population,
+    )
+    seconds = time.perf_counter() - start
+    if args.filter_population:
+        print(
+            f"wrote {written} rows from {generated} patients ({written / generated:.2%} in the population) "
+            f"in {seconds:.1f}s",
+            file=sys.stderr,
+        )
+    else:
+        print(f"wrote {written} rows in {seconds:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
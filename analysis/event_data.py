@@ -0,0 +1,245 @@
+import contextlib
+import copy
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from codelist_arrays import interner
+
+
+# In-memory patient event tables for the local backend
+# A directory of csv files, one per table, or a SQLite database of the same
+# tables (standin_database.py) stands in for the TPP tables the study
+# definition queries. Every table is keyed by a `row` column (the patient's
+# position in the sorted patient list) and sorted by row then event date, so
+# each patient's events are contiguous and in date order. Codes are
+# stored as interned int64 ids (see codelist_arrays.py) and dates as
+# datetime64[D], with NaT for missing dates.
+
+# column kinds: "id" (patient_id), "int", "float", "str", "date" or "code"
+tables = dict(
+    patients=dict(patient_id="id", sex="str", date_of_birth="date"),
+    registrations=dict(patient_id="id", practice_id="int", start_date="date", end_date="date"),
+    practices=dict(practice_id="int", nuts1_region_name="str", stp_code="str"),
+    addresses=dict(
+        patient_id="id",
+        start_date="date",
+        end_date="date",
+        index_of_multiple_deprivation="int",
+        rural_urban_classification="int",
+    ),
+    # ctv3 and snomed events share one table; the two code systems can't
+    # collide once interned, as ctv3 codes are never plain integers
+    clinical_events=dict(patient_id="id", code="code", date="date", numeric_value="float"),
+    medications=dict(patient_id="id", code="code", date="date"),
+    vaccinations=dict(patient_id="id", target_disease="str", product_name="str", date="date"),
+    sgss_tests=dict(patient_id="id", specimen_date="date", result="str"),
+    # diagnoses holds every ICD-10 code for the spell, space separated
+    hospital_admissions=dict(
+        patient_id="id",
+        admission_date="date",
+        admission_method="str",
+        patient_classification="str",
+        diagnoses="str",
+    ),
+    ons_deaths=dict(patient_id="id", date="date"),
+    gp_consultations=dict(patient_id="id", date="date"),
+    sus_ethnicity=dict(patient_id="id", code="str"),
+)
+
+# the column each table is ordered by within a patient
+event_date_columns = dict(
+    registrations="start_date",
+    addresses="start_date",
+    clinical_events="date",
+    medications="date",
+    vaccinations="date",
+    sgss_tests="specimen_date",
+    hospital_admissions="admission_date",
+    ons_deaths="date",
+    gp_consultations="date",
+)
+
+# current registrations and addresses are recorded with this end date, as in TPP
+open_end_date = np.datetime64("9999-12-31", "D")
+
+
+def to_dates(values):
+    return pd.to_datetime(pd.Series(values), errors="coerce").to_numpy().astype("datetime64[D]")
+
+
+def column_array(values, kind):
+    if kind in ("id", "int"):
+        return pd.to_numeric(pd.Series(values), errors="coerce").fillna(0).to_numpy(np.int64)
+    if kind == "float":
+        return pd.to_numeric(pd.Series(values), errors="coerce").fillna(0).to_numpy(np.float64)
+    if kind == "date":
+        return to_dates(values)
+    if kind == "code":
+        return interner.encode(pd.Series(values).fillna("").astype(str).str.strip().to_numpy(), add=True)
+    return pd.Series(values).fillna("").astype(str).to_numpy(object)
+
+
+class EventData:
+    def __init__(self, frames):
+        # frames: table name -> DataFrame with (at least) the columns in `tables`
+        patients = frames.get("patients")
+        if patients is None:
+            raise ValueError("event data must include a patients table")
+        patient_ids = column_array(patients["patient_id"], "id")
+        order = np.argsort(patient_ids, kind="stable")
+        self.patient_ids = patient_ids[order]
+        if len(np.unique(self.patient_ids)) != len(self.patient_ids):
+            raise ValueError("patient_id must be unique in the patients table")
+        self.tables = {}
+        self.date_indexes = {}
+        self.label_indexes = {}
+        self.digest = None
+        for name, columns in tables.items():
+            frame = frames.get(name)
+            if frame is None:
+                frame = pd.DataFrame({column: [] for column in columns})
+            self.tables[name] = self.build_table(name, columns, frame)
+
+    @classmethod
+    def from_directory(cls, path):
+        frames = {}
+        for name in tables:
+            filename = os.path.join(path, f"{name}.csv")
+            if os.path.exists(filename):
+                frames[name] = pd.read_csv(filename, dtype=str, keep_default_na=False)
+        return cls(frames)
+
+    @classmethod
+    def from_sqlite(cls, path):
+        # a stand-in database, as standin_database.py writes
+        with contextlib.closing(sqlite3.connect(path)) as connection:
+            return cls({name: pd.read_sql_query(f"SELECT * FROM {name}", connection) for name in tables})
+
+    @classmethod
+    def from_path(cls, path):
+        # a directory of csv files, or a stand-in database
+        if os.path.isdir(path):
+            return cls.from_directory(path)
+        return cls.from_sqlite(path)
+
+    @classmethod
+    def from_patient_ids(cls, patient_ids):
+        # patients with no records of any kind, as for generating dummy data
+        patients = pd.DataFrame(dict(patient_id=patient_ids, sex="", date_of_birth=np.datetime64("NaT", "D")))
+        return cls(dict(patients=patients))
+
+    @property
+    def n_patients(self):
+        return len(self.patient_ids)
+
+    def date_index(self, name, column):
+        # the table's positions in date order, with the sorted dates, so every
+        # event in a fixed date range can be found by binary search
+        if (name, column) not in self.date_indexes:
+            dates = self.tables[name][column]
+            order = np.argsort(dates, kind="stable")
+            self.date_indexes[name, column] = (order, dates[order])
+        return self.date_indexes[name, column]
+
+    def label_index(self, name, column):
+        # the distinct lower-cased values of a text column and each row's
+        # position among them (SQL Server compares strings case-insensitively)
+        if (name, column) not in self.label_indexes:
+            values = pd.Series(self.tables[name][column], dtype=object).str.lower()
+            labels, ids = np.unique(values.to_numpy(str), return_inverse=True)
+            self.label_indexes[name, column] = (labels, ids.reshape(-1))
+        return self.label_indexes[name, column]
+
+    @property
+    def nbytes(self):
+        return self.patient_ids.nbytes + sum(
+            values.nbytes for table in self.tables.values() for values in table.values()
+        )
+
+    def fingerprint(self):
+        # a digest of all the data, to tell whether results computed earlier
+        # came from the same data; codes are hashed as well as their ids, as
+        # ids depend on the order codes were interned in
+        if self.digest is None:
+            digest = hashlib.sha1(self.patient_ids.tobytes())
+            for name, table in sorted(self.tables.items()):
+                for column, values in sorted(table.items()):
+                    digest.update(f"{name}.{column}".encode("utf8"))
+                    if values.dtype == object:
+                        values = pd.util.hash_array(values)
+                    digest.update(np.ascontiguousarray(values).tobytes())
+                    if tables[name].get(column) == "code":
+                        digest.update("\0".join(interner.decode(np.unique(values))).encode("utf8"))
+            self.digest = digest.hexdigest()
+        return self.digest
+
+    def subset(self, rows):
+        # the same data for only the patients at these (sorted) rows; events
+        # keep their order, so the tables stay sorted by row then date
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+            return self.row_range(rows[0], rows[-1] + 1)
+        positions = np.full(self.n_patients, -1, dtype=np.int64)
+        positions[rows] = np.arange(len(rows))
+        subset = copy.copy(self)
+        subset.patient_ids = self.patient_ids[rows]
+        subset.tables = {}
+        subset.date_indexes = {}
+        subset.label_indexes = {}
+        subset.digest = None
+        for name, table in self.tables.items():
+            if "row" not in table:
+                subset.tables[name] = table
+                continue
+            new_rows = positions[table["row"]]
+            known = new_rows >= 0
+            subset.tables[name] = {column: values[known] for column, values in table.items()}
+            subset.tables[name]["row"] = new_rows[known]
+        return subset
+
+    def row_range(self, start, stop):
+        # a subset of consecutive patients is a slice of every table
+        subset = copy.copy(self)
+        subset.patient_ids = self.patient_ids[start:stop]
+        subset.tables = {}
+        subset.date_indexes = {}
+        subset.label_indexes = {}
+        subset.digest = None
+        for name, table in self.tables.items():
+            if "row" not in table:
+                subset.tables[name] = table
+                continue
+            first, last = np.searchsorted(table["row"], [start, stop])
+            subset.tables[name] = {column: values[first:last] for column, values in table.items()}
+            subset.tables[name]["row"] = table["row"][first:last] - start
+        return subset
+
+    def rows_for(self, patient_ids):
+        # positions of these patient_ids in the patient list, -1 if unknown
+        positions = np.searchsorted(self.patient_ids, patient_ids)
+        positions[positions == len(self.patient_ids)] = 0
+        return np.where(self.patient_ids[positions] == patient_ids, positions, -1)
+
+    def build_table(self, name, columns, frame):
+        missing = [column for column in columns if column not in frame.columns]
+        if missing:
+            raise ValueError(f"{name} table is missing columns: {', '.join(missing)}")
+        table = {column: column_array(frame[column].to_numpy(), kind) for column, kind in columns.items()}
+        for column in ("end_date",):
+            if column in table:
+                table[column] = np.where(np.isnat(table[column]), open_end_date, table[column])
+        if "patient_id" not in table:
+            return table
+        rows = self.rows_for(table.pop("patient_id"))
+        known = rows >= 0
+        table = {column: values[known] for column, values in table.items()}
+        table["row"] = rows[known]
+        date_column = event_date_columns.get(name)
+        if date_column:
+            order = np.lexsort((table[date_column], table["row"]))
+        else:
+            order = np.argsort(table["row"], kind="stable")
+        return {column: values[order] for column, values in table.items()}
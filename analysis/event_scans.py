@@ -0,0 +1,337 @@
+import numpy as np
+
+from codelist_arrays import interner, isin_codelist
+
+
+# Per-patient reductions over event tables
+# Every event query comes down to the same steps: find the rows that match
+# (codes, window, and any other filters), then reduce them to one value per
+# patient. Tables from event_data.py are sorted by patient row then date, so
+# each patient's matches are a contiguous run and the first or last match is
+# found by comparing neighbouring rows, with no sorting or grouping needed.
+#
+# An event query is a dict:
+#   name, codes (sorted int64 code ids), window (lo, hi), find_first,
+#   returning, and optionally ignore_missing_values and categories
+#   (a CategoryLookup, for returning="category")
+# where lo and hi are per-patient dates (a datetime64 array or AnchoredDates)
+# or None for an open end. A missing (NaT) bound matches nothing, as a NULL
+# date does in TPP.
+
+# returning values that can be reduced over a series of windows at once
+series_returning = ("binary_flag", "date", "number_of_matches_in_period")
+
+
+class AnchoredDates:
+    # dates for groups of patients sharing an anchor date, rather than one per
+    # patient. Almost every window in the study is relative to elig_date, which
+    # takes only a handful of values, so date arithmetic is done once per group
+    # and each group's window is a fixed date range. Indexing with patient rows
+    # gives per-row dates, so these stand in for per-patient arrays.
+    def __init__(self, groups, values):
+        # groups: group number per patient; values: the date for each group
+        self.groups = groups
+        self.values = values
+
+    @classmethod
+    def from_dates(cls, dates):
+        missing = np.isnat(dates)
+        values = np.unique(dates[~missing])
+        groups = np.searchsorted(values, dates).astype(np.int32)
+        if missing.any():
+            # patients with no anchor date get a group of their own
+            groups[missing] = len(values)
+            values = np.append(values, np.datetime64("NaT"))
+        return cls(groups, values.astype("datetime64[D]"))
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def is_constant(self):
+        return len(self.values) == 1
+
+    def map(self, function):
+        return AnchoredDates(self.groups, function(self.values))
+
+    def regroup(self, groups, n_groups):
+        # a constant date, spread over another grouping of the same patients
+        assert self.is_constant
+        return AnchoredDates(groups, np.repeat(self.values, n_groups))
+
+    def __getitem__(self, rows):
+        return self.values[self.groups[rows]]
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __array__(self, dtype=None, copy=None):
+        dates = self.values[self.groups]
+        return dates if dtype is None else dates.astype(dtype)
+
+
+def window_groups(window):
+    # a window whose bounds are open or anchored on one grouping of patients,
+    # as (groups, lo values, hi values), or None
+    bounds = [bound for bound in window if bound is not None]
+    if not bounds or not all(isinstance(bound, AnchoredDates) for bound in bounds):
+        return None
+    anchored = {id(bound.groups): bound for bound in bounds if not bound.is_constant}
+    if len(anchored) > 1:
+        return None
+    reference = next(iter(anchored.values()), bounds[0])
+    n_groups = len(reference.values)
+
+    def group_values(bound):
+        if bound is None:
+            return None
+        if bound.is_constant and n_groups > 1:
+            bound = bound.regroup(reference.groups, n_groups)
+        return bound.values
+
+    lo, hi = window
+    return reference.groups, group_values(lo), group_values(hi)
+
+
+def positions_in_window(table, window, date_index):
+    # positions (in table order) of events within the window, found by binary
+    # search of a date-sorted index for each group's fixed date range rather
+    # than by comparing every row against per-patient bounds; None if the
+    # window isn't anchored
+    grouped = window_groups(window)
+    if grouped is None:
+        return None
+    groups, lo, hi = grouped
+    n_groups = len(lo if lo is not None else hi)
+    order, sorted_dates = date_index
+    # events with no date sort last and never fall in a bounded window
+    dated = sorted_dates[:len(sorted_dates) - np.isnat(sorted_dates).sum()]
+    pieces = []
+    for group in range(n_groups):
+        start, stop = 0, len(dated)
+        if lo is not None:
+            if np.isnat(lo[group]):
+                continue
+            start = np.searchsorted(dated, lo[group], "left")
+        if hi is not None:
+            if np.isnat(hi[group]):
+                continue
+            stop = np.searchsorted(dated, hi[group], "right")
+        candidates = order[start:stop]
+        if n_groups > 1:
+            candidates = candidates[groups[table["row"][candidates]] == group]
+        pieces.append(candidates)
+    if not pieces:
+        return np.empty(0, dtype=np.int64)
+    return np.sort(np.concatenate(pieces))
+
+
+def in_window(dates, rows, window):
+    lo, hi = window
+    keep = np.ones(len(dates), dtype=bool)
+    if lo is not None:
+        keep &= dates >= lo[rows]
+    if hi is not None:
+        keep &= dates <= hi[rows]
+    return keep
+
+
+def chosen_matches(rows, dates, find_first):
+    # positions of the one match kept for each patient; TPP orders by date
+    # then by event id, so among events on the same day the earliest row in
+    # the table wins whether looking for the first or the last match
+    if not len(rows):
+        return np.empty(0, dtype=np.int64)
+    new_patient = np.r_[True, rows[1:] != rows[:-1]]
+    if find_first:
+        return np.flatnonzero(new_patient)
+    new_day = new_patient | np.r_[True, dates[1:] != dates[:-1]]
+    day_starts = np.flatnonzero(new_day)
+    last_of_patient = np.r_[rows[1:] != rows[:-1], True]
+    return day_starts[np.cumsum(new_day)[last_of_patient] - 1]
+
+
+def reduce_matches(n_patients, rows, dates, returning, find_first, values=None):
+    # rows/dates (and values, for value-returning queries) describe the
+    # matched events only; returns the output column and the date of the
+    # match used for it
+    chosen = chosen_matches(rows, dates, find_first)
+    match_dates = np.full(n_patients, np.datetime64("NaT"), dtype="datetime64[D]")
+    match_dates[rows[chosen]] = dates[chosen]
+    if returning == "date":
+        return match_dates, match_dates
+    if returning == "binary_flag":
+        column = np.zeros(n_patients, dtype=bool)
+        column[rows] = True
+    elif returning == "number_of_matches_in_period":
+        column = np.bincount(rows, minlength=n_patients).astype(np.int64)
+    elif returning == "numeric_value":
+        column = np.zeros(n_patients, dtype=np.float64)
+        column[rows[chosen]] = values[chosen]
+    elif returning in ("code", "category"):
+        column = np.full(n_patients, "", dtype=object)
+        column[rows[chosen]] = values[chosen]
+    else:
+        raise ValueError(f"Unsupported `returning` value: {returning}")
+    return column, match_dates
+
+
+def match_values(table, positions, query):
+    returning = query["returning"]
+    if returning == "numeric_value":
+        return table["numeric_value"][positions]
+    if returning == "code":
+        return np.array(interner.decode(table["code"][positions]), dtype=object)
+    if returning == "category":
+        return query["categories"].categories_for(table["code"][positions])
+    return None
+
+
+def reduce_event_query(table, positions, query, n_patients):
+    # positions: rows of the table whose code is in the query's codelist
+    rows = table["row"][positions]
+    dates = table["date"][positions]
+    keep = in_window(dates, rows, query["window"])
+    if query.get("ignore_missing_values"):
+        keep &= table["numeric_value"][positions] != 0
+    positions = positions[keep]
+    return reduce_matches(
+        n_patients,
+        table["row"][positions],
+        table["date"][positions],
+        query["returning"],
+        query["find_first"],
+        values=match_values(table, positions, query),
+    )
+
+
+def scan_events(table, query, n_patients):
+    # one query, one pass over the table
+    positions = np.flatnonzero(isin_codelist(table["code"], query["codes"]))
+    return reduce_event_query(table, positions, query, n_patients)
+
+
+def window_series(queries):
+    # queries over one codelist whose windows never overlap (such as the three
+    # consecutive monthly astrx windows) can share a single reduction: each
+    # matched event falls into at most one window. Returns the queries in
+    # window order, or None if they can't be treated as a series.
+    if len(queries) < 2:
+        return None
+    for query in queries:
+        if query["returning"] not in series_returning or query.get("ignore_missing_values"):
+            return None
+        if query["window"][0] is None or query["window"][1] is None:
+            return None
+    lo = np.stack([query["window"][0] for query in queries])
+    hi = np.stack([query["window"][1] for query in queries])
+    missing = np.isnat(lo) | np.isnat(hi)
+    # windows anchored on the same date are missing for the same patients
+    if not (missing == missing[0]).all():
+        return None
+    known = ~missing[0]
+    if known.any():
+        order = np.argsort(lo[:, np.argmax(known)], kind="stable")
+        lo, hi = lo[order], hi[order]
+        if not (hi[:-1, known] < lo[1:, known]).all():
+            return None
+        queries = [queries[i] for i in order]
+    return queries
+
+
+def reduce_window_series(table, positions, queries, n_patients):
+    # one pass over the matched rows gives every window's result: each row is
+    # put in the window it falls in, and (patient, window) pairs are reduced
+    # exactly as patients are for a single query. Keys stay sorted because
+    # rows are sorted by patient then date and the windows are in date order.
+    rows = table["row"][positions]
+    dates = table["date"][positions]
+    lo = np.stack([query["window"][0] for query in queries])
+    hi = np.stack([query["window"][1] for query in queries])
+    n_windows = len(queries)
+    window = (lo[:, rows] <= dates).sum(axis=0) - 1
+    keep = window >= 0
+    keep[keep] = dates[keep] <= hi[window[keep], rows[keep]]
+    keys = rows[keep] * n_windows + window[keep]
+    dates = dates[keep]
+    results = {}
+    reductions = {}
+    for i, query in enumerate(queries):
+        kind = (query["returning"], query["find_first"])
+        if kind not in reductions:
+            reductions[kind] = reduce_matches(n_patients * n_windows, keys, dates, *kind)
+        column, match_dates = reductions[kind]
+        results[query["name"]] = (
+            np.ascontiguousarray(column.reshape(n_patients, n_windows)[:, i]),
+            np.ascontiguousarray(match_dates.reshape(n_patients, n_windows)[:, i]),
+        )
+    return results
+
+
+def codelist_groups(queries):
+    # queries grouped by identical codelist contents
+    groups = {}
+    for i, query in enumerate(queries):
+        groups.setdefault(query["codes"].tobytes(), []).append(i)
+    return list(groups.values())
+
+
+def scan_events_fused(table, queries, n_patients):
+    # many queries, one pass over the table: the union of every codelist is
+    # looked up once per event row, giving for each matching row a position in
+    # a membership matrix of (code, codelist) flags. Each query is then reduced
+    # over its own slice of the (much smaller) set of matched rows, and queries
+    # sharing a codelist over consecutive windows are reduced together.
+    if not queries:
+        return {}
+    groups = codelist_groups(queries)
+    codes = np.unique(np.concatenate([query["codes"] for query in queries]))
+    membership = np.zeros((len(codes), len(groups)), dtype=bool)
+    for j, group in enumerate(groups):
+        membership[np.searchsorted(codes, queries[group[0]]["codes"]), j] = True
+    matched = np.flatnonzero(isin_codelist(table["code"], codes))
+    code_positions = np.searchsorted(codes, table["code"][matched])
+    results = {}
+    for j, group in enumerate(groups):
+        positions = matched[membership[code_positions, j]]
+        series = window_series([queries[i] for i in group])
+        if series:
+            results.update(reduce_window_series(table, positions, series, n_patients))
+            continue
+        for i in group:
+            results[queries[i]["name"]] = reduce_event_query(table, positions, queries[i], n_patients)
+    return results
+
+
+def label_matches(label_index, queries, key):
+    # (row, query) flags for whether each row's label is one the query asks
+    # for; a query with no labels for this key matches every row
+    labels, ids = label_index
+    matrix = np.ones((len(labels), len(queries)), dtype=bool)
+    for i, query in enumerate(queries):
+        if query[key] is not None:
+            matrix[:, i] = np.isin(labels, list(query[key]))
+    return matrix[ids]
+
+
+def scan_vaccinations_fused(table, disease_index, product_index, queries, n_patients):
+    # every vaccination record query from one pass: target disease and
+    # product name predicates for all queries are tested together, then each
+    # query is reduced over the records it matched. A vaccination query is a
+    # dict of name, target_diseases and product_names (sets of lower-cased
+    # names, or None for any), window, find_first and returning.
+    if not queries:
+        return {}
+    matches = label_matches(disease_index, queries, "target_diseases")
+    matches &= label_matches(product_index, queries, "product_names")
+    matched = np.flatnonzero(matches.any(axis=1))
+    rows = table["row"][matched]
+    dates = table["date"][matched]
+    results = {}
+    for i, query in enumerate(queries):
+        keep = matches[matched, i] & in_window(dates, rows, query["window"])
+        results[query["name"]] = reduce_matches(
+            n_patients, rows[keep], dates[keep], query["returning"], query["find_first"]
+        )
+    return results
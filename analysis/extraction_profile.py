@@ -0,0 +1,210 @@
+import collections
+import copy
+import json
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+from study_expressions import truthy
+
+
+# Per-variable profile of a local backend run
+# Every task the backend runs (one variable, or a fused scan covering several)
+# is timed, with the peak memory allocated while it ran, the rows of the table
+# it reads, and how many patients end up with a value. Lookups in the
+# backend's caches (resolved dates, anchor groups, date and label indexes,
+# shared subexpressions) are counted against the task making them. A fused
+# task's time, memory and rows scanned are split evenly between its
+# variables, so the table is only counted once per task; each variable keeps
+# the task's totals and the names of the variables it was shared with.
+# A variable read back from a result cache instead is recorded with the time
+# the load took, as a result_cache hit with nothing scanned, and a variable
+# that wasn't cached counts a result_cache miss against its task.
+# Memory is traced with tracemalloc, which slows the run down (pass
+# trace_memory=False to skip it). Its peak is process-wide, so it is only
+# traced while tasks run one at a time: with more than one worker, memory
+# isn't reported and timings include time spent waiting for other tasks.
+
+
+def share(total, n, i):
+    # the i-th of n near-equal integer parts of total
+    return total // n + (i < total % n)
+
+
+def rows_emitted(result):
+    if isinstance(result, tuple):
+        result = result[0]
+    return int(np.count_nonzero(truthy(np.asarray(result))))
+
+
+class ExtractionProfile:
+    def __init__(self, trace_memory=True):
+        self.variables = {}
+        self.local = threading.local()
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.trace_memory = trace_memory
+        # lookups missed before a variable's task ran, by variable
+        self.misses = collections.defaultdict(collections.Counter)
+        # why memory isn't traced, if it isn't
+        self.memory_note = None if trace_memory else "memory tracing was turned off"
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __getstate__(self):
+        # profiles are sent back from shard processes; the per-thread counts
+        # only exist while a task is running
+        state = dict(self.__dict__)
+        del state["local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.started
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def stop_tracing_memory(self, reason):
+        # peaks measured while other tasks run at the same time would be
+        # theirs as much as this task's
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.trace_memory = False
+        self.memory_note = reason
+
+    def lookup(self, cache, hit):
+        counts = getattr(self.local, "counts", None)
+        if counts is not None:
+            counts["cache_hits" if hit else "cache_misses"][cache] += 1
+
+    def missed(self, name, cache):
+        self.misses[name][cache] += 1
+
+    def loaded(self, name, seconds, result, described):
+        # a variable read back from a result cache; memory isn't traced
+        self.add(
+            name,
+            dict(
+                described,
+                seconds=seconds,
+                task_seconds=seconds,
+                rows_scanned=0,
+                task_rows_scanned=0,
+                rows_emitted=rows_emitted(result),
+                shared_with=[],
+                cache_hits={"result_cache": 1},
+                cache_misses={},
+            ),
+        )
+
+    def measure(self, task, describe):
+        # runs task (returning {name: result}); describe(name) gives the
+        # variable's query_type, table and rows_scanned
+        self.local.counts = {"cache_hits": collections.Counter(), "cache_misses": collections.Counter()}
+        if self.trace_memory:
+            memory_before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            results = task()
+        finally:
+            seconds = time.perf_counter() - start
+            memory = max(tracemalloc.get_traced_memory()[1] - memory_before, 0) if self.trace_memory else 0
+            counts, self.local.counts = self.local.counts, None
+        names = list(results)
+        described = {name: describe(name) for name in names}
+        # a fused task reads its table once for all of its variables
+        task_rows_scanned = sum({record["table"]: record["rows_scanned"] for record in described.values()}.values())
+        for i, name in enumerate(names):
+            record = dict(
+                described[name],
+                seconds=seconds / len(names),
+                task_seconds=seconds,
+                rows_scanned=share(task_rows_scanned, len(names), i),
+                task_rows_scanned=task_rows_scanned,
+                rows_emitted=rows_emitted(results[name]),
+                shared_with=[other for other in names if other != name],
+                cache_hits=dict(counts["cache_hits"]),
+                cache_misses=dict(counts["cache_misses"] + self.misses.pop(name, collections.Counter())),
+            )
+            if self.trace_memory:
+                record["peak_memory_bytes"] = memory // len(names)
+            self.add(name, record)
+        return results
+
+    def merge(self, other):
+        # add another run's profile (such as another shard's) to this one
+        for name, record in other.variables.items():
+            self.add(name, record)
+        self.memory_note = self.memory_note or other.memory_note
+
+    def add(self, name, theirs):
+        # a variable measured more than once (in several shards or batches)
+        # adds up its costs
+        if name not in self.variables:
+            self.variables[name] = copy.deepcopy(theirs)
+            return
+        record = self.variables[name]
+        for key in ("seconds", "task_seconds", "rows_scanned", "task_rows_scanned", "rows_emitted"):
+            record[key] += theirs[key]
+        if "peak_memory_bytes" in theirs:
+            record["peak_memory_bytes"] = max(record.get("peak_memory_bytes", 0), theirs["peak_memory_bytes"])
+        for key in ("cache_hits", "cache_misses"):
+            for cache, count in theirs[key].items():
+                record[key][cache] = record[key].get(cache, 0) + count
+
+    def families(self):
+        families = {}
+        for record in self.variables.values():
+            family = families.setdefault(
+                record["query_type"], dict(variables=0, seconds=0.0, rows_scanned=0, rows_emitted=0)
+            )
+            family["variables"] += 1
+            family["seconds"] += record["seconds"]
+            family["rows_scanned"] += record["rows_scanned"]
+            family["rows_emitted"] += record["rows_emitted"]
+        return families
+
+    def report(self):
+        return dict(
+            seconds=self.seconds,
+            memory_traced=self.memory_note is None,
+            memory_note=self.memory_note,
+            variables=self.variables,
+            query_families=self.families(),
+        )
+
+    def summary(self, limit=20):
+        slowest = sorted(self.variables.items(), key=lambda item: item[1]["seconds"], reverse=True)
+        lines = []
+        if self.seconds is not None:
+            lines.append(f"total {self.seconds:.3f}s")
+        if self.memory_note is not None:
+            lines.append(f"memory not traced: {self.memory_note}")
+        lines.append("")
+        lines.append(f"{'variable':<40} {'query type':<46} {'seconds':>8} {'rows scanned':>13} {'rows emitted':>13}")
+        for name, record in slowest[:limit]:
+            lines.append(
+                f"{name:<40} {record['query_type']:<46} {record['seconds']:>8.3f} "
+                f"{record['rows_scanned']:>13} {record['rows_emitted']:>13}"
+            )
+        lines.append("")
+        lines.append(f"{'query type':<46} {'variables':>9} {'seconds':>8} {'rows scanned':>13}")
+        families = sorted(self.families().items(), key=lambda item: item[1]["seconds"], reverse=True)
+        for query_type, family in families:
+            lines.append(
+                f"{query_type:<46} {family['variables']:>9} {family['seconds']:>8.3f} {family['rows_scanned']:>13}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # a json report at path, and the text summary alongside it
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        with open(f"{path.rsplit('.', 1)[0]}.txt", "w") as f:
+            f.write(self.summary())
@@ -0,0 +1,1035 @@
+import argparse
+import contextlib
+import functools
+import importlib
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from codelist_arrays import category_lookup, codelist_array, interner, restore_interner
+from event_data import EventData, to_dates
+from event_scans import (
+    AnchoredDates,
+    in_window,
+    positions_in_window,
+    reduce_matches,
+    scan_events,
+    scan_events_fused,
+    scan_vaccinations_fused,
+)
+from extraction_profile import ExtractionProfile
+from output_files import (
+    StreamingWriter,
+    check_output_path,
+    cohort_file,
+    concat_frames,
+    is_columnar,
+    skip_empty,
+    write_output,
+    write_partitioned,
+)
+from result_cache import ResultCache, result_key
+from study_expressions import ExpressionEvaluator, names_in, parse_expression, truthy
+from variable_keys import dedupe_covariate_definitions
+
+
+# Local backend
+# Evaluates a study definition's covariate_definitions against in-memory event
+# tables (event_data.py) with the same semantics as cohortextractor's TPP
+# backend, one whole column at a time. Variables are evaluated in dependency
+# order; each batch of variables whose inputs are ready is evaluated together,
+# so with fuse=True every with_these_clinical_events (or with_these_medications)
+# variable in a batch is computed from a single pass over its table.
+#
+#   python analysis/local_backend.py --data <dir of csvs> --output output/input.csv
+
+nat = np.datetime64("NaT", "D")
+
+date_ref_pattern = re.compile(
+    r"^(?:(?P<function>[a-z_]+)\(\s*)?(?P<name>\d{4}-\d{2}-\d{2}|[A-Za-z_]\w*)\s*\)?"
+    r"(?:\s*(?P<sign>[+-])\s*(?P<quantity>\d+)\s*(?P<unit>days?|months?|years?))?$"
+)
+
+iso_date_pattern = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# date arguments, other than `between`, which may refer to other variables
+date_arg_names = ("reference_date", "date", "start_date", "end_date")
+
+# query types evaluated from other columns rather than from the event tables;
+# they take column_type (and date_format) themselves
+column_query_types = ("categorised_as", "value_from", "aggregate_of", "fixed_value")
+
+# date columns with at most this many distinct values are treated as anchors:
+# dates relative to them are worked out once per distinct value
+max_anchor_groups = 64
+
+# event queries that can share a single pass over their table
+event_tables = dict(
+    with_these_clinical_events="clinical_events",
+    with_these_medications="medications",
+)
+
+# the table each query type reads, for profiling
+query_tables = dict(
+    event_tables,
+    most_recent_bmi="clinical_events",
+    with_tpp_vaccination_record="vaccinations",
+    with_test_result_in_sgss="sgss_tests",
+    admitted_to_hospital="hospital_admissions",
+    with_gp_consultations="gp_consultations",
+    died_from_any_cause="ons_deaths",
+    sex="patients",
+    age_as_of="patients",
+    registered_as_of="registrations",
+    registered_with_one_practice_between="registrations",
+    date_deregistered_from_all_supported_practices="registrations",
+    address_as_of="addresses",
+    registered_practice_as_of="registrations",
+    with_ethnicity_from_sus="sus_ethnicity",
+)
+
+# memory estimates for batched extraction: copies of a patient's event data
+# held while a batch is evaluated, and bytes per value per variable
+batch_working_copies = 4
+batch_bytes_per_value = 32
+
+# TPP uses -1 for a missing IMD rank, as 0 is a legitimate value
+default_values = dict(index_of_multiple_deprivation=-1)
+
+sus_ethnicity_groups = dict(
+    group_6=dict(
+        A="1", B="1", C="1",
+        D="2", E="2", F="2", G="2",
+        H="3", J="3", K="3", L="3",
+        M="4", N="4", P="4",
+        R="5", S="5",
+    ),
+    group_16=dict(
+        A="1", B="2", C="3", D="4", E="5", F="6", G="7", H="8",
+        J="9", K="10", L="11", M="12", N="13", P="14", R="15", S="16",
+    ),
+)
+
+# CTV3 codes used by the TPP backend for most_recent_bmi
+bmi_codes = ["22K.."]
+weight_codes = ["X76C7", "22A.."]
+height_codes = ["XM01E", "229.."]
+
+
+@functools.lru_cache(maxsize=None)
+def parsed(expression):
+    return parse_expression(expression)
+
+
+def parse_date_ref(date_ref):
+    match = date_ref_pattern.match(date_ref.strip())
+    if not match:
+        raise ValueError(f"Can't parse date expression: {date_ref}")
+    return match
+
+
+def date_ref_variable(date_ref):
+    # the variable a date expression refers to, or None for a literal date
+    name = parse_date_ref(date_ref)["name"]
+    return None if iso_date_pattern.match(name) else name
+
+
+def variable_dependencies(query_type, query_args):
+    names = set()
+    date_refs = [query_args.get(arg) for arg in date_arg_names]
+    date_refs += list(query_args.get("between") or ())
+    for date_ref in date_refs:
+        if isinstance(date_ref, str) and date_ref_variable(date_ref):
+            names.add(date_ref_variable(date_ref))
+    if query_type == "categorised_as":
+        for expression in query_args["category_definitions"].values():
+            if expression != "DEFAULT":
+                names |= names_in(parsed(expression))
+    elif query_type == "value_from":
+        names.add(query_args["source"])
+    elif query_type == "aggregate_of":
+        names.update(query_args["column_names"])
+    return names
+
+
+def required_variables(names, dependencies):
+    # the given variables and everything they depend on, directly or not
+    required = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in required:
+            required.add(name)
+            pending.extend(dependencies[name])
+    return required
+
+
+def add_months(dates, months):
+    # calendar month arithmetic, clamping to the end of shorter months as SQL
+    # Server's DATEADD does
+    missing = np.isnat(dates)
+    dates = np.where(missing, np.datetime64("2000-01-01", "D"), dates)
+    month_starts = dates.astype("datetime64[M]")
+    days = (dates - month_starts.astype("datetime64[D]")).astype(np.int64)
+    target = month_starts + np.asarray(months).astype("timedelta64[M]")
+    month_lengths = ((target + 1).astype("datetime64[D]") - target.astype("datetime64[D]")).astype(np.int64)
+    shifted = target.astype("datetime64[D]") + np.minimum(days, month_lengths - 1).astype("timedelta64[D]")
+    return np.where(missing, nat, shifted)
+
+
+def truncate_dates(dates, date_format):
+    # TPP outputs (and compares) dates as strings cut to date_format
+    if date_format in (None, "YYYY"):
+        return dates.astype("datetime64[Y]").astype("datetime64[D]")
+    if date_format == "YYYY-MM":
+        return dates.astype("datetime64[M]").astype("datetime64[D]")
+    return dates
+
+
+def format_dates(dates, date_format):
+    # dates repeat a lot, so each distinct date is formatted once
+    unit = {None: "Y", "YYYY": "Y", "YYYY-MM": "M"}.get(date_format, "D")
+    distinct, inverse = np.unique(dates.astype(f"datetime64[{unit}]"), return_inverse=True)
+    strings = np.where(np.isnat(distinct), "", np.datetime_as_string(distinct, unit=unit)).astype(object)
+    return strings[inverse]
+
+
+date_functions = dict(
+    first_day_of_month=lambda d: d.astype("datetime64[M]").astype("datetime64[D]"),
+    last_day_of_month=lambda d: (d.astype("datetime64[M]") + 1).astype("datetime64[D]") - 1,
+    first_day_of_year=lambda d: d.astype("datetime64[Y]").astype("datetime64[D]"),
+    last_day_of_year=lambda d: (d.astype("datetime64[Y]") + 1).astype("datetime64[D]") - 1,
+)
+
+
+def apply_to_dates(dates, function):
+    if isinstance(dates, AnchoredDates):
+        return dates.map(function)
+    return function(dates)
+
+
+def as_column_type(values, column_type):
+    values = np.asarray(values)
+    if column_type == "date":
+        if values.dtype.kind == "M":
+            return values.astype("datetime64[D]")
+        return to_dates(values)
+    if column_type == "bool":
+        return values.astype(bool)
+    if column_type == "int":
+        return values.astype(np.int64)
+    if column_type == "float":
+        return values.astype(np.float64)
+    return values.astype(str).astype(object)
+
+
+def round_half_away_from_zero(values, decimals):
+    scale = 10 ** decimals
+    return np.sign(values) * np.floor(np.abs(values) * scale + 0.5) / scale
+
+
+def first_per_patient(rows):
+    # positions of the first entry of each patient in a row-sorted array
+    return np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]]) if len(rows) else np.empty(0, dtype=np.int64)
+
+
+def diagnoses_match(diagnoses, codes):
+    # a code matches any diagnosis in the spell that starts with it
+    if not len(diagnoses):
+        return np.zeros(0, dtype=bool)
+    prefixes = tuple(codes)
+    distinct, inverse = np.unique(diagnoses.astype(str), return_inverse=True)
+    matches = np.array(
+        [
+            any(token.startswith(prefixes) for token in re.split(r"[^A-Za-z0-9]+", value) if token)
+            for value in distinct
+        ],
+        dtype=bool,
+    )
+    return matches[inverse]
+
+
+def lower_set(matches):
+    # names to match, case-insensitively as in SQL Server; None matches anything
+    if not matches:
+        return None
+    return {match.lower() for match in ([matches] if isinstance(matches, str) else matches)}
+
+
+class LocalBackend:
+    def __init__(
+        self, event_data, covariate_definitions, fuse=True, staged=False, workers=1, profile=None, cache=None
+    ):
+        self.data = event_data
+        # each distinct query is evaluated once, and duplicates read its result
+        self.covariate_definitions = dedupe_covariate_definitions(covariate_definitions)
+        self.fuse = fuse
+        self.staged = staged
+        self.workers = workers
+        # an ExtractionProfile to record each variable's costs in, or None
+        self.profile = profile
+        if profile is not None and workers > 1:
+            profile.stop_tracing_memory("tasks overlap with more than one worker")
+        # a ResultCache to reuse results from earlier runs, or None
+        self.cache = cache
+        self.columns = {}
+        self.match_dates = {}
+        self.restrict_to_patients(np.arange(event_data.n_patients))
+
+    @property
+    def n_patients(self):
+        return self.data.n_patients
+
+    def table(self, name):
+        return self.data.tables[name]
+
+    def evaluate(self):
+        if self.columns:
+            return self.columns
+        dependencies = {
+            name: variable_dependencies(query_type, query_args)
+            for name, (query_type, query_args) in self.covariate_definitions.items()
+        }
+        for name, names in dependencies.items():
+            unknown = names - self.covariate_definitions.keys()
+            if unknown:
+                raise ValueError(f"{name} refers to undefined variables: {', '.join(sorted(unknown))}")
+        if self.staged and "population" in self.covariate_definitions:
+            # the population and the variables it depends on are evaluated for
+            # everyone; everything else only for the patients who are in it
+            required = required_variables(["population"], dependencies)
+            self.evaluate_variables([name for name in self.covariate_definitions if name in required], dependencies)
+            self.restrict_to_patients(np.flatnonzero(truthy(self.columns["population"])))
+        pending = [name for name in self.covariate_definitions if name not in self.columns]
+        self.evaluate_variables(pending, dependencies)
+        return self.columns
+
+    def evaluate_variables(self, names, dependencies):
+        # variables are evaluated as soon as everything they depend on is
+        # known; with more than one worker, independent tasks run at the same
+        # time, so a study takes as long as its slowest chain of dependencies
+        # rather than the sum of all its variables. Results are only stored
+        # here, so tasks never see a column before it is complete.
+        pending = dict.fromkeys(names)
+        running = set()
+        with ThreadPoolExecutor(self.workers) if self.workers > 1 else contextlib.nullcontext() as pool:
+            while pending or running:
+                ready = [name for name in pending if dependencies[name].issubset(self.columns)]
+                for name in ready:
+                    del pending[name]
+                uncached = [name for name in ready if not self.load_cached(name)]
+                for task in self.batch_tasks(uncached):
+                    if self.profile is not None:
+                        task = functools.partial(self.profile.measure, task, self.describe_variable)
+                    if pool is None:
+                        self.store_all(task())
+                    else:
+                        running.add(pool.submit(task))
+                if not running:
+                    if pending and not ready:
+                        raise ValueError(f"Circular dependency between variables: {', '.join(pending)}")
+                    continue
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.store_all(future.result())
+
+    def restrict_to_patients(self, rows):
+        # continue with only the patients at these rows: columns evaluated so
+        # far are cut down to them, and everything derived per patient (anchor
+        # groups, shared subexpressions) is worked out afresh
+        if len(rows) != self.n_patients:
+            self.data = self.data.subset(rows)
+            self.columns = {name: column[rows] for name, column in self.columns.items()}
+            self.match_dates = {name: dates[rows] for name, dates in self.match_dates.items()}
+        self.resolved_dates = {}
+        self.anchors = {}
+        self.cache_keys = {}
+        self.single_group = np.zeros(self.n_patients, dtype=np.int32)
+        self.expressions = ExpressionEvaluator(self.visible, self.note_lookup)
+
+    def note_lookup(self, cache, hit):
+        if self.profile is not None:
+            self.profile.lookup(cache, hit)
+
+    def describe_variable(self, name):
+        query_type = self.covariate_definitions[name][0]
+        table = query_tables.get(query_type)
+        rows_scanned = len(self.data.patient_ids) if table == "patients" else 0
+        if table and table != "patients":
+            rows_scanned = len(self.table(table)["row"])
+        return dict(query_type=query_type, table=table, rows_scanned=rows_scanned)
+
+    def batch_tasks(self, names):
+        # the work for a set of variables that are ready to evaluate, as
+        # functions returning {name: result}. A fused scan covers every
+        # variable of its kind; anything else is its own task.
+        tasks = []
+        fused = set()
+        if self.fuse:
+            fused_scans = dict(event_tables, with_tpp_vaccination_record=None)
+            for query_type, table in fused_scans.items():
+                group = [name for name in names if self.covariate_definitions[name][0] == query_type]
+                if group:
+                    tasks.append(functools.partial(self.fused_scan, table, group))
+                    fused.update(group)
+        for name in names:
+            if name not in fused:
+                tasks.append(functools.partial(self.evaluate_variable, name))
+        return tasks
+
+    def fused_scan(self, table, names):
+        # table is None for vaccination records
+        if table is None:
+            return self.scan_vaccinations([self.vaccination_query(name, **self.query_args(name)) for name in names])
+        queries = [self.event_query(name, table, **self.query_args(name)) for name in names]
+        return scan_events_fused(self.table(table), queries, self.n_patients)
+
+    def query_args(self, name):
+        query_type, query_args = self.covariate_definitions[name]
+        query_args = dict(query_args)
+        query_args.pop("return_expectations", None)
+        query_args.pop("hidden", None)
+        if query_type not in column_query_types:
+            query_args.pop("column_type", None)
+            query_args.pop("date_format", None)
+            # the date of each match is always kept
+            query_args.pop("include_date_of_match", None)
+        return query_args
+
+    def evaluate_variable(self, name):
+        query_type = self.covariate_definitions[name][0]
+        method = getattr(self, f"patients_{query_type}", None)
+        if method is None:
+            raise ValueError(f"Query type not supported by the local backend: {query_type}")
+        return {name: method(**self.query_args(name))}
+
+    def store_all(self, results):
+        for name, result in results.items():
+            self.store(name, result)
+            if self.cache is not None:
+                self.cache.save(self.cache_key(name), self.columns[name], self.match_dates.get(name))
+
+    def cache_key(self, name):
+        # covers the variable's definition, everything it depends on, and the
+        # data it is computed from (which changes with the patients evaluated)
+        if name not in self.cache_keys:
+            query_type, query_args = self.covariate_definitions[name]
+            dependency_keys = {
+                dependency: self.cache_key(dependency)
+                for dependency in variable_dependencies(query_type, query_args)
+            }
+            self.cache_keys[name] = result_key(query_type, query_args, dependency_keys, self.data.fingerprint())
+        return self.cache_keys[name]
+
+    def load_cached(self, name):
+        if self.cache is None:
+            return False
+        start = time.perf_counter()
+        cached = self.cache.load(self.cache_key(name))
+        if cached is None:
+            if self.profile is not None:
+                self.profile.missed(name, "result_cache")
+            return False
+        column, match_dates = cached
+        result = column if match_dates is None else (column, match_dates)
+        self.store(name, result)
+        if self.profile is not None:
+            self.profile.loaded(name, time.perf_counter() - start, result, self.describe_variable(name))
+        return True
+
+    def store(self, name, result):
+        if isinstance(result, tuple):
+            result, self.match_dates[name] = result
+        column_type = self.covariate_definitions[name][1]["column_type"]
+        self.columns[name] = as_column_type(result, column_type)
+
+    def date_format(self, name):
+        query_type, query_args = self.covariate_definitions[name]
+        if query_type == "aggregate_of":
+            # aggregates are taken over the already formatted components
+            formats = [self.date_format(column) for column in query_args["column_names"]]
+            return max(formats, key=lambda date_format: len(date_format or ""))
+        return query_args.get("date_format")
+
+    def visible(self, name):
+        # a column as other variables see it, ie with dates cut to date_format
+        values = self.columns[name]
+        if values.dtype.kind == "M":
+            return truncate_dates(values, self.date_format(name))
+        return values
+
+    def anchor_dates(self, name):
+        # a date column with few distinct values (like elig_date) is kept as
+        # AnchoredDates, so anything relative to it is worked out per group
+        self.note_lookup("anchors", name in self.anchors)
+        if name not in self.anchors:
+            dates = self.visible(name)
+            if dates.dtype.kind != "M":
+                raise ValueError(f"{name} is not a date")
+            anchored = AnchoredDates.from_dates(dates)
+            self.anchors[name] = anchored if len(anchored.values) <= max_anchor_groups else dates
+        return self.anchors[name]
+
+    def dates(self, date_ref):
+        # resolve a date expression to per-patient dates
+        if date_ref is None:
+            return None
+        self.note_lookup("dates", date_ref in self.resolved_dates)
+        if date_ref not in self.resolved_dates:
+            match = parse_date_ref(date_ref)
+            name = match["name"]
+            if iso_date_pattern.match(name):
+                dates = AnchoredDates(self.single_group, np.array([name], dtype="datetime64[D]"))
+            else:
+                dates = self.anchor_dates(name)
+            if match["function"]:
+                if match["function"] not in date_functions:
+                    raise ValueError(f"Unknown date function in: {date_ref}")
+                dates = apply_to_dates(dates, date_functions[match["function"]])
+            if match["sign"]:
+                quantity = int(match["quantity"]) * (-1 if match["sign"] == "-" else 1)
+                unit = match["unit"].rstrip("s")
+                if unit == "day":
+                    dates = apply_to_dates(dates, lambda d: d + np.timedelta64(quantity, "D"))
+                else:
+                    months = quantity * (12 if unit == "year" else 1)
+                    dates = apply_to_dates(dates, lambda d: add_months(d, months))
+            self.resolved_dates[date_ref] = dates
+        return self.resolved_dates[date_ref]
+
+    def window(self, between):
+        lo, hi = between or (None, None)
+        return self.dates(lo), self.dates(hi)
+
+    def window_positions(self, name, date_column, between):
+        # positions of a table's events within the window, in table order
+        table = self.table(name)
+        window = self.window(between)
+        self.note_lookup("date_index", (name, date_column) in self.data.date_indexes)
+        positions = positions_in_window(table, window, self.data.date_index(name, date_column))
+        if positions is None:
+            positions = np.flatnonzero(in_window(table[date_column], table["row"], window))
+        return positions
+
+    def any_rows(self, rows):
+        flag = np.zeros(self.n_patients, dtype=bool)
+        flag[rows] = True
+        return flag
+
+    def current_spells(self, table, date):
+        # spells (registrations, addresses) covering date, picking the one with
+        # the latest start date, then the latest end date, as TPP does
+        d = self.dates(date)[table["row"]]
+        positions = np.flatnonzero((table["start_date"] <= d) & (table["end_date"] > d))
+        order = np.lexsort((
+            positions,
+            -table["end_date"][positions].astype(np.int64),
+            -table["start_date"][positions].astype(np.int64),
+            table["row"][positions],
+        ))
+        positions = positions[order]
+        positions = positions[first_per_patient(table["row"][positions])]
+        return table["row"][positions], positions
+
+    # Event queries
+
+    def event_query(
+        self,
+        name,
+        table,
+        codelist,
+        between=None,
+        returning="binary_flag",
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        ignore_missing_values=False,
+        ignore_days_where_these_codes_occur=None,
+        episode_defined_as=None,
+    ):
+        if ignore_days_where_these_codes_occur or episode_defined_as:
+            raise ValueError(
+                "ignore_days_where_these_codes_occur and episode_defined_as are not "
+                "supported by the local backend"
+            )
+        if table == "medications" and returning == "numeric_value":
+            raise ValueError("Unsupported `returning` value: numeric_value")
+        if returning == "category" and not codelist.has_categories:
+            raise ValueError(
+                "Cannot return categories because the supplied codelist does "
+                "not have any categories defined"
+            )
+        return dict(
+            name=name,
+            codes=codelist_array(codelist),
+            window=self.window(between),
+            find_first=bool(find_first_match_in_period),
+            returning=returning,
+            ignore_missing_values=ignore_missing_values,
+            categories=category_lookup(codelist) if returning == "category" else None,
+        )
+
+    def patients_with_these_clinical_events(self, **kwargs):
+        query = self.event_query(None, "clinical_events", **kwargs)
+        return scan_events(self.table("clinical_events"), query, self.n_patients)
+
+    def patients_with_these_medications(self, **kwargs):
+        query = self.event_query(None, "medications", **kwargs)
+        return scan_events(self.table("medications"), query, self.n_patients)
+
+    def patients_most_recent_bmi(self, between=None, minimum_age_at_measurement=16):
+        events = self.table("clinical_events")
+        window = self.window(between)
+
+        def most_recent(codes, window):
+            query = dict(codes=codelist_array(codes), window=window, find_first=False, returning="numeric_value")
+            return scan_events(events, query, self.n_patients)
+
+        # heights may be from before the period, as long as the patient was
+        # old enough when they were measured
+        bmi, bmi_date = most_recent(bmi_codes, window)
+        weight, weight_date = most_recent(weight_codes, window)
+        height, height_date = most_recent(height_codes, (None, window[1]))
+
+        birth_years = self.table("patients")["date_of_birth"].astype("datetime64[Y]").astype(np.int64)
+
+        def old_enough(dates):
+            years = dates.astype("datetime64[Y]").astype(np.int64) - birth_years
+            return ~np.isnat(dates) & (years >= int(minimum_age_at_measurement))
+
+        has_weight_and_height = old_enough(weight_date) & old_enough(height_date)
+        computed = has_weight_and_height & (height != 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            value = np.where(computed, weight / np.square(height), np.where(old_enough(bmi_date), bmi, 0.0))
+        dates = np.where(has_weight_and_height, weight_date, np.where(old_enough(bmi_date), bmi_date, nat))
+        return round_half_away_from_zero(value, 1), dates
+
+    def vaccination_query(
+        self,
+        name,
+        target_disease_matches=None,
+        product_name_matches=None,
+        between=None,
+        returning="binary_flag",
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+    ):
+        if returning not in ("binary_flag", "date"):
+            raise ValueError(f"Unsupported `returning` value: {returning}")
+        return dict(
+            name=name,
+            target_diseases=lower_set(target_disease_matches),
+            product_names=lower_set(product_name_matches),
+            window=self.window(between),
+            find_first=bool(find_first_match_in_period),
+            returning=returning,
+        )
+
+    def scan_vaccinations(self, queries):
+        for column in ("target_disease", "product_name"):
+            self.note_lookup("label_index", ("vaccinations", column) in self.data.label_indexes)
+        return scan_vaccinations_fused(
+            self.table("vaccinations"),
+            self.data.label_index("vaccinations", "target_disease"),
+            self.data.label_index("vaccinations", "product_name"),
+            queries,
+            self.n_patients,
+        )
+
+    def patients_with_tpp_vaccination_record(self, **kwargs):
+        return self.scan_vaccinations([self.vaccination_query(None, **kwargs)])[None]
+
+    def patients_with_test_result_in_sgss(
+        self,
+        pathogen=None,
+        test_result=None,
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        restrict_to_earliest_specimen_date=True,
+        returning="binary_flag",
+    ):
+        assert pathogen == "SARS-CoV-2"
+        if returning not in ("binary_flag", "date", "number_of_matches_in_period"):
+            raise ValueError(f"Unsupported `returning` value: {returning}")
+        if returning == "number_of_matches_in_period" and restrict_to_earliest_specimen_date is not False:
+            raise ValueError("number_of_matches_in_period needs restrict_to_earliest_specimen_date=False")
+        tests = self.table("sgss_tests")
+        if test_result in ("positive", "negative"):
+            keep = tests["result"] == test_result
+        else:
+            keep = np.ones(len(tests["row"]), dtype=bool)
+        if restrict_to_earliest_specimen_date:
+            # TPP keeps each patient's earliest positive and earliest negative
+            # test, so "any" can still match a later test of the other result
+            earliest = np.zeros(len(keep), dtype=bool)
+            for result in ("positive", "negative"):
+                positions = np.flatnonzero(keep & (tests["result"] == result))
+                earliest[positions[first_per_patient(tests["row"][positions])]] = True
+            keep = earliest
+        return self.reduce_table("sgss_tests", "specimen_date", keep, between, returning, find_first_match_in_period)
+
+    def patients_admitted_to_hospital(
+        self,
+        between=None,
+        returning="binary_flag",
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        with_these_diagnoses=None,
+        with_admission_method=None,
+        with_patient_classification=None,
+        **kwargs,
+    ):
+        unsupported = [key for key, value in kwargs.items() if value]
+        if unsupported:
+            raise ValueError(f"Not supported by the local backend: {', '.join(unsupported)}")
+        admissions = self.table("hospital_admissions")
+        keep = np.ones(len(admissions["row"]), dtype=bool)
+        if with_these_diagnoses:
+            keep &= diagnoses_match(admissions["diagnoses"], with_these_diagnoses)
+        if with_admission_method:
+            keep &= np.isin(admissions["admission_method"], list(with_admission_method))
+        if with_patient_classification:
+            keep &= np.isin(admissions["patient_classification"], list(with_patient_classification))
+        if returning == "date_admitted":
+            returning = "date"
+        if returning in ("admission_method", "patient_classification"):
+            positions = self.window_positions("hospital_admissions", "admission_date", between)
+            positions = positions[keep[positions]]
+            return reduce_matches(
+                self.n_patients,
+                admissions["row"][positions],
+                admissions["admission_date"][positions],
+                "code",
+                find_first_match_in_period,
+                values=admissions[returning][positions],
+            )
+        if returning not in ("binary_flag", "date"):
+            raise ValueError(f"Unsupported `returning` value: {returning}")
+        return self.reduce_table("hospital_admissions", "admission_date", keep, between, returning, find_first_match_in_period)
+
+    def patients_with_gp_consultations(
+        self,
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        returning="binary_flag",
+    ):
+        if returning not in ("binary_flag", "date", "number_of_matches_in_period"):
+            raise ValueError(f"Unsupported `returning` value: {returning}")
+        consultations = self.table("gp_consultations")
+        keep = np.ones(len(consultations["row"]), dtype=bool)
+        return self.reduce_table("gp_consultations", "date", keep, between, returning, find_first_match_in_period)
+
+    def patients_died_from_any_cause(self, between=None, returning="binary_flag"):
+        if returning == "date_of_death":
+            returning = "date"
+        if returning not in ("binary_flag", "date"):
+            raise ValueError(f"Unsupported `returning` value: {returning}")
+        deaths = self.table("ons_deaths")
+        keep = np.ones(len(deaths["row"]), dtype=bool)
+        return self.reduce_table("ons_deaths", "date", keep, between, returning, True)
+
+    def reduce_table(self, name, date_column, keep, between, returning, find_first):
+        table = self.table(name)
+        positions = self.window_positions(name, date_column, between)
+        positions = positions[keep[positions]]
+        return reduce_matches(
+            self.n_patients,
+            table["row"][positions],
+            table[date_column][positions],
+            returning,
+            find_first,
+        )
+
+    # Patient and registration queries
+
+    def patients_all(self):
+        return np.ones(self.n_patients, dtype=bool)
+
+    def patients_sex(self):
+        return self.table("patients")["sex"]
+
+    def patients_age_as_of(self, reference_date):
+        # whole years, less one if the birthday hasn't been reached yet
+        reference = np.asarray(self.dates(reference_date))
+        birth_dates = self.table("patients")["date_of_birth"]
+        years = (
+            reference.astype("datetime64[Y]").astype(np.int64)
+            - birth_dates.astype("datetime64[Y]").astype(np.int64)
+        )
+        missing = np.isnat(reference) | np.isnat(birth_dates)
+        years = np.where(missing, 0, years)
+        birthdays = add_months(birth_dates, years * 12)
+        return np.where(missing, 0, np.where(birthdays > reference, years - 1, years))
+
+    def patients_registered_as_of(self, reference_date):
+        return self.patients_registered_with_one_practice_between(reference_date, reference_date)
+
+    def patients_registered_with_one_practice_between(self, start_date, end_date):
+        registrations = self.table("registrations")
+        rows = registrations["row"]
+        covered = (
+            (registrations["start_date"] <= self.dates(start_date)[rows])
+            & (registrations["end_date"] > self.dates(end_date)[rows])
+        )
+        return self.any_rows(rows[covered])
+
+    def patients_date_deregistered_from_all_supported_practices(self, between=None):
+        lo, hi = between or (None, None)
+        registrations = self.table("registrations")
+        order = np.lexsort((registrations["end_date"], registrations["row"]))
+        rows = registrations["row"][order]
+        last = np.r_[rows[1:] != rows[:-1], True] if len(rows) else np.zeros(0, dtype=bool)
+        latest = np.full(self.n_patients, nat)
+        latest[rows[last]] = registrations["end_date"][order][last]
+        # current registrations (ending 9999-12-31) are not deregistrations
+        in_period = (
+            (latest >= np.asarray(self.dates(lo or "1900-01-01")))
+            & (latest <= np.asarray(self.dates(hi or "3000-01-01")))
+        )
+        return np.where(in_period, latest, nat)
+
+    def patients_address_as_of(self, date, returning=None, round_to_nearest=None):
+        if returning not in ("index_of_multiple_deprivation", "rural_urban_classification"):
+            raise ValueError(f"Unsupported `returning` value: {returning}")
+        addresses = self.table("addresses")
+        rows, positions = self.current_spells(addresses, date)
+        values = addresses[returning][positions]
+        if round_to_nearest:
+            values = (round_half_away_from_zero(values / round_to_nearest, 0) * round_to_nearest).astype(np.int64)
+        column = np.full(self.n_patients, default_values.get(returning, 0), dtype=np.int64)
+        column[rows] = values
+        return column
+
+    def patients_registered_practice_as_of(self, date, returning=None):
+        registrations = self.table("registrations")
+        rows, positions = self.current_spells(registrations, date)
+        practice_ids = registrations["practice_id"][positions]
+        if returning == "pseudo_id":
+            column = np.zeros(self.n_patients, dtype=np.int64)
+            column[rows] = practice_ids
+            return column
+        practices = self.table("practices")
+        if returning not in practices or returning == "practice_id":
+            raise ValueError(f"Unsupported `returning` value: {returning}")
+        order = np.argsort(practices["practice_id"], kind="stable")
+        known_ids = practices["practice_id"][order]
+        found = np.searchsorted(known_ids, practice_ids)
+        found[found == len(known_ids)] = 0
+        known = known_ids[found] == practice_ids if len(known_ids) else np.zeros(len(rows), dtype=bool)
+        column = np.full(self.n_patients, "", dtype=object)
+        column[rows[known]] = practices[returning][order][found[known]]
+        return column
+
+    def patients_with_ethnicity_from_sus(self, returning="code", use_most_frequent_code=None):
+        if returning not in ("code", "group_6", "group_16"):
+            raise ValueError(f"Unknown value for 'returning' ({returning})")
+        if not use_most_frequent_code:
+            raise ValueError("use_most_frequent_code must be set to 'True'")
+        sus = self.table("sus_ethnicity")
+        codes = pd.Series(sus["code"], dtype=object).str.strip()
+        keep = (codes != "") & (codes != "99") & ~codes.str.startswith("Z")
+        frame = pd.DataFrame({"row": sus["row"][keep.to_numpy()], "code": codes[keep].to_numpy()})
+        counts = frame.groupby(["row", "code"]).size().reset_index(name="n")
+        counts = counts.sort_values(["row", "n", "code"], ascending=[True, False, True])
+        most_frequent = counts.drop_duplicates("row")
+        values = most_frequent["code"].to_numpy(object)
+        column = np.full(self.n_patients, "" if returning == "code" else "0", dtype=object)
+        if returning != "code":
+            groups = sus_ethnicity_groups[returning]
+            values = np.array([groups.get(code[:1], "0") for code in values], dtype=object)
+        column[most_frequent["row"].to_numpy()] = values
+        return column
+
+    # Queries over other columns
+
+    def patients_categorised_as(self, category_definitions, column_type, date_format=None):
+        defaults = [category for category, expression in category_definitions.items() if expression == "DEFAULT"]
+        if len(defaults) != 1:
+            raise ValueError("Exactly one category must be given the definition 'DEFAULT'")
+        categories = [category for category, expression in category_definitions.items() if expression != "DEFAULT"]
+        nodes = [parsed(category_definitions[category]) for category in categories]
+        # categories are tested in order and the first one matching wins
+        chosen = np.broadcast_to(self.expressions.select(nodes), (self.n_patients,))
+        labels = np.array(defaults + categories, dtype=object)
+        return as_column_type(labels[chosen], column_type)
+
+    def patients_value_from(self, source, returning, column_type, date_format=None):
+        values = self.columns[source]
+        if returning == "date" and values.dtype.kind != "M":
+            values = self.match_dates[source]
+        return as_column_type(values, column_type)
+
+    def patients_aggregate_of(self, column_names, aggregate_function, column_type):
+        # empty values are ignored, as NULLs are by SQL's MIN and MAX
+        assert aggregate_function in ("MIN", "MAX")
+        values = [self.visible(name) for name in column_names]
+        if column_type == "date":
+            combine = np.fmin if aggregate_function == "MIN" else np.fmax
+            return functools.reduce(combine, [as_column_type(v, "date") for v in values])
+        stacked = np.vstack([np.asarray(v, dtype=np.float64) for v in values])
+        stacked[stacked == 0] = np.nan
+        combine = np.fmin if aggregate_function == "MIN" else np.fmax
+        combined = combine.reduce(stacked, axis=0)
+        return as_column_type(np.nan_to_num(combined, nan=0.0), column_type)
+
+    def patients_fixed_value(self, value, column_type, date_format=None):
+        return as_column_type(np.full(self.n_patients, value, dtype=object), column_type)
+
+    # Output
+
+    def output_column(self, name):
+        values = self.columns[name]
+        column_type = self.covariate_definitions[name][1]["column_type"]
+        if column_type == "date":
+            return format_dates(values, self.date_format(name))
+        if column_type == "bool":
+            return values.astype(np.int64)
+        return values
+
+    def typed_column(self, name, rows):
+        # the output column with its real type, for columnar formats: dates
+        # cut to their date_format, and text as categories
+        values = self.columns[name][rows]
+        column_type = self.covariate_definitions[name][1]["column_type"]
+        if column_type == "date":
+            return truncate_dates(values, self.date_format(name))
+        if column_type == "str":
+            return pd.Categorical(values)
+        return values
+
+    def to_dataframe(self, typed=False):
+        columns = self.evaluate()
+        if "population" in columns:
+            keep = truthy(columns["population"])
+        else:
+            keep = np.ones(self.n_patients, dtype=bool)
+        frame = {"patient_id": self.data.patient_ids[keep]}
+        for name, (_, query_args) in self.covariate_definitions.items():
+            if name == "population" or query_args.get("hidden"):
+                continue
+            frame[name] = self.typed_column(name, keep) if typed else self.output_column(name)[keep]
+        return pd.DataFrame(frame)
+
+    def to_file(self, path, partition_by=None):
+        check_output_path(path)
+        frame = self.to_dataframe(typed=is_columnar(path))
+        if partition_by:
+            write_partitioned(frame, path, partition_by)
+        else:
+            write_output(frame, path)
+
+
+def shard_rows(n_patients, shards):
+    # contiguous ranges of the patient list, which is sorted by patient_id, so
+    # the shards' outputs only need putting end to end
+    return np.array_split(np.arange(n_patients), shards)
+
+
+def batch_size_for(event_data, n_variables, memory_budget):
+    # patients per batch to stay within memory_budget bytes, roughly: a batch
+    # holds several working copies of its share of the event data (matched
+    # rows, sort orders, date indexes) and a few values per variable for
+    # each patient
+    per_patient = event_data.nbytes / max(event_data.n_patients, 1) * batch_working_copies
+    per_patient += n_variables * batch_bytes_per_value
+    return max(int(memory_budget // per_patient), 1)
+
+
+def extract_streaming(event_data, covariate_definitions, path, batch_size, partition_by=None, **options):
+    # patients are extracted in batches of consecutive patient_ids and each
+    # batch is written while the next is extracted, giving the same output
+    # as extracting everyone at once. A profile adds up every batch's costs.
+    typed = is_columnar(path)
+    n_batches = max(-(-event_data.n_patients // batch_size), 1)
+    frames = (
+        LocalBackend(event_data.subset(rows), covariate_definitions, **options).to_dataframe(typed=typed)
+        for rows in shard_rows(event_data.n_patients, n_batches)
+    )
+    with StreamingWriter(path, partition_by) as writer:
+        for frame in skip_empty(frames):
+            writer.write(frame)
+
+
+def extract_shard(event_data, covariate_definitions, options, profiled, typed):
+    profile = ExtractionProfile() if profiled else None
+    frame = LocalBackend(event_data, covariate_definitions, profile=profile, **options).to_dataframe(typed=typed)
+    if profile is not None:
+        profile.finish()
+    return frame, profile
+
+
+def extract_sharded(event_data, covariate_definitions, shards, profile=None, typed=False, **options):
+    # every variable is a function of one patient's records, so each shard of
+    # patients can be extracted in its own process and the results joined
+    # into exactly what a single process would give. A profile collects
+    # every shard's costs.
+    with ProcessPoolExecutor(shards, initializer=restore_interner, initargs=(interner.codes,)) as pool:
+        futures = [
+            pool.submit(
+                extract_shard, event_data.subset(rows), covariate_definitions, options, profile is not None, typed
+            )
+            for rows in shard_rows(event_data.n_patients, shards)
+        ]
+        frames = []
+        for future in futures:
+            frame, shard_profile = future.result()
+            frames.append(frame)
+            if profile is not None:
+                profile.merge(shard_profile)
+    return concat_frames(skip_empty(frames))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a study definition against local event data")
+    parser.add_argument("--study", default="study_definition", help="study definition module")
+    parser.add_argument(
+        "--data", required=True, help="directory of event data csv files, or a stand-in SQLite database"
+    )
+    parser.add_argument("--output", default=cohort_file, help="csv, csv.gz, feather or parquet file to write")
+    parser.add_argument("--no-fuse", action="store_true", help="scan the events table once per variable")
+    parser.add_argument(
+        "--staged", action="store_true", help="find the population first, then extract other variables only for it"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="number of variables to evaluate at once")
+    parser.add_argument("--shards", type=int, default=1, help="number of processes to split patients between")
+    parser.add_argument("--partition-by", help="write one output file per value of this variable")
+    parser.add_argument("--batch-size", type=int, help="extract and write this many patients at a time")
+    parser.add_argument(
+        "--memory-budget", type=float, help="extract and write patients in batches sized to fit this many MiB"
+    )
+    parser.add_argument("--cache-dir", help="reuse results of unchanged variables from earlier runs kept here")
+    parser.add_argument("--profile", help="write a json profile of each variable's costs to this file")
+    args = parser.parse_args()
+    study = importlib.import_module(args.study).study
+    event_data = EventData.from_path(args.data)
+    profile = ExtractionProfile() if args.profile else None
+    cache = ResultCache(args.cache_dir) if args.cache_dir else None
+    options = dict(fuse=not args.no_fuse, staged=args.staged, workers=args.workers, profile=profile, cache=cache)
+    check_output_path(args.output)
+    batch_size = args.batch_size
+    if args.memory_budget:
+        batch_size = batch_size_for(event_data, len(study.covariate_definitions), args.memory_budget * 2 ** 20)
+    if batch_size and args.shards > 1:
+        parser.error("batched output can't be combined with --shards")
+    if batch_size:
+        extract_streaming(event_data, study.covariate_definitions, args.output, batch_size, args.partition_by, **options)
+    elif args.shards > 1:
+        typed = is_columnar(args.output)
+        frame = extract_sharded(event_data, study.covariate_definitions, args.shards, typed=typed, **options)
+        if args.partition_by:
+            write_partitioned(frame, args.output, args.partition_by)
+        else:
+            write_output(frame, args.output)
+    else:
+        LocalBackend(event_data, study.covariate_definitions, **options).to_file(args.output, args.partition_by)
+    if profile is not None:
+        profile.finish()
+        profile.write(args.profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import os
+import queue
+import re
+import threading
+
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Writing extracted cohorts
+# The format is chosen by the file extension: csv (optionally gzipped), as
+# cohortextractor writes, feather or parquet. Both keep each column's real
+# type (dates, integers, booleans, and text as dictionary-encoded categories),
+# so downstream steps can read just the columns they need without parsing
+# text; feather is what cohortextractor writes with --output-format feather,
+# and parquet adds min/max/null statistics in the footer. pyarrow is only
+# needed for these two.
+# Output can also be partitioned on a variable, one file per value, so that a
+# step working on one group reads only that group: partitioning
+# output/input.csv on elig_date writes output/input_elig_date_2020-12-08.csv
+# and so on. This is for local runs of the local backend and dummy data; the
+# actions in project.yaml still read the whole output/input.csv.
+# StreamingWriter appends batches of patients to the output as they are
+# extracted, so the whole cohort never has to be held at once.
+
+# the extract that project.yaml's study_definition action writes and
+# 01_data_process.R reads, so the default for local extracts and dummy data
+cohort_file = "output/input.csv"
+
+csv_extensions = (".csv", ".csv.gz")
+columnar_extensions = (".parquet", ".feather")
+
+
+def is_columnar(path):
+    return path.endswith(columnar_extensions)
+
+
+def check_output_path(path):
+    if not path.endswith(csv_extensions + columnar_extensions):
+        extensions = ", ".join(csv_extensions + columnar_extensions)
+        raise ValueError(f"Output file must have one of these extensions: {extensions}")
+    if is_columnar(path) and pyarrow is None:
+        raise ImportError(f"pyarrow is needed to write {path}")
+
+
+def arrow_table(frame):
+    # typed columns from LocalBackend.to_dataframe(typed=True); pandas holds
+    # dates as timestamps, which are stored as plain dates. Categories always
+    # get 32 bit indices, so batches with different numbers of categories
+    # share a schema.
+    table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pyarrow.types.is_timestamp(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pyarrow.date32()))
+        elif pyarrow.types.is_dictionary(field.type):
+            dictionary = pyarrow.dictionary(pyarrow.int32(), field.type.value_type)
+            table = table.set_column(i, field.name, table.column(i).cast(dictionary))
+    return table
+
+
+def columnar_writer(path, schema):
+    # feather (version 2) is the arrow ipc file format, so like parquet it can
+    # be written a batch at a time; zstd as cohortextractor uses
+    if path.endswith(".feather"):
+        options = pyarrow.ipc.IpcWriteOptions(compression="zstd", emit_dictionary_deltas=True)
+        return pyarrow.ipc.new_file(path, schema, options=options)
+    return pyarrow.parquet.ParquetWriter(path, schema, write_statistics=True)
+
+
+def make_directory(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+def write_output(frame, path):
+    check_output_path(path)
+    make_directory(path)
+    if is_columnar(path):
+        table = arrow_table(frame)
+        with columnar_writer(path, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        frame.to_csv(path, index=False)
+
+
+def split_extension(path):
+    for extension in csv_extensions[::-1] + columnar_extensions:
+        if path.endswith(extension):
+            return path[: -len(extension)], extension
+    return os.path.splitext(path)
+
+
+def partition_label(value):
+    if pd.isna(value):
+        return "missing"
+    if isinstance(value, pd.Timestamp):
+        value = value.date().isoformat()
+    return re.sub(r"[^\w.-]", "_", str(value)) or "missing"
+
+
+def partition_path(path, variable, value):
+    stem, extension = split_extension(path)
+    return f"{stem}_{variable}_{partition_label(value)}{extension}"
+
+
+def write_partitioned(frame, path, variable):
+    # one file per value of variable (missing values together), with rows in
+    # the same order as they are in frame; returns the paths written
+    if variable not in frame.columns:
+        raise ValueError(f"Can't partition output on {variable}: it isn't an output column")
+    check_output_path(path)
+    paths = []
+    for value, part in frame.groupby(variable, sort=True, dropna=False, observed=True):
+        paths.append(partition_path(path, variable, value))
+        write_output(part.reset_index(drop=True), paths[-1])
+    return paths
+
+
+def skip_empty(frames):
+    # the frames that have rows, or just the first if none do. A frame with no
+    # rows has no values to type its columns by (an empty text column isn't a
+    # category), so writing or joining it alongside the others would change
+    # their types; the first is kept only so that the output has its columns.
+    empty = None
+    written = False
+    for frame in frames:
+        if len(frame):
+            written = True
+            yield frame
+        elif empty is None:
+            empty = frame
+    if not written and empty is not None:
+        yield empty
+
+
+def concat_frames(frames):
+    # join frames of the same columns in order; categories are merged rather
+    # than falling back to text
+    frames = list(frames)
+    joined = pd.concat(frames, ignore_index=True)
+    for name, values in frames[0].items():
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            joined[name] = pd.api.types.union_categoricals(
+                [frame[name] for frame in frames], sort_categories=True, ignore_order=True
+            )
+    return joined
+
+
+class StreamingWriter:
+    # appends frames of consecutive patients to the output (or its
+    # partitions) on a background thread, so one batch is written while the
+    # next is extracted. At most `queued` frames wait to be written; write()
+    # blocks until there is room, which bounds the memory held for output.
+    def __init__(self, path, partition_by=None, queued=1):
+        check_output_path(path)
+        self.path = path
+        self.partition_by = partition_by
+        self.queue = queue.Queue(maxsize=queued)
+        self.columnar_writers = {}
+        # path -> column -> categories written so far, for feather
+        self.categories = {}
+        self.started = set()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(frame)
+
+    def run(self):
+        # after an error, frames are still taken from the queue (and dropped)
+        # so that write() never blocks; the error is raised in the caller
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            if self.error is None:
+                try:
+                    self.write_frame(frame)
+                except Exception as error:
+                    self.error = error
+
+    def write_frame(self, frame):
+        if not self.partition_by:
+            self.append(frame, self.path)
+            return
+        if self.partition_by not in frame.columns:
+            raise ValueError(f"Can't partition output on {self.partition_by}: it isn't an output column")
+        for value, part in frame.groupby(self.partition_by, sort=True, dropna=False, observed=True):
+            self.append(part.reset_index(drop=True), partition_path(self.path, self.partition_by, value))
+
+    def extend_categories(self, frame, path):
+        # a feather file has one dictionary per column, which later batches
+        # can only add to: each batch's new categories go after those already
+        # written, so its dictionary extends theirs
+        written = self.categories.setdefault(path, {})
+        extended = {}
+        for name, values in frame.items():
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                categories = written.setdefault(name, [])
+                known = set(categories)
+                categories.extend(category for category in values.cat.categories if category not in known)
+                extended[name] = values.cat.set_categories(categories)
+        return frame.assign(**extended)
+
+    def append(self, frame, path):
+        if is_columnar(path):
+            if path.endswith(".feather"):
+                frame = self.extend_categories(frame, path)
+            table = arrow_table(frame)
+            if path not in self.columnar_writers:
+                make_directory(path)
+                self.columnar_writers[path] = columnar_writer(path, table.schema)
+            self.columnar_writers[path].write_table(table)
+        else:
+            first = path not in self.started
+            if first:
+                make_directory(path)
+            frame.to_csv(path, index=False, header=first, mode="w" if first else "a")
+        self.started.add(path)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        for writer in self.columnar_writers.values():
+            writer.close()
+        if self.error is not None:
+            raise self.error
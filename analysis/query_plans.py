@@ -0,0 +1,379 @@
+import argparse
+import collections
+import contextlib
+import hashlib
+import importlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+import numpy as np
+
+from cohortextractor.tpp_backend import TPPBackend
+from local_backend import (
+    add_months,
+    bmi_codes,
+    column_query_types,
+    date_functions,
+    event_tables,
+    height_codes,
+    iso_date_pattern,
+    parse_date_ref,
+    query_tables,
+    weight_codes,
+)
+
+
+# Per-variable query plans
+# For every variable in a study definition this writes out the SQL the TPP
+# backend generates for it, and the plan SQLite chooses for the same query
+# over a stand-in database (standin_database.py). The generated SQL is SQL
+# Server's dialect (temporary tables, SELECT INTO, DATEADD) and can't be run
+# or explained anywhere else, so each query type also has a translation over
+# the stand-in's tables with the same filters (codes, window, returning),
+# which is explained and timed. Dates relative to other variables, such as
+# elig_date, are taken relative to an anchor date so windows keep their width.
+# Each variable is flagged for:
+#   - full scans of an event table, and the table's indexes on the columns it
+#     filters (codes, dates) that the scan doesn't use,
+#   - indexes read end to end whose leading column isn't patient_id; reading
+#     the (patient_id, ...) index in order is how every per-patient query
+#     groups its events, so that isn't flagged,
+#   - statements or subqueries in its generated SQL that are identical to
+#     another variable's (such as the same codelist uploaded twice), which
+#     the server runs once for each.
+#   python analysis/query_plans.py --database output/standin.sqlite --output output/query_plans.json
+
+# tables read whole by design, one row per patient
+whole_tables = {"patients"}
+
+# generated statements every variable has, once names are normalised
+trivial_statement = re.compile(r"^\s*(CREATE CLUSTERED INDEX|CREATE TABLE|-- Uploading codelist)", re.IGNORECASE)
+
+
+def generated_sql(covariate_definitions):
+    # name -> the statements the TPP backend runs to compute that variable;
+    # variables without any (those computed in the final query from other
+    # columns) are left out, as is the final query itself
+    backend = TPPBackend("mssql://localhost/dummy", covariate_definitions, dummy_data=True)
+    statements = {}
+    pending = []
+    for query in backend.queries:
+        pending.append(query)
+        match = re.match(r"\s*CREATE CLUSTERED INDEX patient_id_ix ON #(\w+) \(patient_id\)", query)
+        if match:
+            statements[match[1]] = pending
+            pending = []
+    return statements
+
+
+def codelist_names(queries):
+    # each uploaded codelist's temporary table -> a name from its contents
+    uploads = collections.defaultdict(list)
+    for query in queries:
+        match = re.match(r"\s*INSERT INTO \[(#tmp\d+_\w+_codelist)\][^\n]*VALUES(.*)", query, re.DOTALL)
+        if match:
+            uploads[match[1]].append(match[2])
+    return {
+        table: "#codelist_" + hashlib.sha1("".join(values).encode("utf8")).hexdigest()[:12]
+        for table, values in uploads.items()
+    }
+
+
+def normalised(sql, name, codelists):
+    # the same statement for another variable reads the same once its own
+    # temporary tables are named by what they hold
+    sql = re.sub(r"#tmp\d+_\w+?_codelist\b", lambda match: codelists.get(match[0], match[0]), sql)
+    sql = re.sub(rf"#{re.escape(name)}\b", "#variable", sql)
+    sql = re.sub(r"-- Query for \w+", "", sql)
+    return " ".join(sql.split())
+
+
+def subqueries(sql):
+    # every bracketed SELECT, innermost ones included
+    found = []
+    for match in re.finditer(r"\(\s*SELECT\b", sql, re.IGNORECASE):
+        depth = 0
+        for end in range(match.start(), len(sql)):
+            depth += {"(": 1, ")": -1}.get(sql[end], 0)
+            if depth == 0:
+                found.append(sql[match.start() : end + 1])
+                break
+    return found
+
+
+def repeated_fragments(statements):
+    # name -> {other variable: number of identical statements and subqueries}
+    owners = collections.defaultdict(set)
+    for name, queries in statements.items():
+        codelists = codelist_names(queries)
+        for query in queries:
+            query = normalised(query, name, codelists)
+            if trivial_statement.match(query):
+                continue
+            for fragment in [query] + subqueries(query):
+                owners[fragment].add(name)
+    shared = {name: collections.Counter() for name in statements}
+    for names in owners.values():
+        for name in names:
+            for other in names - {name}:
+                shared[name][other] += 1
+    return shared
+
+
+def resolve_date(date_ref, anchor):
+    # an ISO date for a date expression, with anything relative to another
+    # variable taken relative to anchor
+    match = parse_date_ref(date_ref)
+    name = match["name"]
+    date = np.datetime64(name if iso_date_pattern.match(name) else anchor, "D")
+    if match["function"]:
+        date = date_functions[match["function"]](date)
+    if match["sign"]:
+        quantity = int(match["quantity"]) * (-1 if match["sign"] == "-" else 1)
+        unit = match["unit"].rstrip("s")
+        if unit == "day":
+            date = date + np.timedelta64(quantity, "D")
+        else:
+            date = add_months(np.array([date]), quantity * (12 if unit == "year" else 1))[0]
+    return str(date)
+
+
+def quoted(values):
+    return ", ".join("'" + str(value).replace("'", "''") + "'" for value in values)
+
+
+def codes_of(codelist):
+    if codelist.has_categories:
+        return [code for code, _ in codelist]
+    return list(codelist)
+
+
+def standin_query(query_type, query_args, anchor):
+    # (sql, parameters) over the stand-in tables, doing what query_type does,
+    # or None for variables computed from other columns
+    if query_type in column_query_types or query_type == "all":
+        return None
+    returning = query_args.get("returning", "binary_flag")
+    conditions = []
+    parameters = []
+
+    def window(column, between):
+        lo, hi = between or (None, None)
+        if lo:
+            conditions.append(f"{column} >= ?")
+            parameters.append(resolve_date(lo, anchor))
+        if hi:
+            conditions.append(f"{column} <= ?")
+            parameters.append(resolve_date(hi, anchor))
+
+    def covering(date):
+        # spells covering date; open spells have no end date
+        conditions.append("start_date <= ? AND (end_date IS NULL OR end_date > ?)")
+        parameters.extend([resolve_date(date, anchor)] * 2)
+
+    table = query_tables.get(query_type)
+    date_column = dict(sgss_tests="specimen_date", hospital_admissions="admission_date").get(table, "date")
+    if query_type in event_tables:
+        conditions.append(f"code IN ({quoted(codes_of(query_args['codelist']))})")
+    elif query_type == "most_recent_bmi":
+        conditions.append(f"code IN ({quoted(bmi_codes + weight_codes + height_codes)})")
+        returning = "numeric_value"
+    elif query_type == "with_tpp_vaccination_record":
+        for column in ("target_disease", "product_name"):
+            matches = query_args.get(f"{column}_matches")
+            if matches:
+                matches = [matches] if isinstance(matches, str) else matches
+                conditions.append(f"{column} IN ({quoted(matches)}) COLLATE NOCASE")
+    elif query_type == "with_test_result_in_sgss":
+        if query_args.get("test_result") in ("positive", "negative"):
+            conditions.append(f"result = {quoted([query_args['test_result']])}")
+    elif query_type == "admitted_to_hospital":
+        for column in ("admission_method", "patient_classification"):
+            matches = query_args.get(f"with_{column}")
+            if matches:
+                conditions.append(f"{column} IN ({quoted(matches)})")
+        if query_args.get("with_these_diagnoses"):
+            codes = codes_of(query_args["with_these_diagnoses"])
+            # any diagnosis in the spell starting with the code
+            patterns = [pattern for code in codes for pattern in (f"{code}%", f"% {code}%")]
+            conditions.append(f"({' OR '.join(f'diagnoses LIKE {quoted([pattern])}' for pattern in patterns)})")
+    elif query_type in ("registered_as_of", "registered_with_one_practice_between"):
+        start = query_args.get("reference_date") or query_args["start_date"]
+        end = query_args.get("reference_date") or query_args["end_date"]
+        conditions.append("start_date <= ? AND (end_date IS NULL OR end_date > ?)")
+        parameters.extend([resolve_date(start, anchor), resolve_date(end, anchor)])
+        returning = "binary_flag"
+    elif query_type == "date_deregistered_from_all_supported_practices":
+        window("end_date", query_args.get("between"))
+        date_column = "end_date"
+        returning = "date"
+    elif query_type in ("address_as_of", "registered_practice_as_of"):
+        covering(query_args["date"])
+    elif query_type == "age_as_of":
+        reference_date = resolve_date(query_args["reference_date"], anchor)
+        sql = "SELECT patient_id, CAST((julianday(?) - julianday(date_of_birth)) / 365.25 AS INTEGER) FROM patients"
+        return sql, [reference_date]
+    elif query_type == "sex":
+        return "SELECT patient_id, sex FROM patients", []
+    elif query_type == "with_ethnicity_from_sus":
+        conditions.append("code != ''")
+        returning = "code"
+    elif table is None:
+        raise ValueError(f"No stand-in query for query type: {query_type}")
+    if query_type in event_tables or query_type in (
+        "most_recent_bmi",
+        "with_tpp_vaccination_record",
+        "with_test_result_in_sgss",
+        "admitted_to_hospital",
+        "died_from_any_cause",
+        "with_gp_consultations",
+    ):
+        window(date_column, query_args.get("between"))
+    if returning == "binary_flag":
+        value = "1"
+    elif returning in ("date", "date_of_death", "date_admitted"):
+        value = f"{'MIN' if query_args.get('find_first_match_in_period') else 'MAX'}({date_column})"
+    elif returning in ("number_of_matches_in_period", "number_of_episodes"):
+        value = "COUNT(*)"
+    elif returning == "category":
+        value = "MAX(code)"
+    else:
+        value = f"MAX({returning})"
+    source = table
+    if query_type == "registered_practice_as_of":
+        source = "registrations JOIN practices USING (practice_id)"
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f"SELECT patient_id, {value} FROM {source}{where} GROUP BY patient_id", parameters
+
+
+def table_indexes(connection):
+    # table -> {index: [columns]}
+    indexes = collections.defaultdict(dict)
+    for name, table in connection.execute("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'"):
+        columns = [row[2] for row in connection.execute(f"PRAGMA index_info({name})")]
+        indexes[table][name] = columns
+    return indexes
+
+
+def filtered_columns(sql):
+    # the columns named in the query's WHERE clause
+    where = sql.partition(" WHERE ")[2].partition(" GROUP BY ")[0]
+    return set(re.findall(r"\b[a-z_]+\b", re.sub(r"'[^']*'", "", where)))
+
+
+def plan_flags(plan, indexes, sql):
+    flags = []
+    filtered = filtered_columns(sql)
+    for detail in plan:
+        match = re.match(r"\s*SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?", detail)
+        if not match or match[1] in whole_tables or match[1] not in query_tables.values():
+            continue
+        table, index = match[1], match[2]
+        if index is not None:
+            leading = indexes[table][index][0]
+            if leading != "patient_id":
+                flags.append(f"reads every entry of {index} on {table}: its leading column {leading} isn't constrained")
+            continue
+        flags.append(f"full scan of {table}")
+        for unused, columns in indexes.get(table, {}).items():
+            covered = [column for column in columns if column != "patient_id" and column in filtered]
+            if covered:
+                flags.append(f"{table} has index {unused} on {', '.join(covered)} but it isn't used")
+    return flags
+
+
+def explain(connection, sql, parameters):
+    # the plan's steps, indented by depth, and how long the query takes
+    rows = connection.execute(f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+    depths = {0: -1}
+    plan = []
+    for step, parent, _, detail in rows:
+        depths[step] = depths.get(parent, -1) + 1
+        plan.append("  " * depths[step] + detail)
+    start = time.perf_counter()
+    connection.execute(sql, parameters).fetchall()
+    return plan, time.perf_counter() - start
+
+
+def variable_plans(covariate_definitions, database, anchor):
+    statements = generated_sql(covariate_definitions)
+    shared = repeated_fragments(statements)
+    report = {}
+    with contextlib.closing(sqlite3.connect(database)) as connection:
+        indexes = table_indexes(connection)
+        for name, (query_type, query_args) in covariate_definitions.items():
+            record = dict(
+                query_type=query_type,
+                generated_sql=statements.get(name, []),
+                shared_with=dict(shared.get(name, {})),
+                standin_sql=None,
+                plan=[],
+                seconds=None,
+                flags=[],
+            )
+            query = standin_query(query_type, query_args, anchor)
+            if query is not None:
+                record["standin_sql"], parameters = query
+                record["plan"], record["seconds"] = explain(connection, record["standin_sql"], parameters)
+                record["flags"] = plan_flags(record["plan"], indexes, record["standin_sql"])
+            if record["shared_with"]:
+                others = ", ".join(f"{other} ({count})" for other, count in sorted(record["shared_with"].items()))
+                record["flags"].append(f"identical statements or subqueries in the generated SQL of: {others}")
+            report[name] = record
+    return report
+
+
+def summary(report):
+    flagged = [name for name, record in report.items() if record["flags"]]
+    lines = [f"{len(report)} variables, {len(flagged)} flagged", ""]
+    for name, record in report.items():
+        seconds = "" if record["seconds"] is None else f"{record['seconds']:.3f}s"
+        lines.append(f"{name:<40} {record['query_type']:<46} {seconds:>8}")
+        if record["standin_sql"] is None:
+            lines.append("    computed from other columns")
+        for step in record["plan"]:
+            lines.append(f"    {step}")
+        for flag in record["flags"]:
+            lines.append(f"  ! {flag}")
+    return "\n".join(lines) + "\n"
+
+
+def write_sql(report, directory):
+    # one file per variable: its generated SQL, then its stand-in query
+    os.makedirs(directory, exist_ok=True)
+    for name, record in report.items():
+        parts = list(record["generated_sql"])
+        if record["standin_sql"] is not None:
+            parts.append(f"-- stand-in query (SQLite)\n{record['standin_sql']}")
+        if parts:
+            with open(os.path.join(directory, f"{name}.sql"), "w") as f:
+                f.write("\nGO\n\n".join(parts) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report each variable's generated SQL and stand-in query plan")
+    parser.add_argument("--study", default="study_definition", help="study definition module")
+    parser.add_argument("--database", required=True, help="stand-in SQLite database (standin_database.py)")
+    parser.add_argument("--output", default="output/query_plans.json", help="json report to write")
+    parser.add_argument("--sql-dir", default="output/sql", help="directory to write each variable's SQL to")
+    parser.add_argument(
+        "--anchor-date", default="2021-01-01", help="date to take dates relative to other variables from"
+    )
+    args = parser.parse_args()
+    study = importlib.import_module(args.study).study
+    report = variable_plans(study.covariate_definitions, args.database, args.anchor_date)
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    with open(f"{args.output.rsplit('.', 1)[0]}.txt", "w") as f:
+        f.write(summary(report))
+    write_sql(report, args.sql_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import hashlib
+import os
+
+import numpy as np
+
+from variable_keys import freeze
+
+
+# Cached variable results for the local backend
+# Each variable's column is stored under a key made from its definition
+# (codelists by their contents, and dates as they were read from
+# analysis/lib/dates.json), the keys of the variables it depends on, and a
+# digest of the event data. Editing one variable changes its key and the keys
+# of everything that depends on it, so a rerun only recomputes those and
+# reads everything else back from the cache. Cache files are written
+# atomically, as in codelist_cache.py, so concurrent runs can share a cache.
+
+# arguments that don't change what a variable computes
+ignored_args = {"hidden", "return_expectations"}
+
+# change this when the backend's results or the file layout change, so that
+# old cache entries are no longer used
+cache_version = 2
+
+
+def result_key(query_type, query_args, dependency_keys, data_digest):
+    # dependency_keys: name -> key for each variable this one refers to
+    args = {k: v for k, v in query_args.items() if k not in ignored_args}
+    key = (cache_version, query_type, freeze(args), sorted(dependency_keys.items()), data_digest)
+    return hashlib.sha1(repr(key).encode("utf8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def load(self, key):
+        # (column, match dates or None), or None if the key isn't cached
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        with np.load(path) as arrays:
+            column = arrays["column"]
+            match_dates = arrays["match_dates"] if "match_dates" in arrays.files else None
+        if column.dtype.kind == "U":
+            column = column.astype(object)
+        self.hits += 1
+        return column, match_dates
+
+    def save(self, key, column, match_dates=None):
+        # text columns are held as python strings, which numpy can only save
+        # by pickling; they are stored as fixed width unicode instead, so
+        # loading a cache file never unpickles anything
+        if column.dtype == object:
+            column = column.astype(str)
+        arrays = dict(column=column)
+        if match_dates is not None:
+            arrays["match_dates"] = match_dates
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except OSError:
+            # the directory can't be written to: the result is only kept for
+            # this run, and recomputed next time
+            pass
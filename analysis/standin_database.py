@@ -0,0 +1,114 @@
+import argparse
+import importlib
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmark import synthetic_frames
+from event_data import tables
+
+
+# Local stand-in database
+# A SQLite file holding synthetic event-level data in the shape of the tables
+# the study queries (the same tables event_data.py reads from csv): clinical
+# events, medications, vaccinations, SGSS tests, hospital admissions, ONS
+# deaths, GP consultations, addresses, registrations and practices, with codes
+# drawn from the study's own codelists (see benchmark.py). Every event table
+# is indexed on (patient_id, code, date), or (patient_id, date) where it has
+# no code, and the planner's statistics are gathered once it is loaded. The
+# study runs against it with the local backend, with no network:
+#   python analysis/standin_database.py --patients 100000 --output output/standin.sqlite
+#   python analysis/local_backend.py --data output/standin.sqlite --output output/input.csv
+# Dates are stored as ISO text and missing values as NULL. The TPP backend's
+# own SQL is written for SQL Server (temporary tables, SELECT INTO, DATEADD),
+# which SQLite can't run, so the study is run by the local backend rather than
+# by that SQL.
+
+# the indexed columns of each table, after patient_id
+index_columns = dict(
+    registrations=("start_date",),
+    addresses=("start_date",),
+    clinical_events=("code", "date"),
+    medications=("code", "date"),
+    vaccinations=("target_disease", "date"),
+    sgss_tests=("specimen_date",),
+    hospital_admissions=("admission_date",),
+    ons_deaths=("date",),
+    gp_consultations=("date",),
+    sus_ethnicity=("code",),
+)
+
+sql_types = dict(id="INTEGER", int="INTEGER", float="REAL", str="TEXT", date="TEXT", code="TEXT")
+
+
+def sql_column(values, kind):
+    values = np.asarray(values)
+    if kind == "date":
+        strings = np.datetime_as_string(values.astype("datetime64[D]"), unit="D").astype(object)
+        strings[np.isnat(values)] = None
+        return strings
+    return values
+
+
+def create_table(connection, name, columns):
+    definitions = [f"{column} {sql_types[kind]}" for column, kind in columns.items()]
+    if name in ("patients", "practices"):
+        # keyed by their first column, patient_id and practice_id
+        definitions[0] += " PRIMARY KEY"
+    connection.execute(f"CREATE TABLE {name} ({', '.join(definitions)})")
+
+
+def write_database(path, frames):
+    # frames: table name -> {column: values}, as benchmark.synthetic_frames
+    # gives; an existing file at path is replaced
+    if os.path.exists(path):
+        os.remove(path)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path)
+    try:
+        for name, columns in tables.items():
+            create_table(connection, name, columns)
+            frame = pd.DataFrame(
+                {column: sql_column(frames[name][column], kind) for column, kind in columns.items()}
+                if name in frames
+                else {column: [] for column in columns}
+            )
+            placeholders = ", ".join("?" for _ in columns)
+            connection.executemany(
+                f"INSERT INTO {name} VALUES ({placeholders})",
+                frame.astype(object).where(frame.notna(), None).itertuples(index=False, name=None),
+            )
+            if name in index_columns:
+                indexed = ", ".join(("patient_id",) + index_columns[name])
+                connection.execute(f"CREATE INDEX {name}_ix ON {name} ({indexed})")
+        connection.commit()
+        connection.execute("ANALYZE")
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a SQLite stand-in database of synthetic event data")
+    parser.add_argument("--study", default="study_definition", help="study definition module to draw codes from")
+    parser.add_argument("--output", default="output/standin.sqlite", help="SQLite file to write")
+    parser.add_argument("--patients", type=int, default=100_000)
+    parser.add_argument("--events-per-patient", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    study = importlib.import_module(args.study).study
+    start = time.perf_counter()
+    frames = synthetic_frames(study.covariate_definitions, args.patients, args.events_per_patient, args.seed)
+    write_database(args.output, frames)
+    rows = sum(len(next(iter(columns.values()))) for columns in frames.values())
+    print(f"wrote {rows} rows to {args.output} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
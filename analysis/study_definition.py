@@ -2,8 +2,7 @@ from datetime import date
 
 from cohortextractor import (
     StudyDefinition, 
-    patients, 
-    filter_codes_by_category
+    patients
 )
 
 # Import codelists.py script
@@ -176,7 +175,7 @@ study = StudyDefinition(
         ),
     
         ever_smoked=patients.with_these_clinical_events(
-            filter_codes_by_category(codelists.clear_smoking_codes, include=["S", "E"]),
+            codelists.filter_by_category("clear_smoking_codes", include=["S", "E"]),
             on_or_before = "elig_date - 1 day",
         ),
     ),
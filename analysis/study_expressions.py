@@ -0,0 +1,221 @@
+import numpy as np
+import sqlparse
+from sqlparse import tokens as ttypes
+
+from cohortextractor.expressions import filter_and_validate_tokens
+
+
+# Vectorised evaluation of `patients.satisfying` / `patients.categorised_as`
+# expression strings for the local backend
+# Expressions are tokenised and validated exactly as cohortextractor does, then
+# parsed (once per expression string) into a small tree of tuples and evaluated
+# over whole columns at once, sharing common subexpressions between expressions.
+# Semantics follow the TPP backend: a bare column is true when it isn't empty
+# (0, "" or a missing date), and a missing date compares as the earliest date.
+
+comparison_ops = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+arithmetic_ops = {"+": np.add, "-": np.subtract, "*": np.multiply, "/": np.divide}
+
+# missing dates compare as "" does in the TPP backend, ie before any real date
+earliest_date = np.datetime64("1900-01-01", "D")
+
+
+def tokenise(expression):
+    tokens = filter_and_validate_tokens(sqlparse.parse(expression)[0].flatten())
+    return [(token.ttype, token.value) for token in tokens]
+
+
+class Parser:
+    # recursive descent, lowest precedence first:
+    # OR < AND < NOT < comparison < + - < * /
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenise(expression)
+        self.position = 0
+
+    def parse(self):
+        node = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unexpected token in expression: {self.expression}")
+        return node
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def is_keyword(self, value):
+        ttype, token_value = self.peek()
+        return ttype is not None and ttype in ttypes.Keyword and token_value.upper() == value
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.is_keyword("OR"):
+            self.take()
+            node = ("or", node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.is_keyword("AND"):
+            self.take()
+            node = ("and", node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.is_keyword("NOT"):
+            self.take()
+            return ("not", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        node = self.parse_sum()
+        ttype, value = self.peek()
+        if ttype is not None and ttype in ttypes.Comparison:
+            self.take()
+            node = ("compare", value, node, self.parse_sum())
+        return node
+
+    def parse_sum(self):
+        node = self.parse_product()
+        while self.peek()[0] in ttypes.Operator and self.peek()[1] in ("+", "-"):
+            _, op = self.take()
+            node = ("arithmetic", op, node, self.parse_product())
+        return node
+
+    def parse_product(self):
+        node = self.parse_atom()
+        while self.peek()[0] in ttypes.Operator and self.peek()[1] in ("*", "/"):
+            _, op = self.take()
+            node = ("arithmetic", op, node, self.parse_atom())
+        return node
+
+    def parse_atom(self):
+        ttype, value = self.take()
+        if ttype is None:
+            raise ValueError(f"Unexpected end of expression: {self.expression}")
+        if ttype in ttypes.Punctuation and value == "(":
+            node = self.parse_or()
+            if self.take()[1] != ")":
+                raise ValueError(f"Unbalanced brackets in expression: {self.expression}")
+            return node
+        if ttype in ttypes.Name:
+            return ("column", value)
+        if ttype in ttypes.Number.Integer:
+            return ("literal", int(value))
+        if ttype in ttypes.Number.Float:
+            return ("literal", float(value))
+        if ttype in ttypes.Literal.String:
+            return ("literal", value[1:-1])
+        raise ValueError(f"Unexpected token '{value}' in expression: {self.expression}")
+
+
+def parse_expression(expression):
+    return Parser(expression).parse()
+
+
+def names_in(node):
+    if node[0] == "column":
+        return {node[1]}
+    if node[0] == "literal":
+        return set()
+    return set().union(*(names_in(child) for child in node[1:] if isinstance(child, tuple)))
+
+
+def is_date(values):
+    return isinstance(values, np.ndarray) and values.dtype.kind == "M"
+
+
+def truthy(values):
+    if is_date(values):
+        return ~np.isnat(values)
+    if isinstance(values, np.ndarray) and values.dtype == object:
+        return values != ""
+    return np.asarray(values) != 0
+
+
+def comparable(values, other):
+    # dates compare with missing values as the earliest date, and string
+    # literals compared against dates are read as dates
+    if is_date(values):
+        return np.where(np.isnat(values), earliest_date, values)
+    if isinstance(values, str) and is_date(other):
+        return np.datetime64(values or "1900-01-01", "D")
+    return values
+
+
+class ExpressionEvaluator:
+    # Evaluates parsed expressions as whole-column operations. Nodes are
+    # tuples, so identical subexpressions compare equal wherever they appear,
+    # and each distinct one is computed once and shared by every expression
+    # evaluated here: `age_1 >= 80` is one array comparison whether it is
+    # used in elig_date, the population or jcvi_group.
+    # column_values(name) gives the column as expressions see it, and
+    # on_lookup(cache, hit), if given, is told whether each result was shared.
+    def __init__(self, column_values, on_lookup=None):
+        self.column_values = column_values
+        self.on_lookup = on_lookup
+        self.results = {}
+
+    def lookup(self, key):
+        if self.on_lookup is not None:
+            self.on_lookup("expressions", key in self.results)
+        return key in self.results
+
+    def truth(self, node):
+        key = ("truth", node)
+        if not self.lookup(key):
+            self.results[key] = self.compute_truth(node)
+        return self.results[key]
+
+    def value(self, node):
+        key = ("value", node)
+        if not self.lookup(key):
+            self.results[key] = self.compute_value(node)
+        return self.results[key]
+
+    def compute_value(self, node):
+        kind = node[0]
+        if kind == "column":
+            return self.column_values(node[1])
+        if kind == "literal":
+            return node[1]
+        if kind == "arithmetic":
+            _, op, left, right = node
+            return arithmetic_ops[op](self.value(left), self.value(right))
+        return self.truth(node)
+
+    def compute_truth(self, node):
+        kind = node[0]
+        if kind == "or":
+            return self.truth(node[1]) | self.truth(node[2])
+        if kind == "and":
+            return self.truth(node[1]) & self.truth(node[2])
+        if kind == "not":
+            return ~self.truth(node[1])
+        if kind == "compare":
+            _, op, left, right = node
+            left = self.value(left)
+            right = self.value(right)
+            return np.asarray(comparison_ops[op](comparable(left, right), comparable(right, left)), dtype=bool)
+        return truthy(self.value(node))
+
+    def select(self, nodes):
+        # index of the first node that is true for each row (from 1), or 0
+        # where none are, in one pass over the conditions
+        if not nodes:
+            return np.zeros((), dtype=np.int64)
+        return np.select([self.truth(node) for node in nodes], np.arange(1, len(nodes) + 1), 0)
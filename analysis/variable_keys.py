@@ -0,0 +1,76 @@
+import hashlib
+
+
+# Query deduplication
+# Every variable definition is normalised into a key made from its query type
+# and the arguments that change what it computes (codelist contents, window,
+# returning, find_first/last and so on). Variables with identical keys compute
+# identical columns, so only the first is extracted and the others become
+# aliases reading its result. Only the local backend applies it, to the
+# definitions it evaluates; the study definition itself, which cohortextractor
+# extracts, is left as it is written. study_definition.py doesn't include
+# jcvi_variables.py, and its only duplicate is age_2, which aliases age_1.
+
+# arguments that don't change the value a query computes; date_format only
+# truncates the output column, and aliases keep their own
+ignored_args = {"hidden", "return_expectations", "column_type", "date_format"}
+
+# these query types don't scan a table of their own (expressions over other
+# columns, or constants), so there is nothing to gain by aliasing them
+unaliased_query_types = {"categorised_as", "aggregate_of", "value_from", "fixed_value"}
+
+
+def freeze(value):
+    if getattr(value, "system", None) is not None:
+        # codelists are identified by their contents, not by which variable or
+        # module they came from
+        codes = sorted(value)
+        digest = hashlib.sha1(repr(codes).encode("utf8")).hexdigest()
+        return ("codelist", value.system, value.has_categories, digest)
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def variable_key(query_type, query_args):
+    args = {k: v for k, v in query_args.items() if k not in ignored_args}
+    return (query_type, freeze(args))
+
+
+def alias_map(covariate_definitions):
+    # maps each duplicated variable to the first variable with the same key
+    canonical = {}
+    aliases = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if name == "population" or query_type in unaliased_query_types:
+            continue
+        key = variable_key(query_type, query_args)
+        if key in canonical:
+            aliases[name] = canonical[key]
+        else:
+            canonical[key] = name
+    return aliases
+
+
+def dedupe_covariate_definitions(covariate_definitions):
+    aliases = alias_map(covariate_definitions)
+    deduped = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if name in aliases:
+            source = aliases[name]
+            query_type = "value_from"
+            query_args = {
+                "source": source,
+                "returning": covariate_definitions[source][1].get("returning", "value"),
+                "column_type": query_args["column_type"],
+                "date_format": query_args.get("date_format"),
+                "return_expectations": query_args.get("return_expectations"),
+                "hidden": query_args.get("hidden", False),
+            }
+        elif query_type == "value_from" and query_args["source"] in aliases:
+            query_args = dict(query_args, source=aliases[query_args["source"]])
+        deduped[name] = (query_type, query_args)
+    return deduped
+
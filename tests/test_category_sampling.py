@@ -0,0 +1,58 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+
+import category_sampling
+from category_sampling import AliasTable, restore_tables, table_for
+
+ratios = {"A": 0.05, "B": 0.15, "C": 0.3, "D": 0.5}
+
+
+def frequencies(values, categories):
+    return np.array([np.mean(values == category) for category in categories])
+
+
+def test_draws_follow_the_ratios():
+    rng = np.random.default_rng(0)
+    values = table_for(ratios).sample(rng, 200_000)
+    assert np.allclose(frequencies(values, ratios), list(ratios.values()), atol=0.005)
+    # a category with no weight is never drawn
+    values = AliasTable(["x", "y", "z"], [0.5, 0, 0.5]).sample(rng, 10_000)
+    assert set(values) == {"x", "z"}
+
+
+def test_many_equally_likely_categories():
+    # as imd's 320 values
+    table = table_for({value: 1 / 320 for value in range(0, 32000, 100)})
+    values = table.sample(np.random.default_rng(1), 320_000)
+    counts = np.unique(values, return_counts=True)[1]
+    assert len(counts) == 320
+    assert counts.min() > 800 and counts.max() < 1200
+
+
+def test_tables_are_compiled_once():
+    assert table_for(dict(ratios)) is table_for(ratios)
+    with pytest.raises(ValueError, match="must add up to 1"):
+        table_for({"A": 0.5, "B": 0.4})
+
+
+def compiled_in_worker(key):
+    # whether the worker already had the table, and a draw from it
+    had_table = key in category_sampling.tables
+    table = table_for(dict(key))
+    return had_table, list(table.sample(np.random.default_rng(2), 5))
+
+
+def test_restore_tables_in_worker_processes():
+    key = tuple(ratios.items())
+    expected = list(table_for(ratios).sample(np.random.default_rng(2), 5))
+    # spawned workers start with nothing, so they only have the parent's
+    # tables if they are handed them
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        assert pool.submit(compiled_in_worker, key).result() == (False, expected)
+    tables = dict(category_sampling.tables)
+    with ProcessPoolExecutor(1, mp_context=context, initializer=restore_tables, initargs=(tables,)) as pool:
+        assert pool.submit(compiled_in_worker, key).result() == (True, expected)
@@ -0,0 +1,105 @@
+import json
+import os
+
+import pytest
+from cohortextractor import codelist
+
+import codelist_arrays
+import codelist_cache
+import codelist_loader
+
+
+def write_csv(path, rows):
+    path.write_text("code,category\n" + "".join(f"{code},{category}\n" for code, category in rows))
+    return str(path)
+
+
+def test_cache_key_ignores_modification_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(codelist_cache, "cache_dir", str(tmp_path / "cache"))
+    filename = write_csv(tmp_path / "codes.csv", [("1002", "B"), ("1001", "A")])
+    cold = codelist_cache.cached_codelist_from_csv(filename, "snomed", category_column="category")
+    key = codelist_cache.cache_key(filename, "snomed", category_column="category")
+    os.utime(filename, ns=(0, 0))
+    assert codelist_cache.cache_key(filename, "snomed", category_column="category") == key
+    os.remove(filename)
+    # read back from the cache without the csv
+    monkeypatch.setattr(codelist_cache, "cache_key", lambda *args: key)
+    warm = codelist_cache.cached_codelist_from_csv(filename, "snomed", category_column="category")
+    assert list(warm) == list(cold) == [("1001", "A"), ("1002", "B")]
+
+
+def test_cache_key_follows_contents_and_arguments(tmp_path):
+    filename = write_csv(tmp_path / "codes.csv", [("1001", "A")])
+    key = codelist_cache.cache_key(filename, "snomed")
+    assert codelist_cache.cache_key(filename, "ctv3") != key
+    assert codelist_cache.cache_key(filename, "snomed", category_column="category") != key
+    write_csv(tmp_path / "codes.csv", [("1009", "A")])
+    # not in the manifest, so keyed on the contents even at the same size
+    assert codelist_cache.cache_key(filename, "snomed") != key
+
+
+def manifest(**shas):
+    return {filename: {"sha": sha} for filename, sha in shas.items()}
+
+
+def test_loader_checks_shas(tmp_path, monkeypatch):
+    monkeypatch.setattr(codelist_cache, "cache_dir", "")
+    filename = write_csv(tmp_path / "codes.csv", [("1001", "A")])
+    with open(filename, "rb") as f:
+        sha = codelist_loader.manifest_sha(f.read())
+    spec = dict(filename=filename, system="snomed", category_column="category")
+    loaded = codelist_loader.load_verified("codes", spec, manifest(**{"codes.csv": sha}))
+    assert list(loaded) == [("1001", "A")]
+    # line endings are normalised, as the opensafely cli does
+    (tmp_path / "codes.csv").write_bytes(open(filename, "rb").read().replace(b"\n", b"\r\n"))
+    codelist_loader.load_verified("codes", spec, manifest(**{"codes.csv": sha}))
+    write_csv(tmp_path / "codes.csv", [("1001", "B")])
+    with pytest.raises(ValueError, match="does not match the sha"):
+        codelist_loader.load_verified("codes", spec, manifest(**{"codes.csv": sha}))
+    with pytest.raises(ValueError, match="is not listed"):
+        codelist_loader.load_verified("codes", spec, manifest())
+
+
+def test_loader_stops_at_a_bad_codelist(tmp_path, monkeypatch):
+    monkeypatch.setattr(codelist_cache, "cache_dir", "")
+    good = write_csv(tmp_path / "good.csv", [("1001", "A")])
+    bad = write_csv(tmp_path / "bad.csv", [("1002", "A")])
+    with open(good, "rb") as f:
+        sha = codelist_loader.manifest_sha(f.read())
+    manifest_path = tmp_path / "codelists.json"
+    manifest_path.write_text(json.dumps({"files": manifest(**{"good.csv": sha, "bad.csv": "0" * 40})}))
+    specs = {name: dict(filename=filename, system="snomed") for name, filename in [("good", good), ("bad", bad)]}
+    with pytest.raises(ValueError, match="'bad'"):
+        codelist_loader.load_codelists(specs, str(manifest_path))
+    del specs["bad"]
+    assert list(codelist_loader.load_codelists(specs, str(manifest_path))["good"]) == ["1001"]
+
+
+def test_interner_keeps_plain_integer_codes():
+    interner = codelist_arrays.CodeInterner()
+    codes = ["1001", "0", "123456789012345678", "1234567890123456789", "01001", "Y1234", "XaBcD"]
+    ids = interner.encode(codes, add=True)
+    # at most 18 digits, without a leading zero, is the code's own value
+    assert ids[:3].tolist() == [1001, 0, 123456789012345678]
+    # anything else is interned as a negative id
+    assert sorted(ids[3:].tolist()) == [-4, -3, -2, -1]
+    assert interner.decode(ids) == codes
+    # unseen codes are only added when asked to
+    assert interner.encode(["Z999", "01001", "42"]).tolist() == [codelist_arrays.unknown_code, ids[4], 42]
+
+
+def test_restore_interner_forgets_encoded_codelists():
+    saved = list(codelist_arrays.interner.codes)
+    try:
+        codes = codelist(["Y1234", "1001"], "ctv3")
+        array = codelist_arrays.codelist_array(codes)
+        assert codelist_arrays.codelist_array(codes) is array
+        categorised = codelist([("Y1234", "A")], "ctv3")
+        lookup = codelist_arrays.category_lookup(categorised)
+        # a worker with Y1234 at another id must not reuse the arrays
+        codelist_arrays.restore_interner(["other"] + saved)
+        assert codelist_arrays.codelist_array(codes) is not array
+        assert codelist_arrays.category_lookup(categorised) is not lookup
+        assert codelist_arrays.interner.decode(codelist_arrays.codelist_array(codes)) == ["Y1234", "1001"]
+    finally:
+        codelist_arrays.restore_interner(saved)
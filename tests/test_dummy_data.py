@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+from cohortextractor import StudyDefinition, patients
+
+import dummy_data
+
+
+def small_study():
+    return StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2020-01-01", "latest": "2020-12-31"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        population=patients.satisfying("registered AND NOT died"),
+        registered=patients.registered_as_of("2020-01-01", return_expectations={"incidence": 0.8}),
+        died=patients.died_from_any_cause(
+            on_or_before="2020-06-01", returning="binary_flag", return_expectations={"incidence": 0.25}
+        ),
+        age=patients.age_as_of(
+            "2020-01-01", return_expectations={"rate": "universal", "int": {"distribution": "population_ages"}}
+        ),
+        region=patients.registered_practice_as_of(
+            "2020-01-01",
+            returning="nuts1_region_name",
+            return_expectations={"rate": "universal", "category": {"ratios": {"North": 0.25, "South": 0.75}}},
+        ),
+        vaccinated=patients.with_tpp_vaccination_record(
+            target_disease_matches="SARS-2 CORONAVIRUS",
+            between=["2020-03-01", "2020-12-31"],
+            returning="date",
+            find_first_match_in_period=True,
+            date_format="YYYY-MM-DD",
+            return_expectations={"incidence": 0.6},
+        ),
+    )
+
+
+def generate(tmp_path, rows, name="input.csv", **options):
+    path = tmp_path / name
+    written, generated = dummy_data.generate(small_study(), str(path), rows, **options)
+    return pd.read_csv(path, keep_default_na=False, dtype=str), written, generated
+
+
+def test_only_the_population_is_written(tmp_path):
+    frame, written, generated = generate(tmp_path, 40_000, chunk_size=50_000)
+    assert written == len(frame) == 40_000
+    # 0.8 registered and 0.75 alive: about 40,000 / 0.6 patients generated, in
+    # whole chunks
+    assert generated == 100_000
+    assert list(frame.columns) == ["patient_id", "registered", "died", "age", "region", "vaccinated"]
+    assert set(frame["registered"]) == {"1"} and set(frame["died"]) == {"0"}
+    assert frame["patient_id"].astype(int).is_monotonic_increasing
+    dates = frame["vaccinated"][frame["vaccinated"] != ""]
+    assert dates.between("2020-03-01", "2020-12-31").all()
+    assert abs(len(dates) / len(frame) - 0.6) < 0.05
+
+
+def test_without_the_population_filter(tmp_path):
+    frame, written, generated = generate(tmp_path, 3000, chunk_size=50_000, filter_population=False)
+    assert written == len(frame) == 3000 and generated == 50_000
+    assert list(frame["patient_id"].astype(int)) == list(range(1, 3001))
+    assert abs((frame["registered"] == "1").mean() - 0.8) < 0.05
+    assert abs((frame["died"] == "1").mean() - 0.25) < 0.05
+    assert set(frame["region"]) == {"North", "South"}
+    ages = frame["age"].astype(int)
+    assert ages.between(0, 109).all()
+
+
+def test_output_does_not_depend_on_chunk_size_or_workers(tmp_path):
+    # 120,000 rows span three random stream blocks, cut differently by each
+    # chunk size
+    for filter_population in (True, False):
+        outputs = set()
+        for chunk_size, workers in [(50_000, 1), (100_000, 1), (50_000, 2), (150_000, 3)]:
+            path = tmp_path / f"input_{chunk_size}_{workers}_{filter_population}.csv"
+            dummy_data.generate(
+                small_study(), str(path), 120_000, chunk_size=chunk_size, workers=workers,
+                filter_population=filter_population,
+            )
+            outputs.add(path.read_bytes())
+        assert len(outputs) == 1
+
+
+def test_chunks_are_whole_stream_blocks(tmp_path):
+    with pytest.raises(ValueError, match="multiple of 50000"):
+        dummy_data.generate(small_study(), str(tmp_path / "input.csv"), 100, chunk_size=1000)
+
+
+def test_expectations_are_merged_over_the_defaults():
+    merged = dummy_data.merge(
+        {"date": {"earliest": "1900-01-01", "latest": "today"}, "incidence": 0.5},
+        {"date": {"earliest": "2020-01-01"}, "rate": "universal"},
+    )
+    assert merged == {"date": {"earliest": "2020-01-01", "latest": "today"}, "incidence": 0.5, "rate": "universal"}
+    # windows relative to missing dates are empty
+    lo, hi = dummy_data.date_range(
+        np.array(["2020-06-01", "NaT"], dtype="datetime64[D]"), None, {"earliest": "2020-01-01", "latest": "2020-12-31"}
+    )
+    assert lo[0] == np.datetime64("2020-06-01") and hi[0] == np.datetime64("2020-12-31")
+    assert np.isnat(lo[1])
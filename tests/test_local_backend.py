@@ -0,0 +1,798 @@
+import threading
+
+import pandas as pd
+import pytest
+from cohortextractor import StudyDefinition, codelist, patients
+
+import local_backend
+from event_data import EventData, tables
+from event_scans import AnchoredDates
+from extraction_profile import ExtractionProfile
+from local_backend import LocalBackend, extract_sharded, extract_streaming
+from result_cache import ResultCache
+
+
+# Each test builds a handful of patients' records, extracts some variables
+# with the local backend and checks every column against values worked out by
+# hand from the TPP backend's SQL. Every test runs in each of the local
+# backend's modes, so they are all checked against TPP's semantics rather
+# than only against each other.
+
+n_patients = 5
+
+codes = codelist(["1001", "1002"], "snomed")
+categorised_codes = codelist([("1001", "A"), ("1002", "B")], "snomed")
+anchor_codes = codelist(["3001"], "snomed")
+
+
+def in_memory(**options):
+    def run(data, covariate_definitions, tmp_path):
+        return LocalBackend(data, covariate_definitions, **options).to_dataframe()
+    return run
+
+
+def sharded(data, covariate_definitions, tmp_path):
+    return extract_sharded(data, covariate_definitions, 2)
+
+
+def batched(data, covariate_definitions, tmp_path):
+    path = tmp_path / "batched.csv"
+    extract_streaming(data, covariate_definitions, str(path), batch_size=2)
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+modes = dict(
+    fused=in_memory(),
+    unfused=in_memory(fuse=False),
+    # every date is treated per patient rather than per anchor group
+    unanchored=in_memory(),
+    staged_workers=in_memory(staged=True, workers=3),
+    sharded=sharded,
+    batched=batched,
+)
+
+
+def table(name, *rows):
+    return pd.DataFrame(list(rows), columns=list(tables[name]), dtype=object)
+
+
+def event_data(**frames):
+    frames.setdefault(
+        "patients", table("patients", *[(i, "F", "1980-01-01") for i in range(1, n_patients + 1)])
+    )
+    return EventData(frames)
+
+
+@pytest.fixture(params=sorted(modes))
+def extract(request, tmp_path, monkeypatch):
+    if request.param == "unanchored":
+        monkeypatch.setattr(local_backend, "max_anchor_groups", 0)
+
+    def run(data, **variables):
+        study = StudyDefinition(population=variables.pop("population", patients.all()), **variables)
+        frame = modes[request.param](data, study.covariate_definitions, tmp_path)
+        return {column: [str(value) for value in frame[column]] for column in frame.columns}
+    return run
+
+
+def check(columns, **expected):
+    for name, values in expected.items():
+        assert columns[name] == [str(value) for value in values], name
+
+
+def spy(monkeypatch, name, describe):
+    # describe(*args) for every call of local_backend's `name`
+    calls = []
+    original = getattr(local_backend, name)
+
+    def run(*args):
+        calls.append(describe(*args))
+        return original(*args)
+    monkeypatch.setattr(local_backend, name, run)
+    return calls
+
+
+def query_names(*args):
+    # the queries given to a fused scan (the last but one argument)
+    return sorted(query["name"] for query in args[-2])
+
+
+def evaluate(data, **options):
+    variables = options.pop("variables")
+    study = StudyDefinition(population=options.pop("population", patients.all()), **variables)
+    backend = LocalBackend(data, study.covariate_definitions, **options)
+    return backend, backend.to_dataframe()
+
+
+def clinical_events():
+    return table(
+        "clinical_events",
+        (1, "1001", "2020-01-10", 20.0),
+        (1, "1002", "2020-03-05", 25.0),
+        (1, "2001", "2020-04-01", 99.0),
+        # two matches on the same day: TPP orders by date then event id, so
+        # the one recorded first is used whether finding the first or last
+        (2, "1002", "2020-06-01", 30.0),
+        (2, "1001", "2020-06-01", 31.0),
+        (3, "1001", "2019-12-31", 40.0),
+        # recorded out of date order, and the later one has no value
+        (4, "1001", "2020-02-01", 0.0),
+        (4, "1001", "2020-01-15", 18.0),
+        (1, "3001", "2020-03-01", None),
+        (2, "3001", "2020-06-01", None),
+    )
+
+
+def test_clinical_events(extract):
+    between = ["2020-01-01", "2020-12-31"]
+    columns = extract(
+        event_data(clinical_events=clinical_events()),
+        flag=patients.with_these_clinical_events(codes, between=between),
+        count=patients.with_these_clinical_events(codes, between=between, returning="number_of_matches_in_period"),
+        first_date=patients.with_these_clinical_events(
+            codes, between=between, returning="date", find_first_match_in_period=True, date_format="YYYY-MM-DD"
+        ),
+        first_year=patients.with_these_clinical_events(
+            codes, between=between, returning="date", find_first_match_in_period=True
+        ),
+        first_value=patients.with_these_clinical_events(
+            codes, between=between, returning="numeric_value", find_first_match_in_period=True
+        ),
+        last_value=patients.with_these_clinical_events(
+            codes, between=between, returning="numeric_value", find_last_match_in_period=True
+        ),
+        last_known_value=patients.with_these_clinical_events(
+            codes,
+            between=between,
+            returning="numeric_value",
+            find_last_match_in_period=True,
+            ignore_missing_values=True,
+        ),
+        last_code=patients.with_these_clinical_events(
+            codes, between=between, returning="code", find_last_match_in_period=True
+        ),
+        last_category=patients.with_these_clinical_events(
+            categorised_codes, between=between, returning="category", find_last_match_in_period=True
+        ),
+    )
+    check(
+        columns,
+        patient_id=[1, 2, 3, 4, 5],
+        flag=[1, 1, 0, 1, 0],
+        count=[2, 2, 0, 2, 0],
+        first_date=["2020-01-10", "2020-06-01", "", "2020-01-15", ""],
+        first_year=["2020", "2020", "", "2020", ""],
+        first_value=[20.0, 30.0, 0.0, 18.0, 0.0],
+        last_value=[25.0, 30.0, 0.0, 0.0, 0.0],
+        last_known_value=[25.0, 30.0, 0.0, 18.0, 0.0],
+        last_code=["1002", "1002", "", "1001", ""],
+        last_category=["B", "B", "", "A", ""],
+    )
+
+
+def test_clinical_events_are_read_in_one_scan(monkeypatch):
+    fused = spy(monkeypatch, "scan_events_fused", query_names)
+    single = spy(monkeypatch, "scan_events", lambda table, query, n_patients: query["name"])
+    variables = dict(
+        flag=patients.with_these_clinical_events(codes),
+        count=patients.with_these_clinical_events(codes, returning="number_of_matches_in_period"),
+        anchor=patients.with_these_clinical_events(anchor_codes, returning="date", date_format="YYYY-MM-DD"),
+        # depends on anchor, so it is scanned once anchor is known
+        after_anchor=patients.with_these_clinical_events(codes, on_or_after="anchor"),
+    )
+    data = event_data(clinical_events=clinical_events())
+    _, frame = evaluate(data, variables=variables)
+    assert fused == [["anchor", "count", "flag"], ["after_anchor"]]
+    assert single == []
+    _, unfused = evaluate(data, variables=variables, fuse=False)
+    assert len(single) == 4 and len(fused) == 2
+    pd.testing.assert_frame_equal(frame, unfused)
+
+
+def test_consecutive_windows(extract):
+    # queries over one codelist and consecutive windows, as for astrxm1-3
+    months = [("2020-01-01", "2020-01-31"), ("2020-02-01", "2020-02-29"), ("2020-03-01", "2020-03-31")]
+    columns = extract(
+        event_data(clinical_events=clinical_events()),
+        **{
+            f"month_{i}": patients.with_these_clinical_events(
+                codes, between=list(month), returning="number_of_matches_in_period"
+            )
+            for i, month in enumerate(months, 1)
+        },
+    )
+    check(columns, month_1=[1, 0, 0, 1, 0], month_2=[0, 0, 0, 1, 0], month_3=[1, 0, 0, 0, 0])
+
+
+def test_windows_relative_to_another_variable(extract):
+    columns = extract(
+        event_data(clinical_events=clinical_events()),
+        anchor=patients.with_these_clinical_events(
+            anchor_codes, returning="date", find_first_match_in_period=True, date_format="YYYY-MM-DD"
+        ),
+        # a window bounded by a missing date matches nothing, as comparing
+        # with NULL does in SQL, even though patient 3 has an earlier event
+        before_anchor=patients.with_these_clinical_events(codes, on_or_before="anchor - 1 day"),
+        month_after_anchor=patients.with_these_clinical_events(
+            codes, between=["anchor", "anchor + 1 month"], returning="number_of_matches_in_period"
+        ),
+    )
+    check(
+        columns,
+        anchor=["2020-03-01", "2020-06-01", "", "", ""],
+        before_anchor=[1, 0, 0, 0, 0],
+        month_after_anchor=[1, 2, 0, 0, 0],
+    )
+
+
+def test_windows_are_resolved_once_per_anchor_date(monkeypatch):
+    variables = dict(
+        anchor=patients.with_these_clinical_events(
+            anchor_codes, returning="date", find_first_match_in_period=True, date_format="YYYY-MM-DD"
+        ),
+        month_after=patients.with_these_clinical_events(codes, between=["anchor", "anchor + 1 month"]),
+        count_month_after=patients.with_these_clinical_events(
+            codes, between=["anchor", "anchor + 1 month"], returning="number_of_matches_in_period"
+        ),
+    )
+    data = event_data(clinical_events=clinical_events())
+    backend, frame = evaluate(data, variables=variables)
+    # two anchor dates and a group for patients without one
+    anchored = backend.anchors["anchor"]
+    assert isinstance(anchored, AnchoredDates)
+    assert [str(date) for date in anchored.values] == ["2020-03-01", "2020-06-01", "NaT"]
+    assert list(anchored.groups) == [0, 1, 2, 2, 2]
+    # the window's end is worked out per group, once for both variables
+    month_later = backend.resolved_dates["anchor + 1 month"]
+    assert [str(date) for date in month_later.values] == ["2020-04-01", "2020-07-01", "NaT"]
+    # with too many anchor dates to group, dates are kept per patient
+    monkeypatch.setattr(local_backend, "max_anchor_groups", 2)
+    backend, per_patient = evaluate(data, variables=variables)
+    assert not isinstance(backend.anchors["anchor"], AnchoredDates)
+    pd.testing.assert_frame_equal(frame, per_patient)
+
+
+def test_month_arithmetic_clamps_to_the_end_of_the_month(extract):
+    # as SQL Server's DATEADD: 31 January plus a month is the last day of
+    # February, and 29 February plus a year is 28 February
+    data = event_data(
+        clinical_events=table(
+            "clinical_events",
+            (1, "3001", "2021-01-31", None),
+            (1, "1001", "2021-02-28", None),
+            (2, "3001", "2020-01-31", None),
+            (2, "1001", "2020-02-29", None),
+            (3, "3001", "2020-03-31", None),
+            (3, "1001", "2020-02-29", None),
+            (4, "3001", "2020-02-29", None),
+            (4, "1001", "2021-02-28", None),
+        )
+    )
+    columns = extract(
+        data,
+        anchor=patients.with_these_clinical_events(
+            anchor_codes, returning="date", find_first_match_in_period=True, date_format="YYYY-MM-DD"
+        ),
+        month_later=patients.with_these_clinical_events(codes, between=["anchor + 1 month", "anchor + 1 month"]),
+        month_earlier=patients.with_these_clinical_events(codes, between=["anchor - 1 month", "anchor - 1 month"]),
+        year_later=patients.with_these_clinical_events(codes, between=["anchor + 1 year", "anchor + 1 year"]),
+    )
+    check(
+        columns,
+        month_later=[1, 1, 0, 0, 0],
+        month_earlier=[0, 0, 1, 0, 0],
+        year_later=[0, 0, 0, 1, 0],
+    )
+
+
+def test_medications(extract):
+    data = event_data(
+        medications=table(
+            "medications",
+            (1, "1001", "2020-05-01"),
+            (1, "1002", "2020-02-01"),
+            (2, "1001", "2019-06-01"),
+            (3, "9999", "2020-03-01"),
+        )
+    )
+    columns = extract(
+        data,
+        first=patients.with_these_medications(
+            codes, on_or_after="2020-01-01", returning="date", find_first_match_in_period=True, date_format="YYYY-MM"
+        ),
+        ever=patients.with_these_medications(codes, returning="number_of_matches_in_period"),
+    )
+    check(columns, first=["2020-02", "", "", "", ""], ever=[2, 1, 0, 0, 0])
+
+
+def test_medications_are_read_in_one_scan(monkeypatch):
+    fused = spy(monkeypatch, "scan_events_fused", query_names)
+    data = event_data(
+        clinical_events=clinical_events(),
+        medications=table("medications", (1, "1001", "2020-05-01"), (2, "1002", "2019-06-01")),
+    )
+    variables = dict(
+        on_medication=patients.with_these_medications(codes, on_or_after="2020-01-01"),
+        prescriptions=patients.with_these_medications(codes, returning="number_of_matches_in_period"),
+        diagnosed=patients.with_these_clinical_events(codes),
+    )
+    _, frame = evaluate(data, variables=variables)
+    # one scan of each table
+    assert sorted(fused) == [["diagnosed"], ["on_medication", "prescriptions"]]
+    assert list(frame["on_medication"]) == [1, 0, 0, 0, 0]
+    assert list(frame["prescriptions"]) == [1, 1, 0, 0, 0]
+
+
+def test_vaccination_records(extract):
+    # names are matched case-insensitively, as SQL Server compares them
+    data = event_data(
+        vaccinations=table(
+            "vaccinations",
+            (1, "SARS-2 CORONAVIRUS", "", "2021-01-05"),
+            (1, "INFLUENZA", "", "2020-10-01"),
+            (2, "", "COVID-19 mRNA Vaccine Comirnaty", "2021-02-01"),
+            (2, "sars-2 coronavirus", "", "2021-03-01"),
+            (3, "SARS-2 CORONAVIRUS", "", "2020-11-01"),
+        )
+    )
+    columns = extract(
+        data,
+        first_covid=patients.with_tpp_vaccination_record(
+            target_disease_matches="SARS-2 CORONAVIRUS",
+            between=["2020-12-01", "2021-12-31"],
+            returning="date",
+            find_first_match_in_period=True,
+            date_format="YYYY-MM-DD",
+        ),
+        comirnaty=patients.with_tpp_vaccination_record(product_name_matches="COVID-19 mRNA Vaccine Comirnaty"),
+        flu=patients.with_tpp_vaccination_record(target_disease_matches=["influenza"]),
+    )
+    check(
+        columns,
+        first_covid=["2021-01-05", "2021-03-01", "", "", ""],
+        comirnaty=[0, 1, 0, 0, 0],
+        flu=[1, 0, 0, 0, 0],
+    )
+
+
+def test_vaccination_records_are_read_in_one_scan(monkeypatch):
+    fused = spy(monkeypatch, "scan_vaccinations_fused", query_names)
+    data = event_data(
+        vaccinations=table(
+            "vaccinations",
+            (1, "SARS-2 CORONAVIRUS", "", "2021-01-05"),
+            (1, "INFLUENZA", "", "2020-10-01"),
+            (2, "", "COVID-19 mRNA Vaccine Comirnaty", "2021-02-01"),
+        )
+    )
+    variables = dict(
+        covid=patients.with_tpp_vaccination_record(target_disease_matches="SARS-2 CORONAVIRUS"),
+        flu=patients.with_tpp_vaccination_record(target_disease_matches="INFLUENZA"),
+        comirnaty=patients.with_tpp_vaccination_record(
+            product_name_matches="COVID-19 mRNA Vaccine Comirnaty", returning="date", date_format="YYYY-MM-DD"
+        ),
+    )
+    _, frame = evaluate(data, variables=variables)
+    assert fused == [["comirnaty", "covid", "flu"]]
+    _, unfused = evaluate(data, variables=variables, fuse=False)
+    # a scan of its own for each variable
+    assert fused[1:] == [[None]] * 3
+    pd.testing.assert_frame_equal(frame, unfused)
+
+
+def test_age_and_sex(extract):
+    data = event_data(
+        patients=table(
+            "patients",
+            (1, "F", "2000-02-29"),
+            (2, "M", "2000-03-01"),
+            (3, "F", "2000-02-28"),
+            (4, "", ""),
+            (5, "M", "1950-12-31"),
+        )
+    )
+    columns = extract(
+        data,
+        sex=patients.sex(),
+        # someone born on 29 February has their birthday on 28 February in
+        # other years, as DATEADD clamps it
+        age=patients.age_as_of("2021-02-28"),
+        age_on_leap_day=patients.age_as_of("2020-02-29"),
+    )
+    check(
+        columns,
+        sex=["F", "M", "F", "", "M"],
+        age=[21, 20, 21, 0, 70],
+        age_on_leap_day=[20, 19, 20, 0, 69],
+    )
+
+
+def registrations():
+    return table(
+        "registrations",
+        (1, 10, "2019-01-01", ""),
+        # moved practice on 30 June
+        (2, 10, "2019-01-01", "2020-06-30"),
+        (2, 11, "2020-06-30", ""),
+        # ends on the last day of the period
+        (3, 11, "2019-06-01", "2021-01-01"),
+        (5, 10, "2018-01-01", "2019-12-31"),
+    )
+
+
+def test_registrations(extract):
+    data = event_data(
+        registrations=registrations(),
+        practices=table("practices", (10, "London", "STP1"), (11, "North East", "STP2")),
+    )
+    columns = extract(
+        data,
+        registered=patients.registered_as_of("2020-03-01"),
+        # registered with the same practice for the whole period, so patient
+        # 2 is not, and the end date has to be after the period ends
+        one_practice=patients.registered_with_one_practice_between("2020-01-01", "2021-01-01"),
+        deregistered=patients.date_deregistered_from_all_supported_practices(
+            on_or_after="2019-01-01", date_format="YYYY-MM-DD"
+        ),
+        stp=patients.registered_practice_as_of("2020-03-01", returning="stp_code"),
+        # on the day patient 2 moves, the new registration is the current one
+        region=patients.registered_practice_as_of("2020-06-30", returning="nuts1_region_name"),
+    )
+    check(
+        columns,
+        registered=[1, 1, 1, 0, 0],
+        one_practice=[1, 0, 0, 0, 0],
+        deregistered=["", "", "2021-01-01", "", "2019-12-31"],
+        stp=["STP1", "STP1", "STP2", "", ""],
+        region=["London", "North East", "North East", "", ""],
+    )
+
+
+def addresses():
+    return table(
+        "addresses",
+        (1, "2015-01-01", "", 12345, 3),
+        # overlapping addresses: the one that started last is used
+        (2, "2015-01-01", "", 500, 1),
+        (2, "2019-01-01", "2020-12-31", 32844, 5),
+        (3, "2010-01-01", "2019-01-01", 777, 2),
+        (5, "2020-01-01", "", 149, 4),
+    )
+
+
+def test_addresses(extract):
+    columns = extract(
+        event_data(addresses=addresses()),
+        # -1 rather than 0 for no address, as 0 is a legitimate rank
+        imd=patients.address_as_of("2020-06-01", returning="index_of_multiple_deprivation", round_to_nearest=100),
+        rural_urban=patients.address_as_of("2020-06-01", returning="rural_urban_classification"),
+    )
+    check(columns, imd=[12300, 32800, -1, -1, 100], rural_urban=[3, 5, 0, 0, 4])
+
+
+def test_sgss_tests(extract):
+    data = event_data(
+        sgss_tests=table(
+            "sgss_tests",
+            (1, "2020-03-01", "negative"),
+            (1, "2020-06-01", "positive"),
+            (2, "2020-04-01", "positive"),
+            (2, "2020-05-01", "positive"),
+            (3, "2020-07-01", "positive"),
+        )
+    )
+    columns = extract(
+        data,
+        # the earliest positive and the earliest negative test are each kept
+        # before the window is applied
+        earliest_any=patients.with_test_result_in_sgss(
+            pathogen="SARS-CoV-2",
+            test_result="any",
+            on_or_after="2020-05-01",
+            returning="date",
+            find_first_match_in_period=True,
+            date_format="YYYY-MM-DD",
+        ),
+        positive=patients.with_test_result_in_sgss(
+            pathogen="SARS-CoV-2",
+            test_result="positive",
+            on_or_after="2020-05-01",
+            restrict_to_earliest_specimen_date=False,
+        ),
+        positive_count=patients.with_test_result_in_sgss(
+            pathogen="SARS-CoV-2",
+            test_result="positive",
+            returning="number_of_matches_in_period",
+            restrict_to_earliest_specimen_date=False,
+        ),
+    )
+    check(
+        columns,
+        earliest_any=["2020-06-01", "", "2020-07-01", "", ""],
+        positive=[1, 1, 1, 0, 0],
+        positive_count=[1, 2, 1, 0, 0],
+    )
+
+
+def test_hospital_admissions_deaths_and_consultations(extract):
+    data = event_data(
+        hospital_admissions=table(
+            "hospital_admissions",
+            (1, "2020-04-01", "21", "1", "U071 J12"),
+            (1, "2020-08-01", "22", "1", "U072"),
+            (2, "2020-05-01", "11", "1", "I10"),
+        ),
+        ons_deaths=table("ons_deaths", (2, "2020-05-05"), (3, "2019-12-01")),
+        gp_consultations=table(
+            "gp_consultations", (1, "2020-01-05"), (1, "2020-02-05"), (1, "2019-05-05"), (3, "2020-07-01")
+        ),
+    )
+    columns = extract(
+        data,
+        covid_admission=patients.admitted_to_hospital(
+            with_these_diagnoses=codelist(["U07"], "icd10"),
+            between=["2020-01-01", "2020-12-31"],
+            returning="date_admitted",
+            find_first_match_in_period=True,
+            date_format="YYYY-MM-DD",
+        ),
+        emergency=patients.admitted_to_hospital(with_admission_method=["21", "22"]),
+        died=patients.died_from_any_cause(
+            on_or_after="2020-01-01", returning="date_of_death", date_format="YYYY-MM-DD"
+        ),
+        consultations=patients.with_gp_consultations(
+            between=["2020-01-01", "2020-12-31"], returning="number_of_matches_in_period"
+        ),
+    )
+    check(
+        columns,
+        covid_admission=["2020-04-01", "", "", "", ""],
+        emergency=[1, 0, 0, 0, 0],
+        died=["", "2020-05-05", "", "", ""],
+        consultations=[2, 0, 1, 0, 0],
+    )
+
+
+def test_ethnicity_from_sus(extract):
+    # the most frequent code, leaving out unknown (99 and Z) codes
+    data = event_data(
+        sus_ethnicity=table(
+            "sus_ethnicity", (1, "A"), (1, "A"), (1, "D"), (2, "H"), (2, "H"), (2, "99"), (2, "Z"), (2, "Z")
+        )
+    )
+    columns = extract(
+        data,
+        code=patients.with_ethnicity_from_sus(returning="code", use_most_frequent_code=True),
+        group_6=patients.with_ethnicity_from_sus(returning="group_6", use_most_frequent_code=True),
+    )
+    check(columns, code=["A", "H", "", "", ""], group_6=[1, 3, 0, 0, 0])
+
+
+def test_expressions(extract):
+    data = event_data(
+        patients=table(
+            "patients",
+            (1, "F", "2000-02-29"),
+            (2, "M", "2000-03-01"),
+            (3, "F", "2000-02-28"),
+            (4, "", ""),
+            (5, "M", "1950-12-31"),
+        ),
+        addresses=addresses(),
+        clinical_events=clinical_events(),
+    )
+    columns = extract(
+        data,
+        age=patients.age_as_of("2021-02-28"),
+        # identical to age, so it is read from age's result
+        same_age=patients.age_as_of("2021-02-28"),
+        imd=patients.address_as_of("2020-06-01", returning="index_of_multiple_deprivation", round_to_nearest=100),
+        age_band=patients.categorised_as(
+            {"0": "DEFAULT", "old": "age >= 21", "young": "age > 0 AND age < 21"},
+        ),
+        # a missing address is -1, so it isn't a known rank
+        imd_known=patients.satisfying("imd >= 0 AND NOT age_band = 'young'"),
+        anchor=patients.with_these_clinical_events(
+            anchor_codes, returning="date", find_first_match_in_period=True, date_format="YYYY-MM-DD"
+        ),
+        first_event=patients.with_these_clinical_events(
+            codes, returning="date", find_first_match_in_period=True, date_format="YYYY-MM-DD"
+        ),
+        # missing dates are ignored, as NULLs are by MIN
+        earliest=patients.minimum_of("anchor", "first_event"),
+    )
+    check(
+        columns,
+        same_age=[21, 20, 21, 0, 70],
+        age_band=["old", "young", "old", "0", "old"],
+        imd_known=[1, 0, 0, 0, 1],
+        earliest=["2020-01-10", "2020-06-01", "2019-12-31", "2020-01-15", ""],
+    )
+
+
+def test_population(extract):
+    columns = extract(
+        event_data(registrations=registrations(), clinical_events=clinical_events()),
+        population=patients.registered_as_of("2020-03-01"),
+        flag=patients.with_these_clinical_events(codes, on_or_after="2020-01-01"),
+    )
+    check(columns, patient_id=[1, 2, 3], flag=[1, 1, 0])
+
+
+def test_staged_extraction_evaluates_the_population_first(monkeypatch):
+    scans = spy(monkeypatch, "scan_events_fused", lambda table, queries, n: (query_names(table, queries, n), n))
+    data = event_data(registrations=registrations(), clinical_events=clinical_events())
+    variables = dict(
+        registered=patients.registered_as_of("2020-03-01"),
+        has_anchor=patients.with_these_clinical_events(anchor_codes),
+        flag=patients.with_these_clinical_events(codes, on_or_after="2020-01-01"),
+    )
+    population = patients.satisfying("registered AND has_anchor")
+    backend, frame = evaluate(data, variables=variables, population=population, staged=True)
+    # the population's variables for all five patients, the rest only for
+    # patients 1 and 2
+    assert scans == [(["has_anchor"], 5), (["flag"], 2)]
+    assert backend.n_patients == 2
+    _, unstaged = evaluate(data, variables=variables, population=population)
+    pd.testing.assert_frame_equal(frame, unstaged)
+    assert list(frame["patient_id"]) == [1, 2]
+
+
+def test_independent_variables_run_at_the_same_time(monkeypatch):
+    # each of these waits for the other, so they must run on two threads
+    barrier = threading.Barrier(2, timeout=10)
+    for method in ("patients_sex", "patients_age_as_of"):
+        original = getattr(LocalBackend, method)
+
+        def waiting(self, *args, original=original, **kwargs):
+            barrier.wait()
+            return original(self, *args, **kwargs)
+        monkeypatch.setattr(LocalBackend, method, waiting)
+    variables = dict(
+        sex=patients.sex(),
+        age=patients.age_as_of("2020-01-01"),
+        # only once age is known
+        adult=patients.satisfying("age >= 18"),
+    )
+    _, frame = evaluate(event_data(), variables=variables, workers=2)
+    assert list(frame["adult"]) == [1] * n_patients
+
+
+def satisfying(**expressions):
+    # definitions cohortextractor itself would reject, for the backend's checks
+    variables = {name: patients.satisfying("sex") for name in expressions}
+    definitions = StudyDefinition(population=patients.all(), sex=patients.sex(), **variables).covariate_definitions
+    for name, expression in expressions.items():
+        definitions[name][1]["category_definitions"][1] = expression
+    return definitions
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_dependency_errors(workers):
+    data = event_data()
+    with pytest.raises(ValueError, match="Circular dependency between variables: a, b"):
+        LocalBackend(data, satisfying(a="b", b="a"), workers=workers).evaluate()
+    with pytest.raises(ValueError, match="a refers to undefined variables: missing"):
+        LocalBackend(data, satisfying(a="missing"), workers=workers).evaluate()
+
+
+def test_sharding_matches_a_single_process():
+    data = event_data(
+        patients=table(
+            "patients", (1, "F", "1980-01-01"), (2, "M", "1990-01-01"), (3, "F", "2000-01-01"),
+            (4, "", "1970-01-01"), (5, "M", "1960-01-01"),
+        ),
+        clinical_events=clinical_events(),
+    )
+    study = StudyDefinition(
+        population=patients.satisfying("sex = 'F' OR sex = 'M'"),
+        sex=patients.sex(),
+        last_category=patients.with_these_clinical_events(
+            categorised_codes, returning="category", find_last_match_in_period=True
+        ),
+        first_date=patients.with_these_clinical_events(codes, returning="date", date_format="YYYY-MM-DD"),
+    )
+    for typed in (False, True):
+        expected = LocalBackend(data, study.covariate_definitions).to_dataframe(typed=typed)
+        # more shards than patients leaves some shards empty
+        for shards in (2, 3, 7):
+            frame = extract_sharded(data, study.covariate_definitions, shards, typed=typed)
+            pd.testing.assert_frame_equal(frame, expected)
+    # categories seen in different shards are merged
+    assert list(frame["sex"].cat.categories) == ["F", "M"]
+    profile = ExtractionProfile(trace_memory=False)
+    extract_sharded(data, study.covariate_definitions, 2, profile=profile)
+    # every shard's patients are counted, in the population or not
+    assert profile.variables["first_date"]["rows_emitted"] == 4
+
+
+class RecordingWriter:
+    frames = []
+
+    def __init__(self, path, partition_by=None):
+        RecordingWriter.frames = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def write(self, frame):
+        self.frames.append(frame)
+
+
+@pytest.mark.parametrize(
+    "registered_on, written",
+    [
+        # only patient 5, in the last of three batches
+        ("2018-06-01", [[5]]),
+        # nobody: the first empty batch is written, for the output's columns
+        ("2010-01-01", [[]]),
+    ],
+)
+def test_streaming_skips_empty_batches(monkeypatch, registered_on, written):
+    monkeypatch.setattr(local_backend, "StreamingWriter", RecordingWriter)
+    study = StudyDefinition(
+        population=patients.registered_as_of(registered_on),
+        flag=patients.with_these_clinical_events(codes, on_or_after="2020-01-01"),
+    )
+    data = event_data(registrations=registrations(), clinical_events=clinical_events())
+    extract_streaming(data, study.covariate_definitions, "unused.parquet", batch_size=2)
+    assert [list(frame["patient_id"]) for frame in RecordingWriter.frames] == written
+    assert all(list(frame.columns) == ["patient_id", "flag"] for frame in RecordingWriter.frames)
+
+
+def test_editing_a_variable_recomputes_only_it_and_its_dependents(tmp_path):
+    def run(on_or_after):
+        study = StudyDefinition(
+            population=patients.all(),
+            sex=patients.sex(),
+            flag=patients.with_these_clinical_events(codes, on_or_after=on_or_after),
+            last_category=patients.with_these_clinical_events(
+                categorised_codes, returning="category", find_last_match_in_period=True
+            ),
+            flagged_female=patients.satisfying("flag AND sex = 'F'"),
+            group=patients.categorised_as({"A": "flagged_female", "B": "DEFAULT"}),
+        )
+        profile = ExtractionProfile(trace_memory=False)
+        backend = LocalBackend(data, study.covariate_definitions, profile=profile, cache=ResultCache(str(tmp_path)))
+        frame = backend.to_dataframe()
+        recomputed = {name for name, record in profile.variables.items() if record["cache_misses"].get("result_cache")}
+        return frame, recomputed
+
+    data = event_data(
+        patients=table("patients", *[(i, "FMFMF"[i - 1], "1980-01-01") for i in range(1, n_patients + 1)]),
+        clinical_events=clinical_events(),
+    )
+    _, recomputed = run("2020-01-01")
+    assert recomputed == {"population", "sex", "flag", "last_category", "flagged_female", "group"}
+    frame, recomputed = run("2020-01-01")
+    assert recomputed == set()
+    # text columns come back from the cache as they were computed
+    assert list(frame["last_category"]) == ["B", "B", "A", "A", ""]
+    assert list(frame["group"]) == ["A", "B", "B", "B", "B"]
+    # a new window for flag: only flag and what depends on it are recomputed,
+    # and nothing stale is read back
+    frame, recomputed = run("2019-01-01")
+    assert recomputed == {"flag", "flagged_female", "group"}
+    assert list(frame["group"]) == ["A", "B", "A", "B", "B"]
+
+
+def test_profile_records_result_cache_hits(tmp_path):
+    study = StudyDefinition(
+        population=patients.all(),
+        flag=patients.with_these_clinical_events(codes, on_or_after="2020-01-01"),
+    )
+    data = event_data(clinical_events=clinical_events())
+    cache = ResultCache(str(tmp_path))
+    profiles = [ExtractionProfile(trace_memory=False), ExtractionProfile(trace_memory=False)]
+    for profile in profiles:
+        LocalBackend(data, study.covariate_definitions, profile=profile, cache=cache).to_dataframe()
+    cold, warm = (profile.variables for profile in profiles)
+    assert sorted(warm) == sorted(cold) == ["flag", "population"]
+    assert cold["flag"]["cache_misses"]["result_cache"] == 1
+    assert cold["flag"]["rows_scanned"] == len(clinical_events())
+    assert warm["flag"]["cache_hits"] == {"result_cache": 1}
+    assert warm["flag"]["rows_scanned"] == 0
+    assert warm["flag"]["rows_emitted"] == cold["flag"]["rows_emitted"] == 3
@@ -0,0 +1,151 @@
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+import output_files
+from output_files import StreamingWriter, concat_frames, skip_empty, write_output, write_partitioned
+
+requires_pyarrow = pytest.mark.skipif(output_files.pyarrow is None, reason="pyarrow can't be imported")
+
+
+def typed_frame(patient_ids, regions, dates):
+    # as LocalBackend.to_dataframe(typed=True) gives them
+    return pd.DataFrame(
+        {
+            "patient_id": np.array(patient_ids, dtype=np.int64),
+            "flag": np.array([i % 2 == 0 for i in patient_ids]),
+            "region": pd.Categorical(regions),
+            "first_date": np.array(dates, dtype="datetime64[D]"),
+        }
+    )
+
+
+def read_columnar(path):
+    import pyarrow.feather
+    import pyarrow.parquet
+
+    if path.endswith(".feather"):
+        return pyarrow.feather.read_table(path)
+    return pyarrow.parquet.read_table(path)
+
+
+@requires_pyarrow
+@pytest.mark.parametrize("extension", [".parquet", ".feather"])
+def test_columnar_round_trip(tmp_path, extension):
+    import pyarrow
+
+    path = str(tmp_path / f"input{extension}")
+    first = typed_frame([1, 2], ["North", ""], ["2020-01-10", "NaT"])
+    second = typed_frame([3, 4], ["South", "North"], ["2021-03-01", "2020-02-29"])
+    with StreamingWriter(path) as writer:
+        writer.write(first)
+        writer.write(second)
+    table = read_columnar(path)
+    schema = table.schema
+    assert schema.field("patient_id").type == pyarrow.int64()
+    assert schema.field("flag").type == pyarrow.bool_()
+    # dates are plain dates, and text is dictionary encoded with 32 bit
+    # indices, whichever categories each batch had
+    assert schema.field("first_date").type == pyarrow.date32()
+    assert schema.field("region").type == pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    assert table.column("patient_id").to_pylist() == [1, 2, 3, 4]
+    assert table.column("region").to_pylist() == ["North", "", "South", "North"]
+    assert table.column("first_date").to_pylist() == [
+        datetime.date(2020, 1, 10), None, datetime.date(2021, 3, 1), datetime.date(2020, 2, 29)
+    ]
+    # writing everything at once gives the same table
+    whole = str(tmp_path / f"whole{extension}")
+    write_output(concat_frames([first, second]), whole)
+    assert read_columnar(whole).to_pylist() == table.to_pylist()
+
+
+@requires_pyarrow
+def test_parquet_statistics(tmp_path):
+    import pyarrow.parquet
+
+    path = str(tmp_path / "input.parquet")
+    write_output(typed_frame([1, 2, 3], ["North", "South", "North"], ["2020-01-10", "NaT", "2021-03-01"]), path)
+    row_group = pyarrow.parquet.ParquetFile(path).metadata.row_group(0)
+    statistics = {row_group.column(i).path_in_schema: row_group.column(i).statistics for i in range(4)}
+    assert (statistics["patient_id"].min, statistics["patient_id"].max) == (1, 3)
+    dates = statistics["first_date"]
+    assert (dates.min, dates.max, dates.null_count) == (datetime.date(2020, 1, 10), datetime.date(2021, 3, 1), 1)
+
+
+def test_csv_streams_in_order(tmp_path):
+    path = tmp_path / "input.csv"
+    with StreamingWriter(str(path)) as writer:
+        writer.write(pd.DataFrame({"patient_id": [1, 2], "age": [30, 40]}))
+        writer.write(pd.DataFrame({"patient_id": [3], "age": [50]}))
+    assert path.read_text() == "patient_id,age\n1,30\n2,40\n3,50\n"
+
+
+def test_unknown_extension(tmp_path):
+    with pytest.raises(ValueError, match="extensions"):
+        write_output(pd.DataFrame({"patient_id": [1]}), str(tmp_path / "input.txt"))
+
+
+def read_csvs(paths):
+    return {path.name: path.read_text() for path in paths}
+
+
+def test_partition_file_names(tmp_path):
+    frame = pd.DataFrame(
+        {
+            "patient_id": [1, 2, 3, 4, 5],
+            "jcvi_group": ["02", "11", "02", "", "09"],
+            "elig_date": np.array(["2020-12-08", "NaT", "2021-04-30", "2020-12-08", "NaT"], dtype="datetime64[ns]"),
+        }
+    )
+    paths = write_partitioned(frame, str(tmp_path / "input.csv.gz"), "jcvi_group")
+    # in order of value, with empty values as "missing"
+    assert [os.path.basename(path) for path in paths] == [
+        "input_jcvi_group_missing.csv.gz",
+        "input_jcvi_group_02.csv.gz",
+        "input_jcvi_group_09.csv.gz",
+        "input_jcvi_group_11.csv.gz",
+    ]
+    assert list(pd.read_csv(paths[1], dtype=str)["patient_id"]) == ["1", "3"]
+    paths = write_partitioned(frame, str(tmp_path / "input.csv"), "elig_date")
+    assert [os.path.basename(path) for path in paths] == [
+        "input_elig_date_2020-12-08.csv",
+        "input_elig_date_2021-04-30.csv",
+        "input_elig_date_missing.csv",
+    ]
+    with pytest.raises(ValueError, match="isn't an output column"):
+        write_partitioned(frame, str(tmp_path / "input.csv"), "region")
+
+
+def test_partitions_stream_in_order(tmp_path):
+    path = str(tmp_path / "input.csv")
+    with StreamingWriter(path, partition_by="group") as writer:
+        writer.write(pd.DataFrame({"patient_id": [1, 2], "group": ["a", "b"]}))
+        writer.write(pd.DataFrame({"patient_id": [3, 4], "group": ["b", "c"]}))
+    assert read_csvs(sorted(tmp_path.iterdir())) == {
+        "input_group_a.csv": "patient_id,group\n1,a\n",
+        "input_group_b.csv": "patient_id,group\n2,b\n3,b\n",
+        "input_group_c.csv": "patient_id,group\n4,c\n",
+    }
+
+
+def test_skip_empty():
+    empty = pd.DataFrame({"patient_id": pd.Series([], dtype=object)})
+    full = pd.DataFrame({"patient_id": [1, 2]})
+    assert [len(frame) for frame in skip_empty([empty, full, empty, full])] == [2, 2]
+    # with nothing but empty frames, the first keeps the columns
+    assert [frame is empty for frame in skip_empty([empty, empty.copy()])] == [True]
+    assert list(skip_empty([])) == []
+    assert concat_frames(skip_empty([empty, full])).dtypes["patient_id"] == np.int64
+
+
+def test_cohort_file_is_what_the_pipeline_reads():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(root, "project.yaml")) as f:
+        project = yaml.safe_load(f)
+    assert project["actions"]["study_definition"]["outputs"]["highly_sensitive"]["cohort"] == output_files.cohort_file
+    with open(os.path.join(root, "analysis", "01_data_process.R")) as f:
+        assert f'here::here("output", "{os.path.basename(output_files.cohort_file)}")' in f.read()
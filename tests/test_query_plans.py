@@ -0,0 +1,70 @@
+import contextlib
+import sqlite3
+
+from cohortextractor import StudyDefinition, codelist, patients
+
+from benchmark import synthetic_frames
+from query_plans import explain, plan_flags, table_indexes, variable_plans
+from standin_database import write_database
+
+
+def covariate_definitions():
+    asthma_codes = codelist(["XaLTE", "22K.."], system="ctv3")
+    study = StudyDefinition(
+        population=patients.all(),
+        asthma=patients.with_these_clinical_events(
+            asthma_codes, between=["2020-01-01", "2020-12-31"], returning="date", find_first_match_in_period=True
+        ),
+        asthma_count=patients.with_these_clinical_events(
+            codelist(["22K.."], system="ctv3"), returning="number_of_matches_in_period"
+        ),
+        vaccinated=patients.with_tpp_vaccination_record(
+            target_disease_matches="SARS-2 CORONAVIRUS", between=["2020-12-01", "2021-03-31"]
+        ),
+        died=patients.died_from_any_cause(on_or_before="2021-03-31", returning="binary_flag"),
+        registered=patients.registered_as_of("2020-03-01"),
+        age=patients.age_as_of("2020-03-01"),
+    )
+    return study.covariate_definitions
+
+
+def standin(tmp_path):
+    path = str(tmp_path / "standin.sqlite")
+    write_database(path, synthetic_frames(covariate_definitions(), 2000, events_per_patient=5))
+    return path
+
+
+def test_queries_reading_the_patient_id_index_in_order_are_not_flagged(tmp_path):
+    # every per-patient query groups by patient_id, which SQLite does by
+    # reading the (patient_id, ...) index in order
+    report = variable_plans(covariate_definitions(), standin(tmp_path), "2021-01-01")
+    assert any("USING COVERING INDEX clinical_events_ix" in step for step in report["asthma"]["plan"])
+    assert {name: record["flags"] for name, record in report.items()} == {name: [] for name in report}
+
+
+def test_full_scans_and_unused_indexes_on_filtered_columns_are_flagged(tmp_path):
+    with contextlib.closing(sqlite3.connect(standin(tmp_path))) as connection:
+        indexes = table_indexes(connection)
+        sql = (
+            "SELECT patient_id, MAX(date) FROM clinical_events NOT INDEXED"
+            " WHERE code IN ('XaLTE') AND date >= ? GROUP BY patient_id"
+        )
+        plan, _ = explain(connection, sql, ["2020-01-01"])
+    assert plan_flags(plan, indexes, sql) == [
+        "full scan of clinical_events",
+        "clinical_events has index clinical_events_ix on code, date but it isn't used",
+    ]
+    # an index is only worth mentioning if it's on a column the query filters
+    sql = "SELECT patient_id, COUNT(*) FROM gp_consultations NOT INDEXED GROUP BY patient_id"
+    assert plan_flags(["SCAN gp_consultations"], indexes, sql) == ["full scan of gp_consultations"]
+
+
+def test_index_scans_not_led_by_patient_id_are_flagged():
+    indexes = {"clinical_events": {"clinical_events_ix": ["patient_id", "code", "date"], "date_ix": ["date"]}}
+    sql = "SELECT patient_id, 1 FROM clinical_events WHERE code IN ('XaLTE') GROUP BY patient_id"
+    assert plan_flags(["SCAN clinical_events USING COVERING INDEX clinical_events_ix"], indexes, sql) == []
+    assert plan_flags(["  SCAN clinical_events USING INDEX date_ix"], indexes, sql) == [
+        "reads every entry of date_ix on clinical_events: its leading column date isn't constrained"
+    ]
+    # tables read whole by design
+    assert plan_flags(["SCAN patients"], indexes, "SELECT patient_id, sex FROM patients") == []
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+from cohortextractor import codelist, patients
+
+from benchmark import synthetic_frames
+from event_data import EventData
+from standin_database import write_database
+
+
+def covariate_definitions():
+    # codes for the synthetic tables to draw from: a CTV3 codelist, which is
+    # interned, and a SNOMED one, which isn't
+    ctv3 = codelist(["XaLTE", "22K..", "0123"], system="ctv3")
+    snomed = codelist(["1027761000000104", "123456789"], system="snomed")
+    return dict(
+        asthma=patients.with_these_clinical_events(ctv3, returning="binary_flag"),
+        inhaler=patients.with_these_medications(snomed, returning="binary_flag"),
+        vaccinated=patients.with_tpp_vaccination_record(target_disease_matches="SARS-2 CORONAVIRUS"),
+    )
+
+
+def test_standin_database_reads_back_as_the_frames_it_was_built_from(tmp_path):
+    frames = synthetic_frames(covariate_definitions(), 500, events_per_patient=4, seed=1)
+    path = str(tmp_path / "standin.sqlite")
+    write_database(path, frames)
+    from_sqlite = EventData.from_sqlite(path)
+    in_memory = EventData({name: pd.DataFrame(columns) for name, columns in frames.items()})
+    np.testing.assert_array_equal(from_sqlite.patient_ids, np.arange(1, 501))
+    assert from_sqlite.tables.keys() == in_memory.tables.keys()
+    for name, table in in_memory.tables.items():
+        assert from_sqlite.tables[name].keys() == table.keys(), name
+        for column, values in table.items():
+            assert from_sqlite.tables[name][column].dtype == values.dtype, (name, column)
+            np.testing.assert_array_equal(from_sqlite.tables[name][column], values, err_msg=f"{name}.{column}")
+    assert from_sqlite.fingerprint() == in_memory.fingerprint()
+    assert len(in_memory.tables["clinical_events"]["row"]) == 2000
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from study_expressions import ExpressionEvaluator, names_in, parse_expression
+
+
+def test_precedence():
+    assert parse_expression("a OR b AND NOT c") == (
+        "or", ("column", "a"), ("and", ("column", "b"), ("not", ("column", "c")))
+    )
+    assert parse_expression("(a OR b) AND c") == (
+        "and", ("or", ("column", "a"), ("column", "b")), ("column", "c")
+    )
+    assert parse_expression("a + b * 2 >= 3.5") == (
+        "compare", ">=", ("arithmetic", "+", ("column", "a"), ("arithmetic", "*", ("column", "b"), ("literal", 2))),
+        ("literal", 3.5),
+    )
+    assert names_in(parse_expression("age >= 80 AND (sex = 'F' OR flag)")) == {"age", "sex", "flag"}
+
+
+def test_unbalanced_brackets():
+    with pytest.raises(ValueError, match="Unbalanced brackets"):
+        parse_expression("(a AND b")
+
+
+def columns():
+    return dict(
+        age=np.array([85, 70, 80, 50]),
+        sex=np.array(["F", "M", "", "F"], dtype=object),
+        died=np.array(["2021-01-01", "NaT", "2020-06-01", "NaT"], dtype="datetime64[D]"),
+        vaccinated=np.array(["2020-12-01"] * 4, dtype="datetime64[D]"),
+    )
+
+
+def test_tpp_semantics():
+    evaluator = ExpressionEvaluator(columns().__getitem__)
+    # empty strings and missing dates are false
+    assert evaluator.truth(parse_expression("sex")).tolist() == [True, True, False, True]
+    assert evaluator.truth(parse_expression("died")).tolist() == [True, False, True, False]
+    # a missing date compares as the earliest date
+    assert evaluator.truth(parse_expression("died < vaccinated")).tolist() == [False, True, True, True]
+    assert evaluator.value(parse_expression("age - 5 * 2")).tolist() == [75, 60, 70, 40]
+
+
+def test_subexpressions_are_computed_once():
+    read = []
+    lookups = []
+    values = columns()
+
+    def column_values(name):
+        read.append(name)
+        return values[name]
+    evaluator = ExpressionEvaluator(column_values, lambda cache, hit: lookups.append(hit))
+    first = evaluator.truth(parse_expression("age >= 80 AND sex = 'F'"))
+    before = len(lookups)
+    second = evaluator.truth(parse_expression("age >= 80 OR died"))
+    assert first.tolist() == [True, False, False, False]
+    assert second.tolist() == [True, False, True, False]
+    # each column is read once, and `age >= 80` is shared
+    assert sorted(read) == ["age", "died", "sex"]
+    assert lookups[before:].count(True) == 1
+
+
+def test_select_takes_the_first_true_condition():
+    evaluator = ExpressionEvaluator(columns().__getitem__)
+    nodes = [parse_expression("age >= 80"), parse_expression("sex = 'F'")]
+    assert evaluator.select(nodes).tolist() == [1, 0, 1, 2]
@@ -0,0 +1,43 @@
+from cohortextractor import StudyDefinition, codelist, patients
+
+from variable_keys import alias_map, dedupe_covariate_definitions
+
+
+def definitions(**variables):
+    return StudyDefinition(population=patients.all(), **variables).covariate_definitions
+
+
+def test_keys_ignore_output_formatting():
+    codes = codelist(["1001", "1002"], "snomed")
+    same_codes = codelist(["1002", "1001"], "snomed")
+    aliases = alias_map(
+        definitions(
+            first=patients.with_these_clinical_events(
+                codes, returning="date", date_format="YYYY-MM-DD", return_expectations={"incidence": 0.1}
+            ),
+            # the same query, formatted differently and with other expectations
+            by_month=patients.with_these_clinical_events(
+                same_codes, returning="date", date_format="YYYY-MM", return_expectations={"incidence": 0.9}
+            ),
+            # a different value from the same events
+            count=patients.with_these_clinical_events(codes, returning="number_of_matches_in_period"),
+            flag=patients.with_these_clinical_events(codes),
+            other_codes=patients.with_these_clinical_events(codelist(["1001"], "snomed")),
+        )
+    )
+    assert aliases == {"by_month": "first"}
+
+
+def test_aliases_read_their_source():
+    deduped = dedupe_covariate_definitions(
+        definitions(
+            age_1=patients.age_as_of("2021-03-31"),
+            age_2=patients.age_as_of("2021-03-31", return_expectations={"int": {"distribution": "normal"}}),
+            older=patients.satisfying("age_2 > 80"),
+        )
+    )
+    query_type, query_args = deduped["age_2"]
+    assert query_type == "value_from"
+    assert query_args["source"] == "age_1"
+    assert deduped["age_1"][0] == "age_as_of"
+    assert deduped["older"][0] == "categorised_as"